@@ -0,0 +1,100 @@
+#! /usr/bin/env python3
+
+############################################################################
+##  bench_inventory.py
+##
+##  Part of the YonderGit remote Git repository management utilities.
+##
+##  This program is free software; you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation; either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License along
+##  with this programm. If not, see <http://www.gnu.org/licenses/>.
+##
+############################################################################
+
+"""
+Benchmark of large in-memory repository inventories: measures the time and
+memory taken to parse an inventory of repository URLs (with each repository
+listed several times, under differently-spelled URLs), to deduplicate it and
+to group it by host.
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "scripts"))
+import ygit
+
+def inventory_urls(num_repos, num_hosts):
+    """
+    Returns a list of URLs for `num_repos` repositories spread over
+    `num_hosts` hosts, listing every tenth repository a second time under
+    an alternative spelling of its URL.
+    """
+    urls = []
+    for idx in range(num_repos):
+        host = "host%d.example.org" % (idx % num_hosts)
+        urls.append("git@%s:/srv/git/group%d/repo%d.git" % (host, idx % 97, idx))
+        if idx % 10 == 0:
+            urls.append("ssh://git@%s:22/srv/git/group%d/repo%d/" % (host.upper(), idx % 97, idx))
+    return urls
+
+def measure(label, func):
+    """
+    Runs `func` twice: once to time it, and once to trace its memory use
+    (which would otherwise slow it down), clearing the URL parsing cache
+    beforehand each time.
+    """
+    ygit._parse_url_record.cache_clear()
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    ygit._parse_url_record.cache_clear()
+    tracemalloc.start()
+    result = func()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    sys.stdout.write("%-40s %8.3fs %10.1f MiB retained %10.1f MiB peak\n" \
+        % (label, elapsed, current / 1048576.0, peak / 1048576.0))
+    return result
+
+def main():
+    parser = OptionParser(usage="%prog [options]",
+                          description=__doc__.strip())
+    parser.add_option('-n', '--num-repos',
+        action='store',
+        type='int',
+        dest='num_repos',
+        default=100000,
+        help='number of repositories in the inventory (default: %default)')
+    parser.add_option('--num-hosts',
+        action='store',
+        type='int',
+        dest='num_hosts',
+        default=100,
+        help='number of hosts over which repositories are spread (default: %default)')
+    (opts, args) = parser.parse_args()
+
+    urls = inventory_urls(opts.num_repos, opts.num_hosts)
+    sys.stdout.write("%d URLs, %d repositories, %d hosts\n" % (len(urls), opts.num_repos, opts.num_hosts))
+    refs = measure("parse", lambda: ygit.RepositoryReference.parse_many(urls))
+    unique = measure("deduplicate", lambda: set(refs))
+    groups = measure("group by host", lambda: ygit.group_by_host(refs))
+    sys.stdout.write("%d distinct repositories on %d hosts\n" % (len(unique), len(groups)))
+    if len(unique) != opts.num_repos or len(groups) != opts.num_hosts:
+        sys.stderr.write("Equivalent URLs were not recognized as such\n")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
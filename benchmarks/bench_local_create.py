@@ -0,0 +1,124 @@
+#! /usr/bin/env python3
+
+############################################################################
+##  bench_local_create.py
+##
+##  Part of the YonderGit remote Git repository management utilities.
+##
+##  This program is free software; you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation; either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License along
+##  with this programm. If not, see <http://www.gnu.org/licenses/>.
+##
+############################################################################
+
+"""
+Benchmark of the creation of local ("file://") repositories: compares the
+rate at which repositories are created by running git in a shell for each
+repository against that at which they are copied from a template, after
+checking that both produce identical repositories.
+"""
+
+import os
+import sys
+import stat
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "scripts"))
+import ygit
+
+OPTION_SETS = [
+    ["--bare"],
+    ["--bare", "--shared=group"],
+    ["--working"],
+    ["--working", "--shared=0640"],
+]
+
+def parse_opts(args, use_templates):
+    opts, _ = ygit.create_option_parser().parse_args(args + ["-Q"])
+    opts.use_templates = use_templates
+    return opts
+
+def tree_signature(root):
+    """
+    Returns a sorted list describing every entry under `root`: its relative
+    path, permissions and contents (or link target).
+    """
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                content = os.readlink(path)
+            elif stat.S_ISDIR(st.st_mode):
+                content = None
+            else:
+                with open(path, "rb") as f:
+                    content = f.read()
+            entries.append((os.path.relpath(path, root), stat.S_IMODE(st.st_mode), content))
+    entries.sort()
+    return entries
+
+def create_repos(work_dir, prefix, num_repos, opts, messenger):
+    """
+    Creates `num_repos` repositories under `work_dir`, returning the time
+    taken.
+    """
+    start = time.time()
+    for idx in range(num_repos):
+        repo_ref = ygit.parse_repo_url("create", "file://%s/%s%d.git" % (work_dir, prefix, idx))
+        ygit.create_remote(repo_ref, messenger, opts)
+    return time.time() - start
+
+def main():
+    parser = OptionParser(usage="%prog [options]", description=__doc__.strip())
+    parser.add_option("-n", "--num-repos",
+        type="int",
+        default=200,
+        help="number of repositories to create with each method (default: %default)")
+    opts, args = parser.parse_args()
+
+    messenger = ygit.Messenger(all_quiet=True)
+    work_dir = os.path.realpath(tempfile.mkdtemp(prefix="ygit-bench-"))
+    try:
+        for idx, option_set in enumerate(OPTION_SETS):
+            git_opts = parse_opts(option_set, use_templates=False)
+            template_opts = parse_opts(option_set, use_templates=True)
+            # both methods must produce the same repository, wherever it is
+            ygit.create_remote(ygit.parse_repo_url("create", "file://%s/check%d/repo.git" % (work_dir, idx)), messenger, git_opts)
+            ygit.create_remote(ygit.parse_repo_url("create", "file://%s/check%d/templated/repo.git" % (work_dir, idx)), messenger, template_opts)
+            expected = tree_signature(os.path.join(work_dir, "check%d" % idx, "repo.git"))
+            found = tree_signature(os.path.join(work_dir, "check%d" % idx, "templated", "repo.git"))
+            if expected != found:
+                sys.stderr.write("Templated repository differs for options: %s\n" % " ".join(option_set))
+                sys.exit(1)
+        sys.stdout.write("Templated repositories identical to those created by git for: %s\n"
+            % ", ".join(" ".join(option_set) for option_set in OPTION_SETS))
+
+        sys.stdout.write("%-28s %12s %12s %9s\n" % ("options", "git repos/s", "tmpl repos/s", "speedup"))
+        for idx, option_set in enumerate(OPTION_SETS):
+            git_elapsed = create_repos(work_dir, "git%d-" % idx, opts.num_repos,
+                    parse_opts(option_set, use_templates=False), messenger)
+            template_elapsed = create_repos(work_dir, "tmpl%d-" % idx, opts.num_repos,
+                    parse_opts(option_set, use_templates=True), messenger)
+            sys.stdout.write("%-28s %12.1f %12.1f %8.1fx\n" % (" ".join(option_set),
+                opts.num_repos / git_elapsed,
+                opts.num_repos / template_elapsed,
+                git_elapsed / template_elapsed))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+#! /usr/bin/env python3
+
+############################################################################
+##  bench_remote_ops.py
+##
+##  Part of the YonderGit remote Git repository management utilities.
+##
+##  This program is free software; you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation; either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License along
+##  with this programm. If not, see <http://www.gnu.org/licenses/>.
+##
+############################################################################
+
+"""
+Benchmark of the remote operations of ygit: runs "check", "create",
+"init", "setup" and "delete" against increasing numbers of repositories on
+a simulated remote host, reached through "fake_ssh.py" (which runs the
+remote commands locally, adding a configurable connection and per-command
+latency), and reports, for each, the wall time, the number of subprocesses
+that ygit ran and the number of ssh connections and round trips that it
+made.
+
+Each command is run in "bulk" mode, i.e., in a single invocation of ygit
+("check" and "delete" given all the repositories; "create", "init" and
+"setup" through "batch"), and, for up to "--loop-limit" repositories, in
+"loop" mode, i.e., with one invocation of ygit per repository. Any
+arguments following "--" are passed to each invocation of ygit.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+YGIT = os.path.join(BENCHMARKS_DIR, os.pardir, "scripts", "ygit.py")
+FAKE_SSH = os.path.join(BENCHMARKS_DIR, "fake_ssh.py")
+
+COMMANDS = ["check", "create", "init", "setup", "delete"]
+
+class Scenario(object):
+    """
+    A run of a single command against `num_repos` repositories in a fresh
+    directory, `root`.
+    """
+
+    def __init__(self, command, mode, num_repos, root):
+        self.command = command
+        self.mode = mode
+        self.num_repos = num_repos
+        self.root = root
+        self.paths = [os.path.join(root, "srv", "repo%d.git" % idx) for idx in range(num_repos)]
+        self.urls = ["localhost:%s" % path for path in self.paths]
+
+    def prepare(self):
+        """
+        Sets up the repositories (or directories) that the command expects
+        to find, and the local repository to which remotes are added.
+        """
+        os.makedirs(os.path.join(self.root, "srv"))
+        os.makedirs(os.path.join(self.root, "local"))
+        subprocess.check_call(["git", "init", "-q", os.path.join(self.root, "local")])
+        if self.command == "init":
+            for path in self.paths:
+                os.mkdir(path)
+        elif self.command in ("check", "delete"):
+            template = os.path.join(self.root, "template.git")
+            subprocess.check_call(["git", "init", "-q", "--bare", template])
+            for path in self.paths:
+                shutil.copytree(template, path, symlinks=True)
+
+    def batch_line(self, idx):
+        if self.command == "setup":
+            return "setup remote%d %s" % (idx, self.urls[idx])
+        return "%s %s" % (self.command, self.urls[idx])
+
+    def invocations(self):
+        """
+        Returns the argument lists of the invocations of ygit making up this
+        scenario.
+        """
+        if self.mode == "loop":
+            args = []
+            for idx in range(self.num_repos):
+                args.append(self.batch_line(idx).split())
+            if self.command == "delete":
+                for invocation in args:
+                    invocation.append("--yes")
+            return args
+        if self.command == "check":
+            return [["check"] + self.urls]
+        if self.command == "delete":
+            return [["delete", "--yes"] + self.urls]
+        manifest = os.path.join(self.root, "manifest")
+        with open(manifest, "w") as stream:
+            for idx in range(self.num_repos):
+                stream.write(self.batch_line(idx) + "\n")
+        return [["batch", manifest]]
+
+    def verify(self):
+        """
+        Returns an error message if the repositories are not in the state
+        that the command should have left them in.
+        """
+        for path in self.paths:
+            exists = os.path.exists(os.path.join(path, "HEAD"))
+            if exists != (self.command != "delete"):
+                return "unexpected state of %s" % path
+        return None
+
+class Measurement(object):
+
+    def __init__(self, scenario):
+        self.command = scenario.command
+        self.mode = scenario.mode
+        self.num_repos = scenario.num_repos
+        self.wall_time = 0.0
+        self.invocations = 0
+        self.subprocesses = 0
+        self.handshakes = 0
+        self.round_trips = 0
+        self.error = None
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+def count_commands(trace_path):
+    """
+    Returns the number of subprocesses run by ygit, from its trace.
+    """
+    with open(trace_path) as stream:
+        events = json.load(stream)["traceEvents"]
+    return len([event for event in events
+        if event.get("cat") == "command" and event["args"].get("executed")])
+
+def run_scenario(scenario, ygit_args, env):
+    """
+    Runs `scenario`, returning a `Measurement`.
+    """
+    scenario.prepare()
+    measurement = Measurement(scenario)
+    log_path = os.path.join(scenario.root, "ssh.log")
+    trace_path = os.path.join(scenario.root, "trace.json")
+    env = dict(env)
+    env["YGIT_FAKE_SSH_LOG"] = log_path
+    for args in scenario.invocations():
+        argv = [sys.executable, YGIT] + args + ["-Q", "--trace", trace_path] + ygit_args
+        start = time.time()
+        retcode = subprocess.call(argv, cwd=os.path.join(scenario.root, "local"), env=env,
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        measurement.wall_time += time.time() - start
+        measurement.invocations += 1
+        if retcode and measurement.error is None:
+            measurement.error = "exit %d: %s" % (retcode, " ".join(args[:3]))
+        measurement.subprocesses += count_commands(trace_path)
+    if os.path.exists(log_path):
+        with open(log_path) as stream:
+            events = stream.read().split()
+        measurement.handshakes = events.count("handshake")
+        measurement.round_trips = events.count("command")
+    if measurement.error is None:
+        measurement.error = scenario.verify()
+    return measurement
+
+def main():
+    parser = OptionParser(usage="%prog [options] [-- YGIT-OPTIONS]", description=__doc__.strip())
+    parser.add_option("-n", "--num-repos",
+        default="1,10,100,1000",
+        help="comma-separated numbers of repositories to run each command against (default: %default)")
+    parser.add_option("-c", "--commands",
+        default=",".join(COMMANDS),
+        help="comma-separated commands to run (default: %default)")
+    parser.add_option("--handshake",
+        type="float",
+        default=0.05,
+        help="simulated time taken to open an ssh connection, in seconds (default: %default)")
+    parser.add_option("--latency",
+        type="float",
+        default=0.01,
+        help="simulated round-trip time of each remote command, in seconds (default: %default)")
+    parser.add_option("--loop-limit",
+        type="int",
+        default=10,
+        help="largest number of repositories to also run with one invocation of ygit for each (default: %default)")
+    parser.add_option("--json",
+        action="store_true",
+        default=False,
+        help="write one JSON object per measurement instead of a table")
+    opts, ygit_args = parser.parse_args()
+
+    commands = opts.commands.split(",")
+    for command in commands:
+        if command not in COMMANDS:
+            parser.error("unknown command '%s' (expecting one of: %s)" % (command, ", ".join(COMMANDS)))
+    work_dir = os.path.realpath(tempfile.mkdtemp(prefix="ygit-bench-"))
+    env = dict(os.environ)
+    env["YGIT_SSH"] = FAKE_SSH
+    env["YGIT_FAKE_SSH_HANDSHAKE"] = str(opts.handshake)
+    env["YGIT_FAKE_SSH_LATENCY"] = str(opts.latency)
+    # keep ygit's cache (and any user configuration) out of the measurements
+    env["HOME"] = work_dir
+    env["XDG_CACHE_HOME"] = os.path.join(work_dir, "cache")
+    env["GIT_CONFIG_NOSYSTEM"] = "1"
+    ygit_args = ["--no-cache"] + ygit_args
+
+    if not opts.json:
+        sys.stdout.write("Simulated ssh: %.0fms per connection, %.0fms per command\n"
+            % (opts.handshake * 1000, opts.latency * 1000))
+        sys.stdout.write("%-8s %-5s %6s %10s %10s %9s %11s %11s %11s\n" % ("command", "mode", "repos",
+            "wall (s)", "ms/repo", "ygit runs", "subprocs", "connections", "round trips"))
+    try:
+        run_idx = 0
+        for command in commands:
+            for num_repos in [int(n) for n in opts.num_repos.split(",")]:
+                modes = ["bulk"]
+                if num_repos <= opts.loop_limit:
+                    modes.append("loop")
+                for mode in modes:
+                    run_idx += 1
+                    scenario = Scenario(command, mode, num_repos, os.path.join(work_dir, "run%d" % run_idx))
+                    measurement = run_scenario(scenario, ygit_args, env)
+                    shutil.rmtree(scenario.root, ignore_errors=True)
+                    if opts.json:
+                        sys.stdout.write(json.dumps(measurement.as_dict(), sort_keys=True) + "\n")
+                    else:
+                        sys.stdout.write("%-8s %-5s %6d %10.2f %10.1f %9d %11d %11d %11d%s\n" % (
+                            command, mode, num_repos,
+                            measurement.wall_time,
+                            measurement.wall_time * 1000 / num_repos,
+                            measurement.invocations,
+                            measurement.subprocesses,
+                            measurement.handshakes,
+                            measurement.round_trips,
+                            "  FAILED (%s)" % measurement.error if measurement.error else ""))
+                    sys.stdout.flush()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#! /usr/bin/env python3
+
+############################################################################
+##  bench_url_parsing.py
+##
+##  Part of the YonderGit remote Git repository management utilities.
+##
+##  This program is free software; you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation; either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License along
+##  with this programm. If not, see <http://www.gnu.org/licenses/>.
+##
+############################################################################
+
+"""
+Microbenchmark of repository URL parsing: compares the current parser
+(without its cache, as a `RepositoryReference`, and in bulk through
+`RepositoryReference.parse_many()`) with the original one (which compiled
+its patterns on every call and tried them in turn), for every URL form given
+in `EXAMPLE_URLS`, verifying along the way that both give identical results.
+"""
+
+import os
+import re
+import sys
+import timeit
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "scripts"))
+import ygit
+
+FIELDS = ('url',) + ygit.RepositoryReference.url_fields
+
+class OriginalRepositoryReference(object):
+    """
+    The original implementation of `ygit.RepositoryReference` parsing.
+    """
+
+    def __init__(self, url=None):
+        self.url = None
+        self.protocol = None
+        self.user = None
+        self.host = None
+        self.port = None
+        self.repo_path = None
+        self.dir_name = None
+        self.repo_name = None
+        self.repo_basename = None
+        if url is not None:
+            self.parse_from_url(url)
+
+    def parse_repo_path(self, path):
+        sep = os.path.sep
+        if path.endswith(sep):
+            path = path[:-1]
+        self.dir_name = os.path.dirname(path)
+        self.repo_name = os.path.basename(path)
+        if not self.repo_name.endswith(".git"):
+            self.repo_name += ".git"
+        self.repo_basename = os.path.splitext(self.repo_name)[0]
+        self.repo_path = os.path.join(self.dir_name, self.repo_name)
+
+    def parse_from_url(self, url):
+        self.__init__()
+        self.url = url
+        p_file = re.compile('file://(.*)')
+        p_general = re.compile(r'(\w+://)(.+@)*([\w\d\.]+)(:[\d]+){0,1}/*(.*)')
+        p_unspec = re.compile(r'(.+@)*([\w\d\.]+):(.*)')
+        match = p_file.match(url)
+        if match:
+            self.protocol='file'
+            self.parse_repo_path(match.group(1))
+        else:
+            match = p_general.match(url)
+            if match:
+                self.protocol = match.group(1).split(":")[0]
+                if match.group(2):
+                    self.user = match.group(2)[:-1]
+                self.host = match.group(3)
+                if match.group(4):
+                    self.port = match.group(4)[1:]
+                if match.group(5):
+                    path = match.group(5)
+                    if not path.startswith("~"):
+                        path = "/" + path
+                    self.parse_repo_path(path)
+            else:
+                match = p_unspec.match(url)
+                if match:
+                    if match.group(1):
+                        self.user = match.group(1)[:-1]
+                    self.host = match.group(2)
+                    path = match.group(3)
+                    self.parse_repo_path(path)
+                    self.protocol='ssh'
+                else:
+                    # assume path
+                    self.protocol='file'
+                    self.parse_repo_path(url)
+
+def example_urls():
+    urls = []
+    for transport_urls in ygit.EXAMPLE_URLS.values():
+        urls.extend(transport_urls)
+    # a few more forms exercising the less-travelled branches of the parser
+    urls.extend([
+        'ssh://user@host.xz:2222/path/to/repo.git/',
+        'ssh://host.xz',
+        'ssh:///path/to/repo.git',
+        'git@github.com:user/repo',
+        'relative/path:with/colon',
+        'repo',
+    ])
+    return urls
+
+def fields(ref):
+    return tuple(getattr(ref, name) for name in FIELDS)
+
+def check_equivalence(urls):
+    for url in urls:
+        expected = fields(OriginalRepositoryReference(url))
+        found = fields(ygit.RepositoryReference(url))
+        if expected != found:
+            sys.stderr.write("Mismatch for '%s':\n    original: %s\n     current: %s\n" \
+                % (url, expected, found))
+            sys.exit(1)
+    found = [fields(ref) for ref in ygit.RepositoryReference.parse_many(urls)]
+    expected = [fields(OriginalRepositoryReference(url)) for url in urls]
+    if expected != found:
+        sys.stderr.write("Mismatch in results of 'parse_many()'\n")
+        sys.exit(1)
+
+def main():
+    parser = OptionParser(usage="%prog [options]",
+                          description=__doc__.strip())
+    parser.add_option('-n', '--repeat',
+        action='store',
+        type='int',
+        dest='repeat',
+        default=20000,
+        help='number of times to parse each URL (default: %default)')
+    (opts, args) = parser.parse_args()
+
+    urls = example_urls()
+    check_equivalence(urls)
+
+    sys.stdout.write("%-46s %12s %12s %12s %12s %9s\n" \
+        % ("URL", "original", "uncached", "current", "parse_many", "speed-up"))
+    total_original = total_uncached = total_current = total_many = 0.0
+    for url in urls:
+        original = timeit.timeit(lambda: OriginalRepositoryReference(url), number=opts.repeat)
+        uncached = timeit.timeit(lambda: ygit.parse_url_fields(url), number=opts.repeat)
+        current = timeit.timeit(lambda: ygit.RepositoryReference(url), number=opts.repeat)
+        batch = [url] * opts.repeat
+        many = timeit.timeit(lambda: ygit.RepositoryReference.parse_many(batch), number=1)
+        total_original += original
+        total_uncached += uncached
+        total_current += current
+        total_many += many
+        sys.stdout.write("%-46s %10.2fus %10.2fus %10.2fus %10.2fus %8.1fx\n" \
+            % (url,
+               original * 1e6 / opts.repeat,
+               uncached * 1e6 / opts.repeat,
+               current * 1e6 / opts.repeat,
+               many * 1e6 / opts.repeat,
+               original / current))
+    sys.stdout.write("%-46s %10.2fus %10.2fus %10.2fus %10.2fus %8.1fx\n" \
+        % ("(mean over all forms)",
+           total_original * 1e6 / (opts.repeat * len(urls)),
+           total_uncached * 1e6 / (opts.repeat * len(urls)),
+           total_current * 1e6 / (opts.repeat * len(urls)),
+           total_many * 1e6 / (opts.repeat * len(urls)),
+           total_original / total_current))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#! /usr/bin/env python3
+
+############################################################################
+##  fake_ssh.py
+##
+##  Part of the YonderGit remote Git repository management utilities.
+##
+##  This program is free software; you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation; either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License along
+##  with this programm. If not, see <http://www.gnu.org/licenses/>.
+##
+############################################################################
+
+"""
+Stand-in for "ssh" used by the benchmarks (see "ygit.py --ssh"): accepts
+the arguments that ygit gives ssh, but runs the remote command on the local
+host, after sleeping to simulate the latency of a real connection.
+
+Opening a connection (a master connection, or a command that is not
+routed through an open master) costs $YGIT_FAKE_SSH_HANDSHAKE seconds
+(default: 0.05), and each remote command a further $YGIT_FAKE_SSH_LATENCY
+seconds (default: 0.01). If $YGIT_FAKE_SSH_LOG names a file, a line is
+appended to it for each handshake ("handshake") and each remote command
+("command"), from which the benchmarks count round trips.
+
+Hosts listed (comma-separated, as "HOST" or "USER@HOST") in
+$YGIT_FAKE_SSH_UNREACHABLE refuse connections (ssh exits with 255), and
+those listed in $YGIT_FAKE_SSH_HANG never answer.
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+# options of ssh that take an argument
+OPTIONS_WITH_ARGS = "BbcDEeFIiJLlmOopQRSWw"
+
+def log_event(event):
+    path = os.environ.get("YGIT_FAKE_SSH_LOG")
+    if path:
+        with open(path, "a") as stream:
+            stream.write(event + "\n")
+
+def delay(name, default):
+    return float(os.environ.get(name, default))
+
+def parse_args(args):
+    """
+    Returns the ssh options (as a dictionary of "-o" settings, plus the
+    control operation given by "-O", if any), the flags given, the
+    destination, and the remote command (a list of words, possibly empty).
+    """
+    settings = {}
+    flags = set()
+    idx = 0
+    while idx < len(args) and args[idx].startswith("-"):
+        arg = args[idx]
+        idx += 1
+        for pos, flag in enumerate(arg[1:]):
+            if flag in OPTIONS_WITH_ARGS:
+                value = arg[pos + 2:]
+                if not value:
+                    value = args[idx]
+                    idx += 1
+                if flag == "o":
+                    key, value = value.split("=", 1)
+                    settings[key.lower()] = value
+                else:
+                    settings["-" + flag] = value
+                break
+            flags.add(flag)
+    return settings, flags, args[idx], args[idx + 1:]
+
+def listed(name, destination):
+    hosts = [host for host in os.environ.get(name, "").split(",") if host]
+    return destination in hosts or destination.split("@")[-1] in hosts
+
+def main():
+    settings, flags, destination, command = parse_args(sys.argv[1:])
+    control_path = settings.get("controlpath")
+    operation = settings.get("-O")
+    if listed("YGIT_FAKE_SSH_HANG", destination):
+        time.sleep(3600)
+    if listed("YGIT_FAKE_SSH_UNREACHABLE", destination) and operation is None:
+        time.sleep(delay("YGIT_FAKE_SSH_HANDSHAKE", 0.05))
+        sys.stderr.write("ssh: connect to host %s port 22: Connection refused\n" % destination.split("@")[-1])
+        return 255
+    if operation == "exit":
+        if control_path and os.path.exists(control_path):
+            os.remove(control_path)
+        return 0
+    if operation == "check":
+        return 0 if control_path and os.path.exists(control_path) else 255
+    if "M" in flags or settings.get("controlmaster") == "yes":
+        time.sleep(delay("YGIT_FAKE_SSH_HANDSHAKE", 0.05))
+        log_event("handshake")
+        open(control_path, "w").close()
+        return 0
+    if not (control_path and os.path.exists(control_path)):
+        time.sleep(delay("YGIT_FAKE_SSH_HANDSHAKE", 0.05))
+        log_event("handshake")
+    if not command:
+        return 0
+    time.sleep(delay("YGIT_FAKE_SSH_LATENCY", 0.01))
+    log_event("command")
+    # as ssh does, the words of the command are joined into a single command
+    # line for the remote shell
+    return subprocess.call(["sh", "-c", " ".join(command)])
+
+if __name__ == '__main__':
+    sys.exit(main())
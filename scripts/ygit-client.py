@@ -0,0 +1,106 @@
+#! /usr/bin/env python3
+
+############################################################################
+##  ygit-client.py
+##
+##  Part of the YonderGit remote Git repository management utilities.
+##
+##  This program is free software; you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation; either version 3 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License along
+##  with this programm. If not, see <http://www.gnu.org/licenses/>.
+##
+############################################################################
+
+"""
+Forwards a ygit command (given exactly as to "ygit.py") to the server
+started by "ygit.py serve", and writes out its output as it arrives,
+exiting with its exit code. If no server is listening, or if the command
+is not one that the server carries out, "ygit.py" is run instead. The
+socket is given by "--socket", or the YGIT_SOCKET environment variable.
+
+This script is kept small, and independent of "ygit.py", so that it starts
+quickly.
+"""
+
+import os
+import sys
+import json
+import socket
+import stat
+import tempfile
+
+def default_socket_path():
+    """
+    Returns the default path of the socket of the server (as given by the
+    function of the same name in "ygit.py"), or None if it is in a directory
+    under the temporary directory that is not private to the user (as the
+    server would have refused to listen there, anyone listening there is
+    not to be trusted).
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "ygit.sock")
+    directory = os.path.join(tempfile.gettempdir(), "ygit-%d" % os.getuid())
+    try:
+        st = os.lstat(directory)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) & 0o077:
+        return None
+    return os.path.join(directory, "ygit.sock")
+
+def socket_path(args):
+    for idx, arg in enumerate(args):
+        if arg == "--socket" and idx + 1 < len(args):
+            return args[idx + 1]
+        if arg.startswith("--socket="):
+            return arg.split("=", 1)[1]
+    return os.environ.get("YGIT_SOCKET") or default_socket_path()
+
+def run_ygit(args):
+    """
+    Replaces this process with "ygit.py", run with `args`.
+    """
+    ygit = os.path.join(os.path.dirname(os.path.realpath(__file__)), "ygit.py")
+    os.execv(sys.executable, [sys.executable, ygit] + args)
+
+def main():
+    args = sys.argv[1:]
+    path = socket_path(args)
+    if path is None:
+        run_ygit(args)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except OSError:
+        client.close()
+        run_ygit(args)
+    request = {"argv": args, "cwd": os.getcwd()}
+    client.sendall(json.dumps(request).encode("utf-8") + b"\n")
+    for line in client.makefile("rb"):
+        reply = json.loads(line.decode("utf-8"))
+        if "out" in reply:
+            sys.stdout.write(reply["out"])
+            sys.stdout.flush()
+        elif "err" in reply:
+            sys.stderr.write(reply["err"])
+            sys.stderr.flush()
+        elif reply.get("fallback"):
+            client.close()
+            run_ygit(args)
+        elif "exit" in reply:
+            return reply["exit"]
+    sys.stderr.write("Connection to the ygit server lost.\n")
+    return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
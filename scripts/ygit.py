@@ -1,4 +1,4 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 
 ############################################################################
 ##  ygit.py
@@ -30,7 +30,28 @@ import getpass
 from optparse import OptionGroup
 from optparse import OptionParser
 import re
+import posixpath
 import subprocess
+import atexit
+import tempfile
+import shutil
+import errno
+import stat
+import shlex
+import signal
+import socket
+import copy
+import time
+import random
+import asyncio
+import contextlib
+import contextvars
+import cProfile
+import pstats
+import functools
+import json
+import hashlib
+from io import StringIO
 
 ############################################################################
 ## Program identification
@@ -43,6 +64,16 @@ help on commands, and 'ygit.py help urls' for help on repository URL syntax."""
 _prog_author = 'Jeet Sukumaran'
 _prog_copyright = 'Copyright (C) 2009 Jeet Sukumaran.'
 
+############################################################################
+## Errors
+
+class YonderGitError(Exception):
+    """
+    Raised when an operation on a repository fails. The message is reported
+    to the user as-is.
+    """
+    pass
+
 ############################################################################
 ## Parsing Git repository URL's
 
@@ -88,84 +119,287 @@ EXAMPLE_URLS = {
 
 }
 
+_URL_FILE_PATTERN = re.compile(r'file://(.*)')
+_URL_GENERAL_PATTERN = re.compile(r'(\w+://)(.+@)*([\w\d\.]+)(:[\d]+){0,1}/*(.*)')
+_URL_UNSPEC_PATTERN = re.compile(r'(.+@)*([\w\d\.]+):(.*)')
+
+def split_repo_path(path):
+    """
+    Given a file or directory path, returns a tuple of the repository path,
+    the directory path component, the repository (directory) name component
+    (which always ends with ".git"), and the repository name without the
+    ".git" extension.
+    """
+    sep = os.path.sep
+    if path.endswith(sep):
+        path = path[:-1]
+    dir_name = os.path.dirname(path)
+    repo_name = os.path.basename(path)
+    if not repo_name.endswith(".git"):
+        repo_name += ".git"
+    repo_basename = os.path.splitext(repo_name)[0]
+    repo_path = os.path.join(dir_name, repo_name)
+    return repo_path, dir_name, repo_name, repo_basename
+
+def parse_url_fields(url):
+    """
+    Parses a repository URL specification, returning a tuple of the values
+    of the fields of `RepositoryReference` named in
+    `RepositoryReference.url_fields`.
+
+    The URL forms are tried in the order: "file://" URL, "scheme://" URL,
+    scp-like "[user@]host:path" specification, and finally plain path. As
+    each of the first three requires a ":", anything without one is a plain
+    path, and only URLs containing "://" need be tried against the general
+    "scheme://" form.
+    """
+    protocol = user = host = port = None
+    path_fields = (None, None, None, None)
+    if ":" not in url:
+        return ('file', None, None, None) + split_repo_path(url)
+    if url.startswith("file://"):
+        match = _URL_FILE_PATTERN.match(url)
+        return ('file', None, None, None) + split_repo_path(match.group(1))
+    match = None
+    if "://" in url:
+        match = _URL_GENERAL_PATTERN.match(url)
+    if match:
+        protocol = match.group(1).split(":")[0]
+        if match.group(2):
+            user = match.group(2)[:-1]
+        host = match.group(3)
+        if match.group(4):
+            port = match.group(4)[1:]
+        if match.group(5):
+            path = match.group(5)
+            if not path.startswith("~"):
+                path = "/" + path
+            path_fields = split_repo_path(path)
+        return (protocol, user, host, port) + path_fields
+    match = _URL_UNSPEC_PATTERN.match(url)
+    if match:
+        if match.group(1):
+            user = match.group(1)[:-1]
+        host = match.group(2)
+        return ('ssh', user, host, None) + split_repo_path(match.group(3))
+    # assume path
+    return ('file', None, None, None) + split_repo_path(url)
+
+DEFAULT_PORTS = {
+    'ssh': '22',
+    'rsync': '873',
+    'git': '9418',
+    'http': '80',
+    'https': '443',
+}
+
+def canonical_key(values):
+    """
+    Given the values of the fields named in `RepositoryReference.url_fields`,
+    returns a tuple identifying the repository independently of how its URL
+    was spelled: the host name is folded to lower case, the default port of
+    the protocol is made explicit, and the path is normalized, with paths
+    relative to the home directory on remote hosts made explicitly so.
+    """
+    protocol, user, host, port, path = values[:5]
+    if host is not None:
+        host = host.lower()
+    if port is None:
+        port = DEFAULT_PORTS.get(protocol)
+    if path is not None:
+        if protocol != 'file' and not path.startswith("/") and not path.startswith("~"):
+            path = "~/" + path
+        if "//" in path or "/." in path or path.startswith("."):
+            path = posixpath.normpath(path)
+    return (protocol, user, host, port, path)
+
+def _build_url_record(url):
+    """
+    Returns the field values (with the strings that tend to be common to
+    many references, such as host names, interned so that they are shared),
+    the default `ssh_command` and the hash of the canonical key of a
+    `RepositoryReference` for `url`.
+    """
+    protocol, user, host, port, repo_path, dir_name, repo_name, repo_basename \
+        = parse_url_fields(url)
+    values = (_intern(protocol),
+              _intern(user),
+              _intern(host),
+              _intern(port),
+              repo_path,
+              _intern(dir_name),
+              repo_name,
+              repo_basename)
+    return values, None, hash(canonical_key(values))
+
+# as the same URLs tend to be parsed over and over again, parsing results
+# are cached
+_parse_url_record = functools.lru_cache(maxsize=65536)(_build_url_record)
+
+def _intern(value):
+    if value is None:
+        return None
+    return sys.intern(value)
+
 class RepositoryReference(object):
     """
     Wraps parsing of Git repository URL specifications.
+
+    References are immutable (use `replace()` to derive a modified copy) and
+    compare equal, and hash alike, if they refer to the same repository,
+    however their URLs are spelled: e.g., "ssh://user@host.xz:22/srv/repo"
+    and "user@host.xz:/srv/repo.git/" are the same repository, as are
+    "host.xz:repo.git" and "ssh://host.xz/~/repo.git". Instances use
+    `__slots__`, so large inventories of references are compact.
     """
 
+    url_fields = ('protocol',
+                  'user',
+                  'host',
+                  'port',
+                  'repo_path',
+                  'dir_name',
+                  'repo_name',
+                  'repo_basename')
+
+    __slots__ = ('url',) + url_fields + ('ssh_command', '_hash')
+
     def __init__(self, url=None):
         """
-        Initializes variables to default values.
+        Parses `url` (see `parse_url_fields`); all fields are None if no URL
+        is given.
         """
-        self.url = None
-        self.protocol = None
-        self.user = None
-        self.host = None
-        self.port = None
-        self.repo_path = None
-        self.dir_name = None
-        self.repo_name = None
-        self.repo_basename = None
-        if url is not None:
-            self.parse_from_url(url)
-
-    def parse_repo_path(self, path):
-        """
-        Given a file or directory path, stores it as-is in
-        self.repo_path, but then also tries to parse out the directory
-        path component and the repository (directory) name component.
-        """
-        sep = os.path.sep
-        if path.endswith(sep):
-            path = path[:-1]
-        self.dir_name = os.path.dirname(path)
-        self.repo_name = os.path.basename(path)
-        if not self.repo_name.endswith(".git"):
-            self.repo_name += ".git"
-        self.repo_basename = os.path.splitext(self.repo_name)[0]
-        self.repo_path = os.path.join(self.dir_name, self.repo_name)
-
-    def parse_from_url(self, url):
-        """
-        Does the bulk of the work of parsing out components of a repostiory URL
-        specification.
-        """
-        self.__init__()
-        self.url = url
-        p_file = re.compile('file://(.*)')
-        p_general = re.compile('(\w+://)(.+@)*([\w\d\.]+)(:[\d]+){0,1}/*(.*)')
-        p_unspec = re.compile('(.+@)*([\w\d\.]+):(.*)')
-        match = p_file.match(url)
-        if match:
-            self.protocol='file'
-            self.parse_repo_path(match.group(1))
+        if url is None:
+            self._set_fields(url, (None,) * len(self.url_fields), None)
         else:
-            match = p_general.match(url)
-            if match:
-                self.protocol = match.group(1).split(":")[0]
-                if match.group(2):
-                    self.user = match.group(2)[:-1]
-                self.host = match.group(3)
-                if match.group(4):
-                    self.port = match.group(4)[1:]
-                if match.group(5):
-                    path = match.group(5)
-                    if not path.startswith("~"):
-                        path = "/" + path
-                    self.parse_repo_path(path)
-            else:
-                match = p_unspec.match(url)
-                if match:
-                    if match.group(1):
-                        self.user = match.group(1)[:-1]
-                    self.host = match.group(2)
-                    path = match.group(3)
-                    self.parse_repo_path(path)
-                    self.protocol='ssh'
-                else:
-                    # assume path
-                    self.protocol='file'
-                    self.parse_repo_path(url)
+            self._set_fields(url, *_parse_url_record(url))
+
+    def _set_fields(self, url, values, ssh_command, key_hash=None):
+        if key_hash is None:
+            key_hash = hash(canonical_key(values))
+        for set_slot, value in zip(_slot_setters, (url,) + tuple(values) + (ssh_command, key_hash)):
+            set_slot(self, value)
+
+    @classmethod
+    def from_fields(cls, url, values, ssh_command=None):
+        """
+        Returns a reference with the given `url`, values of the fields named
+        in `url_fields`, and `ssh_command`, without parsing anything.
+        """
+        ref = cls.__new__(cls)
+        ref._set_fields(url, values, ssh_command)
+        return ref
+
+    @classmethod
+    def parse_many(cls, urls):
+        """
+        Returns a list of `RepositoryReference` objects parsed from each of
+        the URLs in `urls`. As references are immutable, a URL that is
+        repeated in `urls` yields the same object each time. The URL parsing
+        cache is bypassed, so that parsing a large inventory neither evicts
+        nor duplicates its contents.
+        """
+        parsed = {}
+        refs = []
+        for url in urls:
+            ref = parsed.get(url)
+            if ref is None:
+                ref = cls.__new__(cls)
+                ref._set_fields(url, *_build_url_record(url))
+                parsed[url] = ref
+            refs.append(ref)
+        return refs
+
+    def replace(self, **kwargs):
+        """
+        Returns a copy of this reference, with the fields given as keyword
+        arguments replaced. Replacing `repo_path` also replaces the
+        `dir_name`, `repo_name` and `repo_basename` fields derived from it.
+        """
+        fields = dict(zip(self.url_fields, self.values()))
+        if 'repo_path' in kwargs and kwargs['repo_path'] is not None:
+            fields['repo_path'], fields['dir_name'], fields['repo_name'], fields['repo_basename'] \
+                = split_repo_path(kwargs.pop('repo_path'))
+        url = kwargs.pop('url', self.url)
+        ssh_command = kwargs.pop('ssh_command', self.ssh_command)
+        for name, value in kwargs.items():
+            if name not in fields:
+                raise TypeError("'%s' is not a field of %s" % (name, self.__class__.__name__))
+            fields[name] = value
+        return self.from_fields(url, [fields[name] for name in self.url_fields], ssh_command)
+
+    def values(self):
+        """
+        Returns a tuple of the values of the fields named in `url_fields`.
+        """
+        return tuple(getattr(self, name) for name in self.url_fields)
+
+    def canonical_key(self):
+        """
+        Returns a tuple identifying the repository independently of how its
+        URL was spelled (see `canonical_key`).
+        """
+        return canonical_key(self.values())
+
+    def host_key(self):
+        """
+        Returns a tuple identifying the host holding the repository: (user,
+        host, port), in canonical form, for remote repositories, or
+        ('localhost',) for local ones.
+        """
+        if self.protocol == 'file':
+            return ('localhost',)
+        host = self.host
+        if host is not None:
+            host = host.lower()
+        return (self.user, host, self.port or DEFAULT_PORTS.get(self.protocol))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    def __eq__(self, other):
+        if not isinstance(other, RepositoryReference):
+            return NotImplemented
+        return self._hash == other._hash and self.canonical_key() == other.canonical_key()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        return (self.__class__.from_fields, (self.url, self.values(), self.ssh_command))
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.url)
+
+# setting slots through their descriptors bypasses `__setattr__`
+_slot_setters = tuple([getattr(RepositoryReference, name).__set__
+                       for name in RepositoryReference.__slots__])
+
+def group_by_host(repo_refs):
+    """
+    Returns a dictionary mapping the `host_key()` of each of the distinct
+    repositories referenced by `repo_refs` to a list of the references on
+    that host, in the order first seen. Duplicate references (including
+    references to the same repository through differently spelled URLs) are
+    dropped.
+    """
+    seen = set()
+    groups = {}
+    for repo_ref in repo_refs:
+        if repo_ref in seen:
+            continue
+        seen.add(repo_ref)
+        groups.setdefault(repo_ref.host_key(), []).append(repo_ref)
+    return groups
 
 ############################################################################
 ## Talking to the user
@@ -181,7 +415,9 @@ class Messenger(object):
                  all_quiet=False,
                  show_commands=False,
                  show_debug=False,
-                 dry_run=False):
+                 dry_run=False,
+                 stdout=None,
+                 stderr=None):
         self.ygit_quiet = ygit_quiet
         self.git_verbose = git_verbose
         self.all_quiet = all_quiet
@@ -191,6 +427,12 @@ class Messenger(object):
         self.show_commands = show_commands
         self.show_debug = show_debug
         self.dry_run = dry_run
+        if stdout is None:
+            stdout = sys.stdout
+        if stderr is None:
+            stderr = sys.stderr
+        self.stdout = stdout
+        self.stderr = stderr
 
     def newline_suffix(self, newline):
         if newline:
@@ -200,18 +442,18 @@ class Messenger(object):
         return suffix
 
     def critical(self, msg, newline=True):
-        sys.stdout.write(msg + self.newline_suffix(newline))
+        self.stdout.write(msg + self.newline_suffix(newline))
 
     def debug(self, msg, newline=True):
         if self.show_debug:
-            sys.stdout.write(msg + self.newline_suffix(newline))
+            self.stdout.write(msg + self.newline_suffix(newline))
 
     def ygit_info(self, msg, newline=True):
         if not self.ygit_quiet:
-            sys.stdout.write(msg + self.newline_suffix(newline))
+            self.stdout.write(msg + self.newline_suffix(newline))
 
     def info(self, msg, newline=True):
-        sys.stdout.write(msg + self.newline_suffix(newline))
+        self.stdout.write(msg + self.newline_suffix(newline))
 
     def ygit_command(self, msg, newline=True):
         if self.show_commands or self.show_debug:
@@ -219,305 +461,5102 @@ class Messenger(object):
                 prefix = "   DUMMY RUN: "
             else:
                 prefix = "   EXECUTING: "
-            sys.stdout.write("%s%s%s" % (prefix, msg, self.newline_suffix(newline)))
+            self.stdout.write("%s%s%s" % (prefix, msg, self.newline_suffix(newline)))
 
     def error(self, msg, newline=True):
-        sys.stderr.write(msg + self.newline_suffix(newline))
+        self.stderr.write(msg + self.newline_suffix(newline))
 
     def compose_repo_ref(self, repo_ref):
         return repo_ref.url
 
 
 ############################################################################
-## Core remote handlers
+## Tracing
+
+class Tracer(object):
+    """
+    Records a span (a named interval of time, with arguments such as the
+    command run, the host and the exit code) for every operation, command
+    and remote script phase of a run, and writes them out in the Chrome
+    trace event format, for viewing in a trace viewer (e.g.,
+    "chrome://tracing" or Perfetto). Spans are laid out in lanes (shown as
+    threads): each operation on a repository gets a lane of its own, in
+    which the spans of its commands and phases nest.
+
+    Nothing is recorded unless `enabled` is True.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.origin = time.time()
+        self.events = []
+        self.num_lanes = 1
+        self.current_lane = contextvars.ContextVar("ygit_trace_lane", default=0)
+
+    def enable(self):
+        self.enabled = True
+        self.origin = time.time()
+        self.events.append(self.lane_name_event(0, "main"))
+
+    def lane_name_event(self, lane, name):
+        return {"name": "thread_name", "ph": "M", "pid": 1, "tid": lane, "args": {"name": name}}
+
+    def lane(self, name):
+        """
+        Starts a new lane, named `name`, for the spans of the current task
+        (and of the tasks it starts).
+        """
+        if not self.enabled:
+            return
+        lane = self.num_lanes
+        self.num_lanes += 1
+        self.events.append(self.lane_name_event(lane, name))
+        self.current_lane.set(lane)
+
+    def add(self, name, category, start, end, **args):
+        """
+        Records the span `name` from `start` to `end` (times as given by
+        `time.time()`) in the current lane.
+        """
+        if not self.enabled:
+            return
+        self.events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "pid": 1,
+            "tid": self.current_lane.get(),
+            "ts": round((start - self.origin) * 1e6, 1),
+            "dur": round(max(end - start, 0) * 1e6, 1),
+            "args": dict((key, value) for key, value in args.items() if value is not None),
+        })
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        """
+        Context manager recording a span covering its body.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, time.time(), **args)
+
+    def write(self, path):
+        """
+        Writes the spans recorded so far to the file at `path`.
+        """
+        with open(path, "w") as stream:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, stream)
 
-def remote_exists(repo_ref, messenger):
+# all spans of a run are recorded by this tracer
+tracer = Tracer()
+
+def command_span_name(argv):
     """
-    Checks if the directory at repo_ref exists. Returns True if it does, False
-    otherwise.
+    Returns a short name for the command `argv`, for trace spans.
     """
-    #messenger.ygit_info("Checking if repository path exists: %s" % messenger.compose_repo_ref(repo_ref))
-    if repo_ref.protocol == 'ssh':
-        command = repo_ref.ssh_command + " 'if test -e %s; then echo 1; fi\'" % repo_ref.repo_path
-        messenger.ygit_command(command)
-        check = subprocess.Popen([command], shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        check_stdout, check_stderr = check.communicate()
-        if check_stderr:
-            messenger.error(check_stderr, newline=False)
-            error = True
+    program = os.path.basename(argv[0])
+    if "ssh" in program:
+        if "-O" in argv:
+            return "ssh -O %s" % argv[argv.index("-O") + 1]
+        if "-N" in argv:
+            return "ssh master"
+        if argv[-1].endswith(shell_quote(AGENT_SCRIPT)):
+            return "ssh agent"
+        return "ssh %s" % " ".join(argv[-1].split()[:2])
+    args = list(argv[1:])
+    if program == "git" and args[:1] == ["-C"]:
+        args = args[2:]
+    if args and not args[0].startswith("-"):
+        return "%s %s" % (program, args[0])
+    return program
+
+############################################################################
+## Process execution
+
+_event_loop = None
+
+def event_loop():
+    """
+    Returns the event loop on which all the asynchronous operations of a
+    run are carried out.
+    """
+    global _event_loop
+    if _event_loop is None or _event_loop.is_closed():
+        _event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_event_loop)
+    return _event_loop
+
+def run_sync(coro):
+    """
+    Runs the coroutine `coro` to completion on the event loop, and returns
+    its result.
+    """
+    return event_loop().run_until_complete(coro)
+
+def decode_output(data):
+    if data is None:
+        return ""
+    return data.decode("utf-8", "replace")
+
+def shell_quote(text):
+    """
+    Quotes `text` for use as a single word in a POSIX shell command.
+    """
+    if text and re.match(r'^[\w@%+=:,./-]+$', text):
+        return text
+    return "'" + text.replace("'", "'\"'\"'") + "'"
+
+def format_argv(argv):
+    """
+    Returns `argv` as it would be typed at a POSIX shell, for display.
+    """
+    return " ".join(shell_quote(arg) for arg in argv)
+
+class CommandRecord(object):
+    """
+    Timing and outcome of a single command run by a `CommandRunner`. `start`
+    and `end` are wall-clock times; `stdout_bytes` and `stderr_bytes` are
+    None if the output of the command was not captured, and `executed` is
+    False if the command was skipped on a dry run.
+    """
+
+    __slots__ = ('argv', 'label', 'start', 'end', 'returncode',
+                 'input_bytes', 'stdout_bytes', 'stderr_bytes', 'executed',
+                 'timed_out')
+
+    def __init__(self, argv, label=None):
+        self.argv = tuple(argv)
+        self.label = label
+        self.start = time.time()
+        self.end = None
+        self.returncode = None
+        self.input_bytes = 0
+        self.stdout_bytes = None
+        self.stderr_bytes = None
+        self.executed = False
+        self.timed_out = False
+
+    @property
+    def duration(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def describe(self):
+        if not self.executed:
+            return "skipped (dry run)"
+        if self.returncode is None:
+            return "started in the background"
+        if self.timed_out:
+            return "timed out after %.3fs" % self.duration
+        parts = ["exit %s in %.3fs" % (self.returncode, self.duration)]
+        if self.stdout_bytes is not None:
+            parts.append("%d bytes out, %d bytes err" % (self.stdout_bytes, self.stderr_bytes))
+        return ", ".join(parts)
+
+# exit code reported for a command that was killed for taking too long (as
+# by timeout(1))
+TIMED_OUT = 124
+
+class CommandRunner(object):
+    """
+    Runs every external command issued by ygit. Commands are given as
+    argument lists and executed directly, without an intervening shell, so
+    no argument is ever subject to word splitting or expansion on the local
+    host. This is the single place where "--show" (displaying commands) and
+    "--dry-run" (not running commands that modify anything) are honored, and
+    a `CommandRecord` is kept (and a span traced) for every command.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def begin(self, argv, messenger, read_only, label, details, display=None):
+        record = CommandRecord(argv, label=label)
+        self.records.append(record)
+        messenger.ygit_command(display or format_argv(argv))
+        for line in details or ():
+            messenger.ygit_command("    %s" % line)
+        return read_only or not messenger.dry_run, record
+
+    def finish(self, record, messenger, returncode, stdout_bytes=None, stderr_bytes=None):
+        record.end = time.time()
+        record.returncode = returncode
+        record.stdout_bytes = stdout_bytes
+        record.stderr_bytes = stderr_bytes
+        messenger.debug("    FINISHED: %s" % record.describe())
+        tracer.add(command_span_name(record.argv), "command", record.start, record.end,
+                command=format_argv(record.argv),
+                host=record.label,
+                exit=returncode,
+                executed=record.executed,
+                stdout_bytes=stdout_bytes,
+                stderr_bytes=stderr_bytes)
+
+    @contextlib.contextmanager
+    def step(self, description, messenger, label=None):
+        """
+        Context manager for an operation carried out in-process instead of
+        by running a command: `description` (the equivalent shell command)
+        is shown as the command would have been, and the body is traced.
+        """
+        messenger.ygit_command(description)
+        with tracer.span(description.split(None, 1)[0], "in-process", command=description, host=label):
+            yield
+
+    async def run(self, argv, messenger, input=None, capture=True,
+            read_only=False, label=None, details=None, on_line=None,
+            timeout=None, env=None, input_path=None, display=None, interactive=False,
+            idle_timeout=None):
+        """
+        Runs the command `argv`, feeding it `input` (a string) on standard
+        input if given, and returns a tuple of its exit code, standard output
+        and standard error. If `capture` is False, the output of the command
+        is passed through instead of being collected. Unless `read_only` is
+        True, the command is not run on a dry run, and is taken to have
+        succeeded without output. `label` (e.g., the host the command acts
+        on) is recorded along with the command, and `details` are extra lines
+        shown under the command by "--show". If `on_line` is given, it is
+        called with each line of standard output (without the line ending)
+        as soon as it is read, and the standard output returned is empty.
+        A command still running after `timeout` seconds is killed, along with
+        any processes it started, and reported as exiting with `TIMED_OUT`
+        (if `interactive` is True, the command is instead left attached to
+        the terminal, e.g., for ssh to ask for a password, and only the
+        command itself is killed). With `on_line`, a command whose standard
+        output has been silent for `idle_timeout` seconds is killed likewise.
+        `env` gives environment variables to set for the command. If
+        `input_path` is given, the command reads the file at `input_path` on
+        its standard input instead of `input`. `display` is shown instead of
+        the command itself by "--show" (e.g., if it includes a whole script).
+        """
+        should_run, record = self.begin(argv, messenger, read_only, label, details, display)
+        if not should_run:
+            self.finish(record, messenger, 0)
+            return 0, "", ""
+        record.executed = True
+        if capture:
+            output = asyncio.subprocess.PIPE
         else:
-            error = False
-        if check_stdout:
-            exists = True
+            output = None
+        if env is not None:
+            env = dict(os.environ, **env)
+        try:
+            if input_path is not None:
+                stdin = open(input_path, "rb")
+                record.input_bytes = os.fstat(stdin.fileno()).st_size
+            elif input is None:
+                stdin = asyncio.subprocess.DEVNULL
+            else:
+                stdin = asyncio.subprocess.PIPE
+                input = input.encode("utf-8")
+                record.input_bytes = len(input)
+            try:
+                proc = await asyncio.create_subprocess_exec(*argv,
+                        stdin=stdin,
+                        stdout=output,
+                        stderr=output,
+                        env=env,
+                        start_new_session=(timeout is not None or idle_timeout is not None) \
+                                and not interactive)
+            finally:
+                if input_path is not None:
+                    stdin.close()
+        except OSError as e:
+            err = "%s: %s\n" % (e.filename or argv[0], e.strerror)
+            self.finish(record, messenger, 127, 0, len(err))
+            return 127, "", err
+        try:
+            if on_line is not None and capture:
+                stdout_bytes, stderr = await asyncio.wait_for(self.stream(proc, input, on_line, idle_timeout),
+                        timeout)
+                stdout = b""
+            else:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(input), timeout)
+                stdout_bytes = len(stdout) if stdout is not None else None
+        except asyncio.TimeoutError:
+            try:
+                if interactive:
+                    proc.kill()
+                else:
+                    os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            await proc.wait()
+            record.timed_out = True
+            if timeout is not None and time.time() - record.start >= timeout:
+                err = "%s: timed out after %gs\n" % (argv[0], timeout)
+            else:
+                err = "%s: timed out after %gs without output\n" % (argv[0], idle_timeout)
+            self.finish(record, messenger, TIMED_OUT, 0, len(err))
+            return TIMED_OUT, "", err
+        if capture:
+            self.finish(record, messenger, proc.returncode, stdout_bytes, len(stderr))
         else:
-            exists = False
-    elif repo_ref.protocol == 'file':
-        exists = os.path.exists(repo_ref.repo_path)
-        error = False
-    return exists, error
+            self.finish(record, messenger, proc.returncode)
+        return proc.returncode, decode_output(stdout), decode_output(stderr)
 
-def check_remote(repo_ref, messenger, opts):
+    async def stream(self, proc, input, on_line, idle_timeout=None):
+        """
+        Feeds `input` to `proc` while passing each line of its standard
+        output to `on_line` as it is read. Returns a tuple of the number of
+        bytes of standard output and the standard error of `proc`. Raises
+        `asyncio.TimeoutError` if no line is read for `idle_timeout`
+        seconds.
+        """
+        async def feed():
+            if input is not None:
+                try:
+                    proc.stdin.write(input)
+                    await proc.stdin.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                proc.stdin.close()
+        async def read_lines():
+            count = 0
+            while True:
+                line = await asyncio.wait_for(proc.stdout.readline(), idle_timeout)
+                if not line:
+                    return count
+                count += len(line)
+                on_line(decode_output(line).rstrip("\n"))
+        results = await asyncio.gather(feed(), read_lines(), proc.stderr.read())
+        await proc.wait()
+        return results[1], results[2]
+
+    async def start(self, argv, messenger, label=None, display=None):
+        """
+        Starts the command `argv`, which must not modify anything (it is
+        started on a dry run too), with pipes to its standard input, output
+        and error, for the caller to talk to it. Returns a tuple of the
+        process (an `asyncio.subprocess.Process`, or None if it could not be
+        started) and its `CommandRecord`, which the caller completes (with
+        `finish`) once the process has exited.
+        """
+        should_run, record = self.begin(argv, messenger, True, label, None, display)
+        record.executed = True
+        try:
+            proc = await asyncio.create_subprocess_exec(*argv,
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE)
+        except OSError as e:
+            err = "%s: %s\n" % (e.filename or argv[0], e.strerror)
+            self.finish(record, messenger, 127, 0, len(err))
+            messenger.debug(err.rstrip())
+            return None, record
+        return proc, record
+
+    def call(self, argv, messenger, read_only=False, label=None):
+        """
+        Runs the command `argv` to completion without going through the
+        event loop (e.g., when shutting down), discarding its output. Returns
+        its exit code.
+        """
+        should_run, record = self.begin(argv, messenger, read_only, label, None)
+        if not should_run:
+            self.finish(record, messenger, 0)
+            return 0
+        record.executed = True
+        try:
+            returncode = subprocess.call(argv,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL)
+        except OSError:
+            returncode = 127
+        self.finish(record, messenger, returncode)
+        return returncode
+
+    def spawn(self, argv, messenger, label=None):
+        """
+        Starts the command `argv` in the background, detached from ygit (so
+        that it carries on after ygit exits), without any input or output.
+        Returns True if the command was started (it is not on a dry run).
+        """
+        should_run, record = self.begin(argv, messenger, False, label, None)
+        if not should_run:
+            self.finish(record, messenger, 0)
+            return False
+        record.executed = True
+        try:
+            subprocess.Popen(argv,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    start_new_session=True)
+        except OSError:
+            self.finish(record, messenger, 127)
+            return False
+        self.finish(record, messenger, None)
+        return True
+
+    def clear(self):
+        """
+        Forgets the commands run so far.
+        """
+        self.records = []
+
+    def report(self, messenger):
+        """
+        Summarizes the commands run so far as debugging output.
+        """
+        executed = [record for record in self.records if record.executed and record.end is not None]
+        if not executed:
+            return
+        total = sum(record.duration for record in executed)
+        slowest = max(executed, key=lambda record: record.duration)
+        messenger.debug("%d command(s) run, %.3fs in total; slowest: %.3fs: %s" \
+            % (len(executed), total, slowest.duration, format_argv(slowest.argv)))
+
+# all commands of a run go through this runner
+command_runner = CommandRunner()
+
+_local_config_lock = None
+
+def local_config_lock():
     """
-    Inspect remote.
+    Returns the lock serializing changes to the refs of the local repository
+    (its configuration is written by `LocalConfig`).
     """
-    messenger.ygit_info("Checking: %s" % messenger.compose_repo_ref(repo_ref))
-    exists, error = remote_exists(repo_ref=repo_ref, messenger=messenger)
-    if error:
-        messenger.error("Error connnecting to: %s" % messenger.compose_repo_ref(repo_ref))
-        sys.exit(1)
-    if exists:
-        messenger.ygit_info("Repository path exists.")
-        if repo_ref.protocol == 'ssh':
-            command = repo_ref.ssh_command + " 'cd %s'" % repo_ref.repo_path
-            messenger.ygit_command(command)
-            check = subprocess.Popen([command], shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            check_stderr = check.communicate()[1]
-            if check_stderr:
-                isdir = False
+    global _local_config_lock
+    if _local_config_lock is None:
+        _local_config_lock = asyncio.Lock()
+    return _local_config_lock
+
+############################################################################
+## SSH connection management
+
+class SshMaster(object):
+    """
+    State of the master connection to a single host.
+    """
+
+    def __init__(self, control_path, destination):
+        self.control_path = control_path
+        self.destination = destination
+        self.is_open = False
+        self.attempted = False
+        self.lock = asyncio.Lock()
+
+class SshConnectionManager(object):
+    """
+    Maintains a single multiplexed ssh ("ControlMaster") connection to each
+    remote host for the duration of a run, so that all remote commands
+    issued against the same host share one TCP connection, key exchange and
+    authentication. Attempts to connect to a host are given up after
+    `connect_timeout` seconds (if given).
+    """
+
+    def __init__(self, messenger, multiplex=True, ssh_program="ssh", connect_timeout=None):
+        self.messenger = messenger
+        self.multiplex = multiplex
+        self.ssh_program = ssh_program
+        self.connect_timeout = connect_timeout
+        self.control_dir = None
+        self.masters = {}
+        atexit.register(self.close_all)
+
+    def destination(self, repo_ref):
+        """
+        Returns the ssh arguments selecting the host of `repo_ref`, i.e.,
+        ["-p", PORT, "USER@HOST"] (or just ["USER@HOST"]), preceded by the
+        connection timeout, if any.
+        """
+        args = []
+        if self.connect_timeout:
+            args.extend(["-o", "ConnectTimeout=%d" % max(1, round(self.connect_timeout))])
+        if repo_ref.port:
+            args.extend(["-p", repo_ref.port])
+        args.append("%s@%s" % (repo_ref.user, repo_ref.host))
+        return args
+
+    def master(self, repo_ref):
+        """
+        Returns the `SshMaster` for the host of `repo_ref`. Control sockets
+        are numbered rather than named after the host to stay within the
+        length limit of Unix domain socket paths.
+        """
+        key = repo_ref.host_key()
+        if key not in self.masters:
+            if self.control_dir is None:
+                self.control_dir = tempfile.mkdtemp(prefix="ygit-ssh-")
+            self.masters[key] = SshMaster(
+                    control_path=os.path.join(self.control_dir, "%d" % len(self.masters)),
+                    destination=self.destination(repo_ref))
+        return self.masters[key]
+
+    async def start_master(self, repo_ref):
+        """
+        Opens the master connection to the host of `repo_ref`, if not
+        already open. The master is backgrounded by ssh ("-f") once
+        authentication succeeds. Returns True if a master connection is
+        available. If opening the master fails, it is not attempted again,
+        and commands connect directly instead. Opening the master is given
+        up after twice the connection timeout (to leave time to
+        authenticate), and is not attempted while the host is taken to be
+        down (see `HostHealth`); a master that cannot be opened counts as a
+        failure to reach the host.
+        """
+        master = self.master(repo_ref)
+        async with master.lock:
+            if master.attempted or self.messenger.dry_run:
+                return master.is_open
+            if host_health.is_down(repo_ref):
+                return False
+            argv = [self.ssh_program,
+                    "-o", "ControlMaster=yes",
+                    "-o", "ControlPath=%s" % master.control_path,
+                    "-o", "ControlPersist=yes",
+                    "-N", "-f"] + master.destination
+            master.attempted = True
+            timeout = None
+            if self.connect_timeout:
+                timeout = 2 * self.connect_timeout
+            retcode, stdout, stderr = await command_runner.run(argv,
+                    messenger=self.messenger,
+                    label=host_label(repo_ref),
+                    timeout=timeout,
+                    interactive=True)
+            if retcode:
+                self.messenger.debug("Failed to open multiplexed connection to %s: falling back to direct connections." % format_argv(master.destination))
             else:
-                isdir = True
-        elif repo_ref.protocol == 'file':
-            isdir = os.path.isdir(repo_ref.repo_path)
-        if isdir:
-            messenger.ygit_info("Repository path is an accessible directory.")
-        else:
-            messenger.error("Failed to enter directory: %s." % messenger.compose_repo_ref(repo_ref))
-            sys.exit(1)
-#         messenger.ygit_info("Checking repository status ...")
-#         if repo_ref.protocol == 'ssh':
-#             command = repo_ref.ssh_command + " \"cd %s; git status\"" % repo_ref.repo_path
-#         elif repo_ref.protocol == 'file':
-#             command = "cd '%s'; git status" % repo_ref.repo_path
-#         messenger.ygit_command(command)
-#         gstatus = subprocess.Popen([command], shell=True, stdin=sys.stdin)
-#         retcode = gstatus.wait()
-#         if retcode:
-#             messenger.error("Error checking repository status.")
-#             sys.exit(1)
-    else:
-        messenger.error("Repository not found at: %s" % messenger.compose_repo_ref(repo_ref))
-        sys.exit(1)
+                master.is_open = True
+            host_health.record(repo_ref, failed=retcode != 0)
+            return master.is_open
 
-def delete_remote(repo_ref, messenger, opts):
+    async def ssh_command(self, repo_ref):
+        """
+        Returns the ssh command (as a tuple of arguments, to which the remote
+        command is to be appended) to run a remote command on the host of
+        `repo_ref`, routed through the master connection to the host if
+        multiplexing is enabled.
+        """
+        if not self.multiplex:
+            return tuple([self.ssh_program] + self.destination(repo_ref))
+        await self.start_master(repo_ref)
+        return tuple([self.ssh_program,
+                      "-o", "ControlMaster=no",
+                      "-o", "ControlPath=%s" % self.master(repo_ref).control_path]
+                     + self.destination(repo_ref))
+
+    def close_all(self):
+        """
+        Shuts down all master connections opened during this run.
+        """
+        for master in self.masters.values():
+            if not master.is_open:
+                continue
+            argv = [self.ssh_program,
+                    "-o", "ControlPath=%s" % master.control_path,
+                    "-O", "exit"] + master.destination
+            command_runner.call(argv, messenger=self.messenger)
+        self.masters = {}
+        if self.control_dir is not None:
+            try:
+                os.rmdir(self.control_dir)
+            except OSError:
+                pass
+            self.control_dir = None
+
+############################################################################
+## Unreachable hosts
+##
+## A remote script that could not be run because the host could not be
+## reached (ssh exiting with 255 before the script reported any phase), or
+## that timed out before it did, has not changed anything on the host, and
+## is run again, after a delay growing exponentially with each attempt
+## (with random jitter, so that the operations failing together do not all
+## retry together). A host on which this happens "--host-failures" times in
+## a row is taken to be down: the scripts for it then fail straight away,
+## without trying to reach it, until `HostHealth.reset_after` seconds have
+## passed, after which the next script is tried again.
+
+class HostCircuit(object):
     """
-    Delete repository ... USE WITH CAUTION!
+    Failures of the remote scripts run on a single host: the number of
+    consecutive failures, and the time at which the host was taken to be
+    down, if it is.
     """
-    exists, error = remote_exists(repo_ref=repo_ref, messenger=messenger)
-    if error:
-        messenger.error("Error connnecting to: %s" % messenger.compose_repo_ref(repo_ref))
-        sys.exit(1)
-    if exists:
-        messenger.ygit_info("Deleting repository: %s" % messenger.compose_repo_ref(repo_ref))
-        if repo_ref.protocol == 'ssh':
-            command = repo_ref.ssh_command + " 'rm -r %s'" % repo_ref.repo_path
-        elif repo_ref.protocol == 'file':
-            command = "rm -r '%s'" % repo_ref.repo_path
-        messenger.critical("About to execute:")
-        messenger.critical("    %s" % command)
-        messenger.critical("Continue (y/N)? ", newline=False)
-        ok = raw_input()
-        if not ok.lower().startswith("y"):
-            messenger.critical("Cancelling.")
-            sys.exit(1)
-        messenger.ygit_command(command)
-        if not opts.dry_run:
-            rm = subprocess.Popen([command], shell=True, stdin=sys.stdin)
-            retcode = rm.wait()
-        else:
-            retcode = 0
-        if retcode:
-            messenger.error("Error removing repository.")
-            sys.exit(1)
-        else:
-            messenger.info("Repository deleted, but may still be referenced in local.")
-            messenger.info('Use "git remote rm <name>" to remove reference.')
-    else:
-        messenger.error("Repository not found: %s" % messenger.compose_repo_ref(repo_ref))
 
-def create_remote(repo_ref, messenger, opts, init=True):
+    def __init__(self):
+        self.failures = 0
+        self.opened = None
+
+class HostHealth(object):
     """
-    Create and (optionally) initialize a new repository directory.
+    The timeouts and retries of the remote scripts of a run, and the
+    `HostCircuit` of each host.
+    """
+
+    # seconds after which a host taken to be down is tried again
+    reset_after = 60
+
+    def __init__(self):
+        self.command_timeout = None
+        self.retries = 0
+        self.retry_delay = 1.0
+        self.max_failures = None
+        self.circuits = {}
+
+    def configure(self, opts):
+        """
+        Sets the timeouts and retries from the command-line options.
+        """
+        self.command_timeout = opts.command_timeout or None
+        self.retries = max(0, opts.retries)
+        self.retry_delay = opts.retry_delay
+        self.max_failures = opts.host_failures or None
+
+    def circuit(self, repo_ref):
+        key = repo_ref.host_key()
+        if key not in self.circuits:
+            self.circuits[key] = HostCircuit()
+        return self.circuits[key]
+
+    def is_down(self, repo_ref):
+        """
+        Returns True if the host of `repo_ref` is taken to be down, i.e., if
+        its scripts are to fail without being run.
+        """
+        circuit = self.circuit(repo_ref)
+        return circuit.opened is not None and time.time() - circuit.opened < self.reset_after
+
+    def record(self, repo_ref, failed):
+        """
+        Records the outcome of a script run on the host of `repo_ref`.
+        """
+        circuit = self.circuit(repo_ref)
+        if not failed:
+            circuit.failures = 0
+            circuit.opened = None
+            return
+        circuit.failures += 1
+        if self.max_failures is not None and circuit.failures >= self.max_failures:
+            circuit.opened = time.time()
+
+    @staticmethod
+    def transient(script, reply):
+        """
+        Returns True if `reply` is that of a script that did not get to
+        start because the host could not be reached in time (a script cut
+        off once started may have changed something, and is not run again).
+        """
+        return script.repo_ref.protocol == 'ssh' \
+            and not reply.started \
+            and reply.returncode in (255, TIMED_OUT)
+
+    def retry_delay_for(self, attempt):
+        """
+        Returns the number of seconds to wait before the retry `attempt`
+        (starting from 0): the delay doubles with each attempt, and half of
+        it is random.
+        """
+        delay = self.retry_delay * (2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def down_reply(self, repo_ref, messenger):
+        """
+        Returns the `RemoteScriptReply` of a script failed because its host
+        is taken to be down.
+        """
+        circuit = self.circuit(repo_ref)
+        return RemoteScriptReply(phases=[],
+                returncode=255,
+                stderr="%s: not trying again after %d failures in a row\n" \
+                    % (host_label(repo_ref), circuit.failures),
+                dry_run=messenger.dry_run)
+
+# the timeouts and retries of all remote scripts of a run
+host_health = HostHealth()
+
+############################################################################
+## Remote scripts
+
+def quote_remote_path(path):
+    """
+    Quotes a repository path for use in a remote shell command, leaving any
+    leading "~" or "~user" component unquoted so that the remote shell still
+    expands it.
+    """
+    if path.startswith("~"):
+        parts = path.split("/", 1)
+        if len(parts) == 1:
+            return parts[0]
+        return parts[0] + "/" + shell_quote(parts[1])
+    return shell_quote(path)
+
+def remote_argv(repo_ref, args):
+    """
+    Returns the command running the command `args` (a list of arguments) on
+    the host of `repo_ref`: over ssh, the arguments are quoted into the
+    single command line that the remote shell will split again, so that
+    each arrives there intact; locally, they are run as they are.
     """
-    exists, error = remote_exists(repo_ref=repo_ref, messenger=messenger)
-    if error:
-        messenger.error("Error connnecting to: %s" % messenger.compose_repo_ref(repo_ref))
-        sys.exit(1)
-    if exists:
-        messenger.error("Repository already exists.")
-        messenger.error("Please delete the repository before proceeding, or use another location.")
-        sys.exit(1)
-    if opts.all_quiet:
-        git_stdout = subprocess.PIPE
-    else:
-        git_stdout = None
-    messenger.ygit_info('Creating remote directory: "%s"' % repo_ref.repo_path)
     if repo_ref.protocol == 'ssh':
-        command = repo_ref.ssh_command + " 'mkdir -p %s'" % repo_ref.repo_path
-        messenger.ygit_command(command)
-        if not opts.dry_run:
-            create = subprocess.Popen([command], shell=True, stdin=sys.stdin, stdout=git_stdout)
-            retcode = create.wait()
-        else:
-            retcode = 0
-    elif repo_ref.protocol == 'file':
-        if not opts.dry_run:
+        return list(repo_ref.ssh_command) + [format_argv(args)]
+    return list(args)
+
+class PhaseResult(object):
+    """
+    Outcome of a single phase of a `RemoteScript`.
+    """
+
+    def __init__(self, name, returncode=None, stdout="", stderr=""):
+        self.name = name
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+
+    @property
+    def succeeded(self):
+        return self.returncode == 0
+
+class RemoteScript(object):
+    """
+    Compiles a sequence of shell commands ("phases") into a single script that
+    is run by one shell on the host of the repository (over ssh, or locally
+    for the "file" protocol), so that the whole sequence costs one round
+    trip. Phases run in order and the sequence stops at the first phase that
+    fails, after which the rollback commands of the phases that did complete
+    are run in reverse order, so the sequence is applied either completely
+    or not at all. The exit code, standard output and standard error of
+    each phase are framed in the reply and parsed back into `PhaseResult`
+    objects.
+
+    If `keep_going` is True, the phases are instead independent of each
+    other: every phase is run whatever the outcome of the others, and no
+    rollback commands are run.
+
+    If `payload` (the path of a local file) is given, the script is passed
+    to the remote shell as an argument instead, and the file is streamed to
+    its standard input, which phases can read as file descriptor 3 (e.g.,
+    "cat <&3 > FILE").
+
+    Scripts without a payload are handed to the `RemoteAgent` of the host
+    instead, if agents are enabled ("--agent").
+    """
+
+    marker = "@@ygit"
+
+    def __init__(self, repo_ref, keep_going=False, payload=None):
+        self.repo_ref = repo_ref
+        self.keep_going = keep_going
+        self.payload = payload
+        self.phases = []
+
+    def add_phase(self, name, command, rollback=None, read_only=False):
+        """
+        Appends a phase running the shell command `command`. If given,
+        `rollback` is a shell command undoing the effects of the phase, run
+        if a later phase fails. Phases flagged as `read_only` do not modify
+        anything and so are still run on a dry run.
+        """
+        self.phases.append((name, command, rollback, read_only))
+
+    def read_only_phases(self):
+        """
+        Returns the number of leading phases that are read-only.
+        """
+        count = 0
+        for phase in self.phases:
+            if not phase[3]:
+                break
+            count += 1
+        return count
+
+    def compile(self, num_phases=None):
+        """
+        Returns the text of the script, including only the first `num_phases`
+        phases if given.
+        """
+        if num_phases is None:
+            num_phases = len(self.phases)
+        lines = []
+        if self.payload is not None:
+            lines.append('exec 3<&0')
+        lines += self.preamble()
+        lines.append('echo "%s start"' % self.marker)
+        lines += self.phase_lines(num_phases)
+        lines.append('rm -rf "$ygit_t"')
+        lines.append('[ $ygit_ok = 1 ]')
+        return "\n".join(lines) + "\n"
+
+    def preamble(self):
+        """
+        Returns the lines of the script defining the functions that run and
+        frame each phase.
+        """
+        return [
+            'ygit_t=$(mktemp -d 2>/dev/null || { mkdir "/tmp/ygit.$$" && echo "/tmp/ygit.$$"; })',
+            'ygit_emit() {',
+            '    while IFS= read -r ygit_l || [ -n "$ygit_l" ]; do',
+            '        printf "%s %s\\n" "$1" "$ygit_l"',
+            '    done < "$2"',
+            '}',
+            'ygit_run() {',
+            '    ( eval "$2" ) > "$ygit_t/o" 2> "$ygit_t/e" < /dev/null',
+            '    ygit_rc=$?',
+            '    echo "%s $1 $ygit_rc"' % self.marker,
+            '    ygit_emit O "$ygit_t/o"',
+            '    ygit_emit E "$ygit_t/e"',
+            '    return $ygit_rc',
+            '}',
+        ]
+
+    def phase_lines(self, num_phases):
+        """
+        Returns the lines of the script running its first `num_phases`
+        phases (and their rollback commands), leaving "$ygit_ok" set to 1 if
+        all succeeded and to 0 otherwise.
+        """
+        phases = self.phases[:num_phases]
+        lines = ['ygit_ok=1']
+        if not self.keep_going and phases:
+            lines.append(" ".join("ygit_done_%d=" % idx for idx in range(len(phases))))
+        for idx, (name, command, rollback, read_only) in enumerate(phases):
+            if self.keep_going:
+                lines.append('ygit_run %d %s || ygit_ok=0' % (idx, shell_quote(command)))
+                continue
+            lines.append('if [ $ygit_ok = 1 ]; then if ygit_run %d %s; then ygit_done_%d=1; else ygit_ok=0; fi; fi' \
+                % (idx, shell_quote(command), idx))
+        rollback_idx = len(self.phases)
+        for idx in range(len(phases)-1, -1, -1):
+            if self.keep_going:
+                break
+            rollback = phases[idx][2]
+            if rollback is not None:
+                lines.append('if [ $ygit_ok = 0 ] && [ "$ygit_done_%d" = 1 ]; then ygit_run %d %s; fi' \
+                    % (idx, rollback_idx + idx, shell_quote(rollback)))
+        return lines
+
+    def started(self, reply):
+        """
+        Returns True if the framed output of the script shows that the
+        script started running its phases.
+        """
+        return ("\n%s start\n" % self.marker) in ("\n" + reply)
+
+    def parse_reply(self, reply):
+        """
+        Parses the framed output of the script into a list of `PhaseResult`
+        objects, one for each phase that was run (rollback phases are named
+        after the phase they undo, prefixed by "rollback:"). Lines that do not
+        belong to any phase (e.g., ssh banners) are ignored.
+        """
+        results = []
+        current = None
+        for line in reply.splitlines():
+            if line.startswith(self.marker + " "):
+                parts = line.split()
+                if parts[1] == "start":
+                    continue
+                idx = int(parts[1])
+                current = PhaseResult(self.phase_name(idx), returncode=int(parts[2]))
+                results.append(current)
+            elif current is not None and line.startswith("O "):
+                current.stdout += line[2:] + "\n"
+            elif current is not None and line.startswith("E "):
+                current.stderr += line[2:] + "\n"
+        return results
+
+    def phase_name(self, idx):
+        if idx < len(self.phases):
+            return self.phases[idx][0]
+        return "rollback:" + self.phases[idx - len(self.phases)][0]
+
+    def phase_command(self, idx):
+        if idx < len(self.phases):
+            return self.phases[idx][1]
+        return self.phases[idx - len(self.phases)][2]
+
+    def trace_phases(self, timed_lines, start):
+        """
+        Records a span for each phase run, given the lines of the reply
+        paired with the times at which they were received. The script
+        reports the end of each phase as soon as it happens, so that each
+        phase is taken to run from the end of the one before it (or, for
+        the first phase, from the start of the script).
+        """
+        host = host_label(self.repo_ref)
+        for received, line in timed_lines:
+            if not line.startswith(self.marker + " "):
+                continue
+            parts = line.split()
+            if parts[1] == "start":
+                tracer.add("shell start", "phase", start, received, host=host)
+            else:
+                idx = int(parts[1])
+                tracer.add("phase %s" % self.phase_name(idx), "phase", start, received,
+                        command=self.phase_command(idx),
+                        host=host,
+                        exit=int(parts[2]))
+            start = received
+
+    def argv(self, script=None):
+        """
+        Returns the command that runs the script read from its standard
+        input (or, if there is a payload, `script`) on the host of the
+        repository.
+        """
+        if self.payload is not None:
+            return remote_argv(self.repo_ref, ["sh", "-c", script])
+        return remote_argv(self.repo_ref, ["sh", "-s"])
+
+    def details(self):
+        """
+        Returns the lines shown under the command running the script by
+        "--show".
+        """
+        return ["[%s] %s" % (name, command) for name, command, rollback, read_only in self.phases]
+
+    def interruption(self, reply):
+        """
+        Returns the message reporting that the script was cut off (see
+        `RemoteScriptReply.interrupted`), with the phases that it had
+        completed, none of which were rolled back.
+        """
+        done = [result.name for result in reply.phases if result.succeeded]
+        message = "The script run on %s was cut off (%s)" \
+            % (host_label(self.repo_ref), (reply.stderr.strip().splitlines() or ["exit code %d" % reply.returncode])[-1])
+        if not done:
+            return message + " before it completed any of its phases: check the state of %s." % self.repo_ref.url
+        return message + " after it had completed (and without rolling back): %s. Check the state of %s." \
+            % (", ".join(done), self.repo_ref.url)
+
+    def phases_to_run(self, messenger):
+        """
+        Returns the number of phases actually run: on a dry run, only the
+        leading read-only phases.
+        """
+        if messenger.dry_run:
+            return self.read_only_phases()
+        return len(self.phases)
+
+    def timeout(self):
+        """
+        Returns the number of seconds after which the script is given up,
+        or None.
+        """
+        return host_health.command_timeout
+
+    def idle_timeout(self):
+        """
+        Returns the number of seconds without any output after which the
+        script is given up, or None.
+        """
+        return None
+
+    async def run(self, messenger):
+        """
+        Runs the script and returns a `RemoteScriptReply`. On a dry run, only
+        the leading read-only phases are actually run. In the part of an
+        operation carried out under an `ExecutionPlan`, the script is handed
+        to the plan, which runs it along with the scripts of the other
+        operations on the same host. If the host cannot be reached, the
+        script is run again, or fails straight away if the host is taken to
+        be down (see `HostHealth`).
+        """
+        attempt = 0
+        while True:
+            if self.repo_ref.protocol == 'ssh' and host_health.is_down(self.repo_ref):
+                return host_health.down_reply(self.repo_ref, messenger)
+            host = planned_host.get()
+            if host is not None:
+                reply = await host.run(self, messenger)
+            else:
+                reply = await self.execute(messenger)
+            if not host_health.transient(self, reply) or attempt >= host_health.retries \
+                    or host_health.is_down(self.repo_ref):
+                return reply
+            delay = host_health.retry_delay_for(attempt)
+            messenger.ygit_info("Could not reach %s: trying again in %.1fs" % (host_label(self.repo_ref), delay))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def execute(self, messenger, on_line=None):
+        """
+        Runs the script by itself (see `run`). If `on_line` is given, it is
+        called with each line of the reply as soon as it is read.
+        """
+        details = self.details()
+        num_phases = self.phases_to_run(messenger)
+        # the reply is read as it comes, to time the phases, and so that
+        # what was received of it is kept if the script is cut off
+        timed_lines = []
+        def read_line(line):
+            timed_lines.append((time.time(), line))
+            if on_line is not None:
+                on_line(line)
+        script = self.compile(num_phases)
+        agent = None
+        if self.payload is None and num_phases > 0:
+            agent = await remote_agents.get(self.repo_ref)
+        if self.payload is None:
+            argv = self.argv()
+            display = None
+            input = script
+            input_path = None
+        else:
+            argv = self.argv(script)
+            display = "%s < %s" % (format_argv(self.argv("SCRIPT")), shell_quote(self.payload))
+            input = None
+            # on a dry run, the phases reading the payload are not run
+            input_path = self.payload if num_phases == len(self.phases) else None
+        start = time.time()
+        if agent is not None:
+            returncode, stdout, stderr = await agent.run(script,
+                    messenger=messenger,
+                    details=details,
+                    on_line=read_line,
+                    timeout=self.timeout(),
+                    idle_timeout=self.idle_timeout())
+        else:
+            returncode, stdout, stderr = await command_runner.run(argv,
+                    messenger=messenger,
+                    input=input,
+                    input_path=input_path,
+                    display=display,
+                    read_only=num_phases > 0,
+                    label=host_label(self.repo_ref),
+                    details=details,
+                    on_line=read_line,
+                    timeout=self.timeout(),
+                    idle_timeout=self.idle_timeout(),
+                    interactive=self.repo_ref.protocol == 'ssh')
+        stdout = "".join(line + "\n" for received, line in timed_lines)
+        if tracer.enabled:
+            self.trace_phases(timed_lines, start)
+        reply = RemoteScriptReply(phases=self.parse_reply(stdout),
+                returncode=returncode,
+                stderr=stderr,
+                dry_run=messenger.dry_run,
+                started=self.started(stdout))
+        if self.repo_ref.protocol == 'ssh':
+            host_health.record(self.repo_ref, host_health.transient(self, reply) or reply.interrupted)
+        return reply
+
+class RemoteScriptReply(object):
+    """
+    Collects the per-phase results of running a `RemoteScript`. `started`
+    is True if the script started running its phases.
+    """
+
+    def __init__(self, phases, returncode, stderr="", dry_run=False, started=False):
+        self.phases = phases
+        self.returncode = returncode
+        self.stderr = stderr
+        self.dry_run = dry_run
+        self.started = started
+
+    def phase(self, name):
+        """
+        Returns the `PhaseResult` of the phase `name`, or None if the phase
+        was not run.
+        """
+        for result in self.phases:
+            if result.name == name:
+                return result
+        return None
+
+    @property
+    def connected(self):
+        return (len(self.phases) > 0 and not self.interrupted) or (self.dry_run and self.returncode == 0)
+
+    @property
+    def interrupted(self):
+        """
+        True if the script was cut off (it timed out, or the connection was
+        lost) after it had started, so that it may have run some of its
+        phases (which were not rolled back).
+        """
+        return self.started and self.returncode in (255, TIMED_OUT)
+
+    def failed_phase(self):
+        """
+        Returns the `PhaseResult` of the first phase that failed, or None.
+        """
+        for result in self.phases:
+            if not result.succeeded:
+                return result
+        return None
+
+############################################################################
+## Remote agents
+##
+## With "--agent", a single long-lived shell (the agent) is started on each
+## remote host, over one ssh session, and the scripts of all the operations
+## on the host are sent to it as requests, instead of each being run by a
+## new ssh session and remote shell. Requests are written as soon as they
+## are made, without waiting for the replies to earlier ones, so that any
+## number of them are in flight over the session at the same time; the agent
+## runs them one after the other, in the order received. A request is the
+## line "@@ygit-request ID N" followed by the N lines of a script compiled
+## by `RemoteScript`, and its reply is the (framed) output of the script,
+## followed by the line "@@ygit-reply ID EXIT-CODE". (The script is written
+## to a file as it is read, and then run, as it may be large: see
+## `ScriptBatch`.)
+
+AGENT_SCRIPT = """\
+ygit_request_file=$(mktemp 2>/dev/null || echo "/tmp/ygit-agent.$$")
+echo "@@ygit-agent ready"
+while IFS= read -r ygit_request; do
+    case $ygit_request in
+        "@@ygit-request "*) ;;
+        *) continue ;;
+    esac
+    set -- $ygit_request
+    ygit_n=$3
+    while [ "$ygit_n" -gt 0 ] && IFS= read -r ygit_line; do
+        printf '%s\\n' "$ygit_line"
+        ygit_n=$((ygit_n - 1))
+    done > "$ygit_request_file"
+    ( . "$ygit_request_file" ) < /dev/null
+    echo "@@ygit-reply $2 $?"
+done
+rm -f "$ygit_request_file"
+"""
+
+class RemoteAgent(object):
+    """
+    The agent running on the host of `repo_ref` (whose `ssh_command` is
+    used to reach the host), started with the messages of `messenger`.
+    """
+
+    def __init__(self, repo_ref, messenger):
+        self.repo_ref = repo_ref
+        self.messenger = messenger
+        self.proc = None
+        self.record = None
+        self.lock = asyncio.Lock()
+        self.started = False
+        self.failed = False
+        self.exited = False
+        self.num_requests = 0
+        # the requests written and not yet replied to, in order, as lists of
+        # [ID, future, on_line, lines of output, time the agent started it
+        # (None while it waits for those before it), time of its last
+        # output]
+        self.waiting = []
+        self.stderr = None
+
+    async def start(self):
+        """
+        Starts the agent, if not already started, and returns True if it is
+        running. An agent that has not reported that it is ready within the
+        timeout of a remote script (see `HostHealth`) is stopped, and taken
+        not to have started.
+        """
+        async with self.lock:
+            # if the agent cannot be started, it is not attempted again
+            if self.started:
+                return self.proc is not None
+            self.started = True
+            argv = remote_argv(self.repo_ref, ["sh", "-c", AGENT_SCRIPT])
+            display = format_argv(remote_argv(self.repo_ref, ["sh", "-c", "AGENT"]))
+            proc, self.record = await command_runner.start(argv,
+                    messenger=self.messenger,
+                    label=host_label(self.repo_ref),
+                    display=display)
+            if proc is None:
+                self.failed = True
+                return False
+            self.stderr = asyncio.ensure_future(proc.stderr.read())
+            timeout = host_health.command_timeout
+            deadline = time.time() + timeout if timeout is not None else None
+            try:
+                while True:
+                    line = await asyncio.wait_for(proc.stdout.readline(),
+                            None if deadline is None else max(0, deadline - time.time()))
+                    if not line or line.rstrip() == b"@@ygit-agent ready":
+                        break
+            except asyncio.TimeoutError:
+                proc.kill()
+                line = b""
+            if not line:
+                self.failed = True
+                await self.finish(proc)
+                self.messenger.debug("Failed to start agent on %s: falling back to a remote shell for each command." \
+                    % host_label(self.repo_ref))
+                return False
+            self.proc = proc
+            asyncio.ensure_future(self.read_replies())
+            return True
+
+    async def run(self, script, messenger, details=None, on_line=None, timeout=None, idle_timeout=None):
+        """
+        Has the agent run `script`, returning a tuple of its exit code, its
+        standard output (passed to `on_line` as it is read, if given) and
+        standard error, as `CommandRunner.run` does. The standard error of
+        the script itself is not collected (that of each phase is framed in
+        its standard output). If the script has not finished `timeout`
+        seconds after the agent started it (the agent runs one script at a
+        time: the time spent waiting for those before it does not count),
+        or has been silent for `idle_timeout` seconds, the agent is stopped
+        (failing any other requests waiting for it), and the script is
+        reported as exiting with `TIMED_OUT`.
+        """
+        messenger.ygit_command("[agent %s] sh -s" % host_label(self.repo_ref))
+        for line in details or ():
+            messenger.ygit_command("    %s" % line)
+        if self.proc is None:
+            return 255, "", "Connection to the agent on %s lost.\n" % host_label(self.repo_ref)
+        start = time.time()
+        self.num_requests += 1
+        request = [self.num_requests, asyncio.get_running_loop().create_future(), on_line, [], None, None]
+        if not self.waiting:
+            request[4] = request[5] = start
+        self.waiting.append(request)
+        try:
+            self.proc.stdin.write(("@@ygit-request %d %d\n%s" \
+                % (request[0], script.count("\n"), script)).encode("utf-8"))
+            await self.proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # the agent has exited: the request is failed by `read_replies`
+            pass
+        timed_out = False
+        while not request[1].done():
+            if request[4] is None:
+                # (looked at again once the script may have been started)
+                deadlines = [time.time() + limit for limit in (timeout, idle_timeout) if limit is not None]
+            else:
+                deadlines = []
+                if timeout is not None:
+                    deadlines.append(request[4] + timeout)
+                if idle_timeout is not None:
+                    deadlines.append(request[5] + idle_timeout)
+            remaining = min(deadlines) - time.time() if deadlines else None
+            if remaining is not None and remaining <= 0:
+                timed_out = True
+                break
+            try:
+                await asyncio.wait_for(asyncio.shield(request[1]), remaining)
+            except asyncio.TimeoutError:
+                # (the request may have been started, or heard of, in the
+                # meantime)
+                pass
+        if timed_out:
+            # the agent is replaced by the next request
+            if self.proc is not None:
+                self.proc.kill()
+            returncode, stdout, stderr = await request[1]
+            returncode = TIMED_OUT
+            if timeout is not None and time.time() - request[4] >= timeout:
+                stderr = "agent on %s: timed out after %gs\n" % (host_label(self.repo_ref), timeout)
+            else:
+                stderr = "agent on %s: timed out after %gs without output\n" \
+                    % (host_label(self.repo_ref), idle_timeout)
+        else:
+            returncode, stdout, stderr = request[1].result()
+        tracer.add("agent sh -s", "agent", start, time.time(),
+                host=host_label(self.repo_ref),
+                exit=returncode)
+        return returncode, stdout, stderr
+
+    async def read_replies(self):
+        """
+        Reads the output of the agent, handing each line to the request it
+        belongs to, until the agent exits, when any requests still waiting
+        fail.
+        """
+        proc = self.proc
+        while True:
+            line = await proc.stdout.readline()
+            if not line:
+                break
+            if not self.waiting:
+                continue
+            line = decode_output(line).rstrip("\n")
+            request_id, future, on_line, lines, started, heard = self.waiting[0]
+            self.waiting[0][5] = time.time()
+            if line.startswith("@@ygit-reply "):
+                del self.waiting[0]
+                if self.waiting:
+                    # the agent goes on to the next request
+                    self.waiting[0][4] = self.waiting[0][5] = time.time()
+                future.set_result((int(line.split()[2]), "".join(text + "\n" for text in lines), ""))
+                continue
+            if on_line is not None:
+                on_line(line)
+            else:
+                lines.append(line)
+        self.proc = None
+        self.exited = True
+        stderr = await self.finish(proc)
+        waiting, self.waiting = self.waiting, []
+        for request_id, future, on_line, lines, started, heard in waiting:
+            future.set_result((255, "".join(text + "\n" for text in lines),
+                stderr or "Connection to the agent on %s lost.\n" % host_label(self.repo_ref)))
+
+    async def finish(self, proc):
+        """
+        Waits for the agent process `proc` to exit, and returns its standard
+        error.
+        """
+        await proc.wait()
+        stderr = await self.stderr
+        command_runner.finish(self.record, self.messenger, proc.returncode, None, len(stderr))
+        return decode_output(stderr)
+
+    async def close(self):
+        """
+        Stops the agent (once it has replied to all requests).
+        """
+        proc = self.proc
+        if proc is None:
+            return
+        proc.stdin.close()
+        await proc.wait()
+
+class RemoteAgents(object):
+    """
+    The `RemoteAgent` of each remote host, if enabled.
+    """
+
+    def __init__(self):
+        self.messenger = None
+        self.agents = {}
+
+    def enable(self, messenger):
+        """
+        Has the scripts run on remote hosts (over ssh) handed to agents from
+        now on, with the agents started with the messages of `messenger`.
+        """
+        self.messenger = messenger
+
+    async def get(self, repo_ref):
+        """
+        Returns the running agent of the host of `repo_ref` (starting it if
+        need be), or None if agents are not enabled or the agent cannot be
+        started.
+        """
+        if self.messenger is None or repo_ref.protocol != 'ssh' or repo_ref.ssh_command is None:
+            return None
+        key = repo_ref.host_key()
+        agent = self.agents.get(key)
+        if agent is None or agent.exited:
+            agent = self.agents[key] = RemoteAgent(repo_ref, self.messenger)
+        if not await agent.start():
+            return None
+        return agent
+
+    async def close_all_async(self):
+        """
+        Stops all the agents.
+        """
+        agents, self.agents = list(self.agents.values()), {}
+        await asyncio.gather(*[agent.close() for agent in agents])
+
+    def close_all(self):
+        if self.agents:
+            run_sync(self.close_all_async())
+
+# all remote scripts of a run are handed to these agents (if enabled)
+remote_agents = RemoteAgents()
+
+############################################################################
+## Repository templates
+
+def copy_repository_tree(source, target):
+    """
+    Copies the contents of the directory `source` into the existing
+    directory `target`, preserving permissions (including the set-group-ID
+    bit that "--shared" sets on directories), and gives `target` the
+    permissions of `source`.
+    """
+    with os.scandir(source) as entries:
+        for entry in entries:
+            destination = os.path.join(target, entry.name)
+            if entry.is_symlink():
+                os.symlink(os.readlink(entry.path), destination)
+            elif entry.is_dir():
+                os.mkdir(destination)
+                copy_repository_tree(entry.path, destination)
+            else:
+                shutil.copy(entry.path, destination)
+    shutil.copymode(source, target)
+
+class RepositoryTemplates(object):
+    """
+    Creates local ("file" protocol) repositories without running git. For
+    each combination of the "--bare" and "--shared" options used in a run,
+    a pristine repository is created once, by "git init" and "git
+    update-server-info" in a private directory, and new repositories are
+    then copied from it in-process, so that they are identical to what git
+    itself would have created. Files are copied rather than hard-linked,
+    as git (or the user) may later modify some of them in place.
+    """
+
+    def __init__(self):
+        self.base_dir = None
+        self.skeletons = {}
+        self.locks = {}
+        atexit.register(self.remove_all)
+
+    @staticmethod
+    def enabled(repo_ref, messenger, opts):
+        """
+        Returns True if the repository at `repo_ref` can be created from a
+        template: templates are only used for the "file" protocol, and not
+        on a dry run (on which the git commands that would otherwise be run
+        are shown instead).
+        """
+        return repo_ref.protocol == 'file' \
+            and getattr(opts, 'use_templates', True) \
+            and not messenger.dry_run
+
+    async def skeleton(self, messenger, opts):
+        """
+        Returns a tuple of the path of the pristine repository for the
+        options `opts` (creating it if needed) and the output of the "git
+        init" that created it.
+        """
+        key = (bool(opts.bare), opts.shared or None)
+        if key not in self.locks:
+            self.locks[key] = asyncio.Lock()
+        async with self.locks[key]:
+            if key in self.skeletons:
+                return self.skeletons[key]
+            if self.base_dir is None:
+                self.base_dir = os.path.realpath(tempfile.mkdtemp(prefix="ygit-templates-"))
+            path = os.path.join(self.base_dir, "%d" % len(self.skeletons))
+            os.mkdir(path)
+            init_argv = ["git", "init"]
+            if opts.bare:
+                init_argv.append("--bare")
+            if opts.shared:
+                init_argv.append("--shared=" + opts.shared)
+            init_argv.append(path)
+            for argv in (init_argv, ["git", "-C", path, "update-server-info"]):
+                retcode, out, err = await command_runner.run(argv, messenger=messenger, label="localhost")
+                if retcode:
+                    messenger.error(err, newline=False)
+                    raise YonderGitError("Error initializing repository.")
+                if argv is init_argv:
+                    init_output = out
+            self.skeletons[key] = (path, init_output)
+            return self.skeletons[key]
+
+    async def populate(self, repo_ref, messenger, opts):
+        """
+        Copies the pristine repository for `opts` into the existing, empty
+        directory at `repo_ref`, returning the `PhaseResult` objects of the
+        equivalent "init" and "update-server-info" phases.
+        """
+        skeleton, init_output = await self.skeleton(messenger, opts)
+        path = os.path.realpath(repo_ref.repo_path)
+        messenger.debug("Copying repository template: %s -> %s" % (skeleton, path))
+        init = PhaseResult("init", returncode=0, stdout=init_output.replace(skeleton, path))
+        try:
+            with tracer.span("copy template", "in-process", source=skeleton, target=path, host="localhost"):
+                copy_repository_tree(skeleton, path)
+        except OSError as e:
+            init.returncode = 1
+            init.stdout = ""
+            init.stderr = "%s\n" % e
+            return [init]
+        return [init, PhaseResult("update-server-info", returncode=0)]
+
+    async def create(self, repo_ref, messenger, opts):
+        """
+        Carries out the phases of `create_remote_async` (with
+        initialization) for a local repository, returning a
+        `RemoteScriptReply` with the same phases as the remote script would.
+        As with the remote script, the newly-created directory is removed
+        again if initialization fails.
+        """
+        path = repo_ref.repo_path
+        phases = [PhaseResult("probe", returncode=0)]
+        if os.path.lexists(path):
+            phases[0].returncode = 1
+            return RemoteScriptReply(phases=phases, returncode=1)
+        mkdir = PhaseResult("mkdir", returncode=0)
+        phases.append(mkdir)
+        try:
+            if repo_ref.dir_name:
+                os.makedirs(repo_ref.dir_name, exist_ok=True)
+            # as in the remote script, the repository directory itself is
+            # created exclusively
+            os.mkdir(path)
+        except OSError as e:
+            mkdir.returncode = 1
+            mkdir.stderr = "%s\n" % e
+            return RemoteScriptReply(phases=phases, returncode=1)
+        phases.extend(await self.populate(repo_ref, messenger, opts))
+        if not phases[-1].succeeded:
+            shutil.rmtree(path, ignore_errors=True)
+            phases.append(PhaseResult("rollback:mkdir", returncode=0))
+            return RemoteScriptReply(phases=phases, returncode=1)
+        return RemoteScriptReply(phases=phases, returncode=0)
+
+    async def init(self, repo_ref, messenger, opts):
+        """
+        Carries out the phases of `init_remote_async` for a local repository
+        if its directory exists and is empty, returning a
+        `RemoteScriptReply` with the same phases as the remote script would;
+        returns None otherwise (e.g., to re-initialize an existing
+        repository), in which case git has to be run after all.
+        """
+        path = repo_ref.repo_path
+        try:
+            if not os.path.isdir(path) or os.listdir(path):
+                return None
+        except OSError:
+            return None
+        phases = [PhaseResult("exists", returncode=0), PhaseResult("isdir", returncode=0)]
+        phases.extend(await self.populate(repo_ref, messenger, opts))
+        return RemoteScriptReply(phases=phases, returncode=0 if phases[-1].succeeded else 1)
+
+    def remove_all(self):
+        """
+        Removes the pristine repositories created during this run.
+        """
+        if self.base_dir is not None:
+            shutil.rmtree(self.base_dir, ignore_errors=True)
+            self.base_dir = None
+        self.skeletons = {}
+
+repository_templates = RepositoryTemplates()
+
+############################################################################
+## Seed bundles
+
+class SeedBundle(object):
+    """
+    A bundle of the branches and tags of a local repository, at `path`, the
+    branch checked out in the local repository (`head`, e.g.,
+    "refs/heads/master", or None if HEAD is detached), and the refs in the
+    bundle, as a list of (object name, ref name) tuples.
+    """
+
+    def __init__(self, path, head, refs):
+        self.path = path
+        self.head = head
+        self.refs = refs
+
+    @property
+    def head_branch(self):
+        """
+        The name of the branch checked out in the local repository, or None.
+        """
+        if self.head is None or not self.head.startswith("refs/heads/"):
+            return None
+        return self.head[len("refs/heads/"):]
+
+    def branches(self):
+        """
+        Returns a list of (object name, branch name) tuples of the branches
+        in the bundle.
+        """
+        return [(sha, ref[len("refs/heads/"):]) for sha, ref in self.refs if ref.startswith("refs/heads/")]
+
+class SeedBundles(object):
+    """
+    Makes the bundles with which "--seed" fills new repositories with the
+    history of the local repository. The bundle of each local repository is
+    made once for as long as its branches and tags (and the branch checked
+    out) stay the same, however many repositories are seeded from it, so
+    that "git pack-objects" goes over its history only once; the bundle is
+    then streamed to each new repository, which fetches from it.
+    """
+
+    def __init__(self):
+        self.base_dir = None
+        self.num_made = 0
+        # the latest bundle of each local repository, as a tuple of the
+        # refs it was made from and the `SeedBundle`
+        self.bundles = {}
+        self.locks = {}
+        atexit.register(self.remove_all)
+
+    async def bundle(self, messenger, opts):
+        """
+        Returns the `SeedBundle` of the local repository of `opts` as it now
+        is (making it if the last one made is out of date), raising a
+        `YonderGitError` if it cannot be made.
+        """
+        local_repo = os.path.realpath(opts.local_repo)
+        if local_repo not in self.locks:
+            self.locks[local_repo] = asyncio.Lock()
+        async with self.locks[local_repo]:
+            refs = await self.read_refs(local_repo, messenger)
+            if local_repo not in self.bundles or self.bundles[local_repo][0] != refs:
+                # (a bundle replaced may still be streamed: its file is only
+                # removed by `remove_all`)
+                self.bundles[local_repo] = (refs, await self.make(local_repo, messenger))
+            return self.bundles[local_repo][1]
+
+    async def read_refs(self, local_repo, messenger):
+        """
+        Returns the branches and tags of `local_repo`, and which branch is
+        checked out, as the output of "git for-each-ref".
+        """
+        retcode, out, err = await command_runner.run(["git", "-C", local_repo, "for-each-ref",
+                    "--format=%(objectname) %(refname) %(HEAD)", "refs/heads", "refs/tags"],
+                messenger=messenger,
+                read_only=True,
+                label="localhost")
+        if retcode:
+            messenger.error(err, newline=False)
+            raise YonderGitError("Error reading the branches and tags of the local repository.")
+        return out
+
+    async def make(self, local_repo, messenger):
+        if self.base_dir is None:
+            self.base_dir = os.path.realpath(tempfile.mkdtemp(prefix="ygit-seed-"))
+        path = os.path.join(self.base_dir, "%d.bundle" % self.num_made)
+        self.num_made += 1
+        retcode, out, err = await command_runner.run(["git", "-C", local_repo, "symbolic-ref", "-q", "HEAD"],
+                messenger=messenger,
+                read_only=True,
+                label="localhost")
+        head = out.strip() or None
+        messenger.ygit_info("Bundling the branches and tags of: %s" % local_repo)
+        with tracer.span("bundle", "operation", host="localhost"):
+            retcode, out, err = await command_runner.run(["git", "-C", local_repo, "bundle", "create", "-q", path, "--branches", "--tags"],
+                    messenger=messenger,
+                    label="localhost")
+        if retcode:
+            messenger.error(err, newline=False)
+            if "empty bundle" in err:
+                raise YonderGitError("The local repository has no history to seed repositories with.")
+            raise YonderGitError("Error bundling the local repository.")
+        refs = []
+        if not messenger.dry_run:
+            messenger.debug("Bundle of %s: %s (%d bytes)" % (local_repo, path, os.path.getsize(path)))
+            retcode, out, err = await command_runner.run(["git", "bundle", "list-heads", path],
+                    messenger=messenger,
+                    read_only=True,
+                    label="localhost")
+            if retcode:
+                messenger.error(err, newline=False)
+                raise YonderGitError("Error reading the bundle of the local repository.")
+            refs = [tuple(line.split(" ", 1)) for line in out.splitlines() if " " in line]
+        return SeedBundle(path, head, refs)
+
+    def remove_all(self):
+        """
+        Removes the bundles made during this run.
+        """
+        if self.base_dir is not None:
+            shutil.rmtree(self.base_dir, ignore_errors=True)
+            self.base_dir = None
+        self.bundles = {}
+
+seed_bundles = SeedBundles()
+
+############################################################################
+## Local repository configuration
+
+def find_git_dir(path):
+    """
+    Returns the directory holding the configuration of the git repository
+    containing the directory `path` (its ".git" directory, the repository
+    itself if bare, or the main repository of a linked worktree), or None if
+    `path` is not in a git repository. As for git run in `path`, the
+    repository is instead that at $GIT_DIR (relative to `path`) if set, and
+    the configuration that in $GIT_COMMON_DIR if set.
+    """
+    path = cwd = os.path.abspath(path)
+    if os.environ.get("GIT_DIR"):
+        git_dir = os.path.join(cwd, os.environ["GIT_DIR"])
+        if not os.path.isdir(git_dir):
+            return None
+        return common_git_dir(cwd, git_dir)
+    while True:
+        dot_git = os.path.join(path, ".git")
+        git_dir = None
+        if os.path.isdir(dot_git):
+            git_dir = dot_git
+        elif os.path.isfile(dot_git):
+            try:
+                with open(dot_git, "r") as stream:
+                    content = stream.read().strip()
+            except (IOError, OSError):
+                content = ""
+            if content.startswith("gitdir:"):
+                git_dir = os.path.join(path, content[len("gitdir:"):].strip())
+        elif os.path.isfile(os.path.join(path, "HEAD")) \
+                and os.path.isdir(os.path.join(path, "objects")) \
+                and os.path.isdir(os.path.join(path, "refs")):
+            git_dir = path
+        if git_dir is not None:
+            return common_git_dir(cwd, git_dir)
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+def common_git_dir(path, git_dir):
+    """
+    Returns the directory holding the configuration of the repository at
+    `git_dir`, as found by git run in the directory `path`: $GIT_COMMON_DIR
+    (relative to `path`) if set, the main repository if `git_dir` is that of a linked
+    worktree, or `git_dir` itself.
+    """
+    if os.environ.get("GIT_COMMON_DIR"):
+        return os.path.normpath(os.path.join(path, os.environ["GIT_COMMON_DIR"]))
+    commondir = os.path.join(git_dir, "commondir")
+    if os.path.isfile(commondir):
+        with open(commondir, "r") as stream:
+            git_dir = os.path.join(git_dir, stream.read().strip())
+    return os.path.normpath(git_dir)
+
+def valid_remote_name(name):
+    """
+    Returns True if `name` can be the name of a remote, i.e., if
+    "refs/remotes/NAME/" is a valid ref name prefix (as "git remote add"
+    requires).
+    """
+    if not name or name.endswith("/") or name.endswith(".") or name == "@" or "@{" in name:
+        return False
+    if re.search(r'[\x00-\x20\x7f~^:?*\[\\]', name):
+        return False
+    for component in name.split("/"):
+        if not component or component.startswith(".") or component.endswith(".lock") or ".." in component:
+            return False
+    return True
+
+def format_config_value(value):
+    """
+    Returns `value` as it is written in a git configuration file: quoted if
+    it has leading or trailing spaces or comment characters, with special
+    characters escaped.
+    """
+    escaped = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n").replace("\t", "\\t")
+    if value.startswith(" ") or value.endswith(" ") or "#" in value or ";" in value:
+        return '"%s"' % escaped
+    return escaped
+
+class GitConfigFile(object):
+    """
+    The lines of a git configuration file, parsed just enough to find the
+    sections and variables in it and edit them as "git config" would,
+    leaving everything else (comments, layout, other sections) untouched.
+    Section and variable names are matched without regard to case,
+    subsection names exactly.
+    """
+
+    section_pattern = re.compile(r'^\s*\[\s*([-.\w]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]')
+    variable_pattern = re.compile(r'^\s*([A-Za-z][-A-Za-z0-9]*)\s*(=|$|[;#])')
+
+    def __init__(self, text=""):
+        self.lines = text.splitlines(True)
+        if self.lines and not self.lines[-1].endswith("\n"):
+            self.lines[-1] += "\n"
+        self.section_names = None
+
+    def entries(self):
+        """
+        Returns a list of (line index, section, subsection, variable) tuples,
+        one for each section header (with a variable of None) and each
+        variable in the file.
+        """
+        entries = []
+        section = subsection = None
+        continued = False
+        for idx, line in enumerate(self.lines):
+            if continued:
+                continued = self.continues(line)
+                continue
+            match = self.section_pattern.match(line)
+            if match:
+                section, subsection = match.group(1), match.group(2)
+                if subsection is not None:
+                    subsection = re.sub(r'\\(.)', r'\1', subsection)
+                elif "." in section:
+                    # deprecated "[section.subsection]" syntax
+                    section, subsection = section.split(".", 1)
+                    subsection = subsection.lower()
+                section = section.lower()
+                entries.append((idx, section, subsection, None))
+                continue
+            match = self.variable_pattern.match(line)
+            if match and section is not None:
+                entries.append((idx, section, subsection, match.group(1).lower()))
+                continued = self.continues(line)
+        return entries
+
+    @staticmethod
+    def continues(line):
+        stripped = line.rstrip("\r\n")
+        return (len(stripped) - len(stripped.rstrip("\\"))) % 2 == 1
+
+    def has_section(self, section, subsection):
+        if self.section_names is None:
+            self.section_names = set(entry[1:3] for entry in self.entries())
+        return (section, subsection) in self.section_names
+
+    def count(self, section, subsection, variable):
+        return len([entry for entry in self.entries() if entry[1:] == (section, subsection, variable)])
+
+    @staticmethod
+    def header(section, subsection):
+        if subsection is None:
+            return "[%s]\n" % section
+        return '[%s "%s"]\n' % (section, subsection.replace("\\", "\\\\").replace('"', '\\"'))
+
+    def add_section(self, section, subsection, variables):
+        """
+        Appends a new section, with the (variable, value) tuples in
+        `variables`.
+        """
+        self.lines.append(self.header(section, subsection))
+        if self.section_names is not None:
+            self.section_names.add((section, subsection))
+        for variable, value in variables:
+            self.lines.append("\t%s = %s\n" % (variable, format_config_value(value)))
+
+    def set(self, section, subsection, variable, value):
+        """
+        Sets `variable` to `value`: replaces its only value if it is set
+        (including any lines it is continued on with a backslash), adds it
+        to the last of its sections otherwise (or to a new section). Raises
+        a `YonderGitError` if it has several values.
+        """
+        entries = self.entries()
+        line = "\t%s = %s\n" % (variable, format_config_value(value))
+        matches = [idx for idx, entry_section, entry_subsection, entry_variable in entries
+                if (entry_section, entry_subsection, entry_variable) == (section, subsection, variable)]
+        if len(matches) > 1:
+            raise YonderGitError("Cannot overwrite the multiple values of %s with a single value." \
+                % ".".join(part for part in (section, subsection, variable) if part is not None))
+        if matches:
+            # (along with the lines its value is continued on)
+            end = matches[0] + 1
+            while end < len(self.lines) and self.continues(self.lines[end - 1]):
+                end += 1
+            self.lines[matches[0]:end] = [line]
+            return
+        last = None
+        for position, (idx, entry_section, entry_subsection, entry_variable) in enumerate(entries):
+            if (entry_section, entry_subsection) == (section, subsection):
+                last = position
+        if last is None:
+            self.add_section(section, subsection, [(variable, value)])
+            return
+        insert_at = entries[last][0] + 1
+        while insert_at < len(self.lines) and self.continues(self.lines[insert_at - 1]):
+            insert_at += 1
+        self.lines.insert(insert_at, line)
+
+    def text(self):
+        return "".join(self.lines)
+
+class LocalConfig(object):
+    """
+    Edits the configuration file of a local repository in-process, instead
+    of running "git remote add" and "git config" for each change. Changes
+    requested by operations running at the same time are applied together,
+    in a single write, under the same "config.lock" protocol as git (the new
+    contents are written to the lock file, which then replaces the
+    configuration file), so that the file is never seen half-written and
+    concurrent git processes are excluded.
+
+    Names of remotes are reserved (with `reserving_remote`) by the
+    operations that will add them before they do anything else, so that a
+    remote that already exists (or that another operation of the same run
+    is about to add) is reported before any repository is created. Changes
+    made on behalf of a reserved remote are held until the operations of
+    all the other reserved remotes have also requested theirs (or have
+    finished), so that those that finish together are written together,
+    but for at most `group_delay` seconds, so that none wait on slower
+    (or unrelated) operations.
+    """
+
+    # number of times, and interval in seconds, at which to retry taking a
+    # lock held by another process
+    lock_attempts = 20
+    lock_interval = 0.05
+
+    # longest time, in seconds, for which changes are held for those of the
+    # other reserved remotes
+    group_delay = 0.05
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self.path = os.path.join(git_dir, "config")
+        self.reserved = set()
+        self.pending = []
+        self.writing = False
+        self.parsed = None
+        self.wakeup = None
+
+    def read(self):
+        try:
+            with open(self.path, "r") as stream:
+                return GitConfigFile(stream.read())
+        except (IOError, OSError) as e:
+            raise YonderGitError("Cannot read local repository configuration: %s" % e)
+
+    def current(self):
+        """
+        Returns the configuration as it is in the file, parsed only once for
+        as long as the file is unchanged (it must not be modified).
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError as e:
+            raise YonderGitError("Cannot read local repository configuration: %s" % e)
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if self.parsed is None or self.parsed[0] != key:
+            self.parsed = (key, self.read())
+        return self.parsed[1]
+
+    def remote_exists(self, name):
+        """
+        Returns True if the remote `name` is defined in the local repository
+        (including in the legacy "remotes" and "branches" files).
+        """
+        for legacy_dir in ("remotes", "branches"):
+            if os.path.exists(os.path.join(self.git_dir, legacy_dir, name)):
+                return True
+        return self.current().has_section("remote", name)
+
+    def check_remote_name(self, name):
+        """
+        Raises a `YonderGitError` if a remote called `name` cannot be added.
+        """
+        if not valid_remote_name(name):
+            raise YonderGitError("'%s' is not a valid remote name." % name)
+        if name in self.reserved or self.remote_exists(name):
+            raise YonderGitError('A remote called "%s" is already defined in the local repository.' % name)
+
+    @contextlib.contextmanager
+    def reserving_remote(self, name):
+        """
+        Context manager reserving the name `name` for a remote to be added
+        in its body, raising a `YonderGitError` if it is taken.
+        """
+        self.check_remote_name(name)
+        self.reserved.add(name)
+        try:
+            yield
+        finally:
+            self.reserved.discard(name)
+            self.notify()
+
+    async def add_remote(self, name, url, mirror, messenger):
+        """
+        Adds the remote `name`, as "git remote add [--mirror]" would.
+        """
+        if not valid_remote_name(name):
+            raise YonderGitError("'%s' is not a valid remote name." % name)
+        if mirror:
+            variables = [("url", url), ("fetch", "+refs/*:refs/*"), ("mirror", "true")]
+        else:
+            variables = [("url", url), ("fetch", "+refs/heads/*:refs/remotes/%s/*" % name)]
+        argv = ["git", "-C", os.path.dirname(self.git_dir), "remote", "add"]
+        if mirror:
+            argv.append("--mirror")
+        await self.apply([("remote", name, variables)], messenger,
+                format_argv(argv + [name, url]), owner=name)
+
+    async def set_values(self, settings, messenger, owner=None):
+        """
+        Sets each of the ("section[.subsection].variable", value) tuples in
+        `settings`, as "git config" would, in a single write, on behalf of
+        the remote `owner` (if any).
+        """
+        changes = []
+        for key, value in settings:
+            section, rest = key.split(".", 1)
+            subsection = None
+            if "." in rest:
+                subsection, rest = rest.rsplit(".", 1)
+            changes.append(("set", section.lower(), subsection, rest.lower(), value))
+        await self.apply(changes, messenger,
+                "; ".join(format_argv(["git", "-C", os.path.dirname(self.git_dir), "config", key, value])
+                    for key, value in settings),
+                owner=owner)
+
+    async def apply(self, changes, messenger, description, owner=None):
+        """
+        Applies `changes` (of the kinds handled by `apply_changes`), along
+        with those of any other operations waiting to do so, shown as
+        `description` (the equivalent git commands) by "--show". Returns
+        once they have been written (or not at all on a dry run), raising a
+        `YonderGitError` if they could not be.
+        """
+        messenger.ygit_command(description)
+        if messenger.dry_run:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((changes, owner, future))
+        self.notify()
+        if not self.writing:
+            self.writing = True
+            asyncio.ensure_future(self.write_pending())
+        await future
+
+    def notify(self):
+        if self.wakeup is not None and not self.wakeup.done():
+            self.wakeup.set_result(None)
+
+    def ready(self):
+        """
+        Returns True if the operation of each reserved remote is waiting for
+        its changes to be written.
+        """
+        return self.reserved.issubset(owner for changes, owner, future in self.pending)
+
+    async def write_pending(self):
+        try:
+            # lets the operations that are ready at the same time join in
+            await asyncio.sleep(0)
+            while self.pending:
+                deadline = time.time() + self.group_delay
+                while not self.ready() and time.time() < deadline:
+                    self.wakeup = asyncio.get_running_loop().create_future()
+                    try:
+                        await asyncio.wait_for(self.wakeup, deadline - time.time())
+                    except asyncio.TimeoutError:
+                        break
+                batch, self.pending = self.pending, []
+                try:
+                    errors = await self.write([changes for changes, owner, future in batch])
+                except YonderGitError as e:
+                    errors = [e] * len(batch)
+                for (changes, owner, future), error in zip(batch, errors):
+                    if future.done():
+                        continue
+                    if error is None:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(error)
+        finally:
+            self.writing = False
+
+    @staticmethod
+    def apply_changes(config, changes):
+        """
+        Applies `changes` to the `GitConfigFile` `config`, raising a
+        `YonderGitError`, before changing anything, if any cannot be made.
+        """
+        for change in changes:
+            if change[0] == "remote" and config.has_section("remote", change[1]):
+                raise YonderGitError('A remote called "%s" is already defined in the local repository.' % change[1])
+            if change[0] == "set" and config.count(*change[1:4]) > 1:
+                raise YonderGitError("Cannot overwrite the multiple values of %s.%s.%s with a single value." \
+                    % change[1:4])
+        for change in changes:
+            if change[0] == "remote":
+                config.add_section("remote", change[1], change[2])
+            else:
+                config.set(*change[1:])
+
+    async def write(self, change_sets):
+        """
+        Applies each of `change_sets` to the configuration file in a single
+        write, returning a list of the `YonderGitError` raised by each (or
+        None if it was applied).
+        """
+        lock_path = self.path + ".lock"
+        for attempt in range(self.lock_attempts):
+            try:
+                fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+                break
+            except FileExistsError:
+                await asyncio.sleep(self.lock_interval)
+            except OSError as e:
+                raise YonderGitError("Cannot lock local repository configuration: %s" % e)
+        else:
+            raise YonderGitError("Cannot lock local repository configuration: \"%s\" exists; "
+                "another git process seems to be running in this repository." % lock_path)
+        with tracer.span("write config", "in-process", path=self.path, host="localhost"):
+            try:
+                with os.fdopen(fd, "w") as stream:
+                    config = self.read()
+                    errors = []
+                    for changes in change_sets:
+                        try:
+                            self.apply_changes(config, changes)
+                            errors.append(None)
+                        except YonderGitError as e:
+                            errors.append(e)
+                    stream.write(config.text())
+                    os.fchmod(stream.fileno(), stat.S_IMODE(os.stat(self.path).st_mode))
+                os.replace(lock_path, self.path)
+            except (IOError, OSError) as e:
+                try:
+                    os.remove(lock_path)
+                except OSError:
+                    pass
+                raise YonderGitError("Cannot write local repository configuration: %s" % e)
+        return errors
+
+class LocalConfigs(object):
+    """
+    The `LocalConfig` of each local repository used in a run.
+    """
+
+    def __init__(self):
+        self.configs = {}
+
+    def get(self, local_repo):
+        """
+        Returns the `LocalConfig` of the repository containing `local_repo`,
+        raising a `YonderGitError` if there is none.
+        """
+        git_dir = find_git_dir(local_repo)
+        if git_dir is None:
+            raise YonderGitError('Error adding remote: "%s" is not in a git repository (have you run "git init" locally?).' % local_repo)
+        git_dir = os.path.realpath(git_dir)
+        if git_dir not in self.configs:
+            self.configs[git_dir] = LocalConfig(git_dir)
+        return self.configs[git_dir]
+
+local_configs = LocalConfigs()
+
+############################################################################
+## Remote state cache
+
+# number of seconds for which the cached state of a repository is used
+DEFAULT_CACHE_TTL = 60
+
+# cached states are kept on disk for at least this many seconds
+CACHE_RETENTION = 24 * 60 * 60
+
+def default_cache_path():
+    """
+    Returns the path of the remote state cache file.
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "ygit", "remote-state.json")
+
+class RemoteState(object):
+    """
+    Known state of the directory at a repository location: whether it
+    exists, is an accessible directory and is an initialized repository
+    (None if not known), as found at `time`.
+    """
+
+    def __init__(self, exists, isdir=None, initialized=None, time=None):
+        self.exists = exists
+        self.isdir = isdir
+        self.initialized = initialized
+        self.time = time
+
+    @property
+    def age(self):
+        return time.time() - self.time
+
+    def as_dict(self):
+        return {
+            "exists": self.exists,
+            "isdir": self.isdir,
+            "initialized": self.initialized,
+            "time": self.time,
+        }
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(exists=values.get("exists"),
+                   isdir=values.get("isdir"),
+                   initialized=values.get("initialized"),
+                   time=values.get("time", 0))
+
+class RemoteStateCache(object):
+    """
+    On-disk cache of the states of repositories, keyed by the canonical key
+    of their `RepositoryReference` (so that differently spelled URLs of the
+    same repository share an entry), so that repeatedly checking the same
+    repositories does not cost a round trip to their hosts each time. States
+    are used for "--cache-ttl" seconds, and neither used nor recorded with
+    "--no-cache". The entry of a repository is dropped whenever ygit
+    creates, initializes or deletes it, whether or not the cache is in use.
+    Only repositories on remote (ssh) hosts are cached: a local repository
+    is looked at again each time, which costs less than reading the cache,
+    and is never out of date.
+
+    Changes are written out at the end of the run, merged with the entries
+    written in the meantime by any other run.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = None
+        self.changes = {}
+        atexit.register(self.save)
+
+    @staticmethod
+    def key(repo_ref):
+        return json.dumps(list(repo_ref.canonical_key()))
+
+    @staticmethod
+    def enabled(opts, repo_ref):
+        return repo_ref.protocol == 'ssh' and getattr(opts, 'use_cache', False)
+
+    def cache_path(self):
+        if self.path is None:
+            self.path = default_cache_path()
+        return self.path
+
+    def read_entries(self):
+        """
+        Returns the entries in the cache file, or an empty dictionary if it
+        cannot be read.
+        """
+        try:
+            with open(self.cache_path(), "r") as stream:
+                entries = json.load(stream).get("entries", {})
+        except (IOError, OSError, ValueError, AttributeError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def get(self, repo_ref, opts):
+        """
+        Returns the cached `RemoteState` of `repo_ref`, or None if there is
+        no state younger than "--cache-ttl" seconds (or if the cache is not
+        in use, or `repo_ref` is not on a remote host).
+        """
+        if not self.enabled(opts, repo_ref):
+            return None
+        key = self.key(repo_ref)
+        if key in self.changes:
+            values = self.changes[key]
+        else:
+            if self.entries is None:
+                self.entries = self.read_entries()
+            values = self.entries.get(key)
+        if not isinstance(values, dict):
+            return None
+        state = RemoteState.from_dict(values)
+        if state.age > getattr(opts, 'cache_ttl', DEFAULT_CACHE_TTL) or state.age < 0:
+            return None
+        return state
+
+    def record(self, repo_ref, opts, exists, isdir=None, initialized=None):
+        """
+        Records the state of `repo_ref`, as just found (unless the cache is
+        not in use, or `repo_ref` is not on a remote host).
+        """
+        if self.enabled(opts, repo_ref):
+            state = RemoteState(exists, isdir=isdir, initialized=initialized, time=time.time())
+            self.changes[self.key(repo_ref)] = state.as_dict()
+
+    def invalidate(self, repo_ref):
+        """
+        Drops the cached state of `repo_ref`.
+        """
+        self.changes[self.key(repo_ref)] = None
+
+    def save(self):
+        """
+        Writes out the changes made during this run, if any.
+        """
+        if not self.changes:
+            return
+        path = self.cache_path()
+        if not any(self.changes.values()) and not os.path.exists(path):
+            self.changes = {}
+            return
+        entries = self.read_entries()
+        for key, values in self.changes.items():
+            if values is None:
+                entries.pop(key, None)
+            else:
+                entries[key] = values
+        self.changes = {}
+        cutoff = time.time() - CACHE_RETENTION
+        entries = dict((key, values) for key, values in entries.items()
+                if isinstance(values, dict) and values.get("time", 0) > cutoff)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".remote-state.")
+            with os.fdopen(fd, "w") as stream:
+                json.dump({"version": 1, "entries": entries}, stream, sort_keys=True)
+            os.replace(temp_path, path)
+        except (IOError, OSError):
+            # the cache is only an optimization
+            pass
+        self.entries = entries
+
+remote_state_cache = RemoteStateCache()
+
+############################################################################
+## Core remote handlers
+##
+## Each handler is a coroutine, so that any number of operations on any
+## number of repositories can be in flight at the same time on a single
+## event loop; the synchronous function of the same name (without the
+## "_async" suffix) runs the coroutine to completion.
+
+async def remote_exists_async(repo_ref, messenger, opts=None):
+    """
+    Checks if the directory at repo_ref exists. Returns a tuple, (exists,
+    error), where `exists` is True if it does, and `error` is True if the
+    host could not be reached. The remote state cache is used if `opts`
+    are given.
+    """
+    state = remote_state_cache.get(repo_ref, opts)
+    if state is not None:
+        return state.exists, False
+    if repo_ref.protocol == 'ssh':
+        script = RemoteScript(repo_ref)
+        script.add_phase("exists", "test -e %s" % quote_remote_path(repo_ref.repo_path), read_only=True)
+        reply = await script.run(messenger=messenger)
+        if not reply.connected:
+            if reply.stderr:
+                messenger.error(reply.stderr, newline=False)
+            return False, True
+        exists = reply.phase("exists").succeeded
+    else:
+        exists = os.path.exists(repo_ref.repo_path)
+    remote_state_cache.record(repo_ref, opts, exists)
+    return exists, False
+
+async def run_remote_script_async(script, messenger, opts):
+    """
+    Runs `script`, raising a `YonderGitError` if the host of the repository
+    could not be reached. Returns the `RemoteScriptReply`.
+    """
+    reply = await script.run(messenger=messenger)
+    if reply.interrupted:
+        report_phase_stderr(reply, messenger, opts)
+        raise YonderGitError(script.interruption(reply))
+    if not reply.connected:
+        if reply.stderr:
+            messenger.error(reply.stderr, newline=False)
+        raise YonderGitError("Error connnecting to: %s" % messenger.compose_repo_ref(script.repo_ref))
+    return reply
+
+def report_phase_stderr(reply, messenger, opts):
+    """
+    Passes on the standard error of the phases of `reply` to the user.
+    """
+    if opts.all_quiet:
+        return
+    for result in reply.phases:
+        if result.stderr:
+            messenger.error(result.stderr, newline=False)
+
+def add_check_phases(script, repo_ref):
+    """
+    Adds the phases inspecting the repository directory to `script`.
+    """
+    path = quote_remote_path(repo_ref.repo_path)
+    script.add_phase("exists", "test -e %s" % path, read_only=True)
+    script.add_phase("isdir", "cd %s" % path, read_only=True)
+
+def add_probe_phases(script, repo_ref):
+    """
+    Adds the phases inspecting the repository directory to `script`,
+    followed by one telling whether it is an initialized repository (which,
+    failing or not, is the last phase, and so does not affect the others).
+    """
+    path = quote_remote_path(repo_ref.repo_path)
+    add_check_phases(script, repo_ref)
+    script.add_phase("initialized", "test -f %s/HEAD || test -f %s/.git/HEAD" % (path, path), read_only=True)
+
+def reply_state(reply):
+    """
+    Returns the `RemoteState` found by the phases added by
+    `add_probe_phases`.
+    """
+    state = RemoteState(exists=reply.phase("exists").succeeded, time=time.time())
+    if state.exists:
+        state.isdir = reply.phase("isdir").succeeded
+    if state.isdir:
+        state.initialized = reply.phase("initialized").succeeded
+    return state
+
+def report_state(exists, isdir, repo_ref, messenger):
+    """
+    Reports whether the repository directory exists and is accessible,
+    raising a `YonderGitError` if it is missing or inaccessible.
+    """
+    if exists is not None and not exists:
+        raise YonderGitError("Repository not found at: %s" % messenger.compose_repo_ref(repo_ref))
+    messenger.ygit_info("Repository path exists.")
+    if isdir is not None and not isdir:
+        raise YonderGitError("Failed to enter directory: %s." % messenger.compose_repo_ref(repo_ref))
+    messenger.ygit_info("Repository path is an accessible directory.")
+
+def report_check(reply, repo_ref, messenger):
+    """
+    Reports the results of the phases added by `add_check_phases`, raising a
+    `YonderGitError` if the repository directory is missing or inaccessible.
+    """
+    def succeeded(name):
+        result = reply.phase(name)
+        if result is None:
+            return None
+        return result.succeeded
+    report_state(succeeded("exists"), succeeded("isdir"), repo_ref, messenger)
+
+def check_cached(repo_ref, messenger, opts):
+    """
+    Reports the state of the repository directory at `repo_ref` if it is
+    known from the remote state cache, raising a `YonderGitError` if it is
+    missing or inaccessible. Returns False if the state is not known.
+    """
+    state = remote_state_cache.get(repo_ref, opts)
+    if state is None or (state.exists and state.isdir is None):
+        return False
+    messenger.ygit_info("Checking: %s" % messenger.compose_repo_ref(repo_ref))
+    messenger.debug("Using state cached %.0fs ago." % state.age)
+    report_state(state.exists, state.isdir, repo_ref, messenger)
+    return True
+
+class RemoteStatus(object):
+    """
+    State of the directory at a repository location, as found by
+    `probe_remote_async`. `exists`, `isdir` and `initialized` are None if
+    they could not be determined, in which case `error` describes why.
+    `latency` is the time taken by the round trip to the host, and
+    `connect_time` that taken to set up the connection to the host
+    beforehand; both are None if the state was taken from the remote state
+    cache, in which case `cached` is True.
+    """
+
+    def __init__(self, url, host=None, exists=None, isdir=None, error=None, latency=None):
+        self.url = url
+        self.host = host
+        self.exists = exists
+        self.isdir = isdir
+        self.initialized = None
+        self.error = error
+        self.latency = latency
+        self.connect_time = None
+        self.cached = False
+
+    @classmethod
+    def from_state(cls, repo_ref, state):
+        """
+        Returns the status of `repo_ref` given by the cached `RemoteState`
+        `state`.
+        """
+        status = cls(url=repo_ref.url,
+                     host=host_label(repo_ref),
+                     exists=state.exists,
+                     isdir=state.isdir)
+        status.initialized = state.initialized
+        status.cached = True
+        return status
+
+    @property
+    def ok(self):
+        return self.error is None and bool(self.exists) and bool(self.isdir)
+
+    def describe_problem(self):
+        """
+        Returns a description of what is wrong with the repository location,
+        or None if nothing is.
+        """
+        if self.error is not None:
+            return self.error
+        if not self.exists:
+            return "Repository not found"
+        if not self.isdir:
+            return "Failed to enter directory"
+        return None
+
+    def as_dict(self):
+        def seconds(value):
+            if value is None:
+                return None
+            return round(value, 6)
+        return {
+            "url": self.url,
+            "host": self.host,
+            "exists": self.exists,
+            "isdir": self.isdir,
+            "initialized": self.initialized,
+            "ok": self.ok,
+            "error": self.describe_problem(),
+            "latency": seconds(self.latency),
+            "connect_time": seconds(self.connect_time),
+            "cached": self.cached,
+        }
+
+def host_label(repo_ref):
+    """
+    Returns a short description of the host of `repo_ref` for reports.
+    """
+    if repo_ref.protocol == 'file':
+        return "localhost"
+    label = "%s@%s" % (repo_ref.user, repo_ref.host)
+    if repo_ref.port:
+        label += ":%s" % repo_ref.port
+    return label
+
+async def probe_remote_async(repo_ref, messenger, opts=None):
+    """
+    Inspects the directory at `repo_ref` in a single round trip, returning a
+    `RemoteStatus`. Unlike `check_remote_async`, problems are recorded in the
+    returned status rather than raised. The state found is recorded in the
+    remote state cache if `opts` are given.
+    """
+    script = RemoteScript(repo_ref)
+    add_probe_phases(script, repo_ref)
+    start = time.time()
+    reply = await script.run(messenger=messenger)
+    status = RemoteStatus(url=repo_ref.url,
+                          host=host_label(repo_ref),
+                          latency=time.time() - start)
+    if not reply.connected:
+        error = "Error connnecting to: %s" % messenger.compose_repo_ref(repo_ref)
+        if reply.stderr.strip():
+            error += " (%s)" % reply.stderr.strip().splitlines()[-1]
+        status.error = error
+        return status
+    state = reply_state(reply)
+    status.exists = state.exists
+    status.isdir = state.isdir
+    status.initialized = state.initialized
+    remote_state_cache.record(repo_ref, opts, state.exists, state.isdir, state.initialized)
+    return status
+
+def add_init_phases(script, repo_ref, opts):
+    """
+    Adds the phases initializing the repository directory to `script`.
+    """
+    path = quote_remote_path(repo_ref.repo_path)
+    init_args = []
+    if opts.bare:
+        init_args.append("--bare")
+    if opts.shared:
+        init_args.append(shell_quote("--shared=" + opts.shared))
+    script.add_phase("init", "cd %s && git init %s" % (path, " ".join(init_args)))
+    script.add_phase("update-server-info", "cd %s && git update-server-info" % path)
+
+def report_init(reply, repo_ref, messenger, opts):
+    """
+    Reports the results of the phases added by `add_init_phases`, raising a
+    `YonderGitError` if initialization failed.
+    """
+    if repo_ref.protocol == 'ssh':
+        host = str(repo_ref.host)
+    else:
+        host = "localhost"
+    init = reply.phase("init")
+    if init is not None and init.stdout and not opts.all_quiet:
+        messenger.info("[%s] %s" % (host, init.stdout), newline=False)
+    for name in ("init", "update-server-info"):
+        result = reply.phase(name)
+        if result is not None and not result.succeeded:
+            raise YonderGitError("Error initializing repository.")
+
+def add_seed_phases(script, repo_ref, bundle, opts):
+    """
+    Adds the phases filling the newly-initialized repository with the
+    branches and tags in `bundle` to `script`, which must have the bundle as
+    its payload: the bundle is received into the git directory of the
+    repository, fetched from, and removed, and HEAD is pointed at the branch
+    checked out locally (which is also checked out, in a repository with a
+    working tree).
+    """
+    path = quote_remote_path(repo_ref.repo_path)
+    if opts.bare:
+        git_dir = ""
+    else:
+        git_dir = ".git/"
+    bundle_path = git_dir + "ygit-seed.bundle"
+    script.add_phase("receive", "cat <&3 > %s/%s" % (path, bundle_path),
+            rollback="rm -f %s/%s" % (path, bundle_path))
+    script.add_phase("unpack", "cd %s && git fetch -q --update-head-ok %s '+refs/*:refs/*'; ygit_rc=$?; rm -f %s %sFETCH_HEAD; exit $ygit_rc" \
+            % (path, bundle_path, bundle_path, git_dir))
+    if bundle.head is not None:
+        head = "cd %s && git symbolic-ref HEAD %s" % (path, shell_quote(bundle.head))
+        if not opts.bare:
+            head += " && git reset -q --hard"
+        script.add_phase("head", head)
+    script.add_phase("seed-server-info", "cd %s && git update-server-info" % path)
+
+def report_seed(reply, messenger):
+    """
+    Reports the results of the phases added by `add_seed_phases`, raising a
+    `YonderGitError` if seeding failed.
+    """
+    for name in ("receive", "unpack", "head", "seed-server-info"):
+        result = reply.phase(name)
+        if result is not None and not result.succeeded:
+            raise YonderGitError("Error seeding repository (in phase \"%s\")." % name)
+
+async def seed_remote_async(repo_ref, bundle, messenger, opts):
+    """
+    Fills the newly-initialized repository at `repo_ref` with the branches
+    and tags in `bundle`, in a script of its own (see `create_remote_async`
+    for seeding a repository as it is created).
+    """
+    messenger.ygit_info('Seeding: "%s"' % repo_ref.repo_path)
+    script = RemoteScript(repo_ref, payload=bundle.path)
+    add_seed_phases(script, repo_ref, bundle, opts)
+    reply = await run_remote_script_async(script, messenger, opts)
+    report_phase_stderr(reply, messenger, opts)
+    report_seed(reply, messenger)
+
+async def check_remote_async(repo_ref, messenger, opts):
+    """
+    Inspect remote.
+    """
+    if check_cached(repo_ref, messenger, opts):
+        return
+    messenger.ygit_info("Checking: %s" % messenger.compose_repo_ref(repo_ref))
+    script = RemoteScript(repo_ref)
+    add_probe_phases(script, repo_ref)
+    reply = await run_remote_script_async(script, messenger, opts)
+    state = reply_state(reply)
+    remote_state_cache.record(repo_ref, opts, state.exists, state.isdir, state.initialized)
+    report_check(reply, repo_ref, messenger)
+
+async def delete_remote_async(repo_ref, messenger, opts):
+    """
+    Delete repository ... USE WITH CAUTION!
+    """
+    if not await delete_remotes_async([repo_ref], messenger, opts):
+        raise YonderGitError("Error removing repository.")
+
+async def create_remote_async(repo_ref, messenger, opts, init=True, bundle=None):
+    """
+    Create and (optionally) initialize a new repository directory. The
+    existence check, directory creation and initialization are run as a
+    single remote script; if initialization fails, the newly-created
+    directory is removed again. If a `SeedBundle` is given, the new
+    repository is also filled from it by the same script, streamed the
+    bundle over the same connection, and is removed again if that fails.
+    """
+    remote_state_cache.invalidate(repo_ref)
+    path = quote_remote_path(repo_ref.repo_path)
+    templated = init and repository_templates.enabled(repo_ref, messenger, opts)
+    if bundle is not None and init and not templated:
+        script = RemoteScript(repo_ref, payload=bundle.path)
+    else:
+        script = RemoteScript(repo_ref)
+    script.add_phase("probe", "test ! -e %s" % path, read_only=True)
+    # the repository directory itself is created without "-p", so that
+    # exactly one of several concurrent attempts to create it succeeds
+    mkdir = "mkdir %s" % path
+    if repo_ref.dir_name:
+        mkdir = "mkdir -p %s && %s" % (quote_remote_path(repo_ref.dir_name), mkdir)
+    script.add_phase("mkdir", mkdir, rollback="rm -rf %s" % path)
+    if init:
+        add_init_phases(script, repo_ref, opts)
+        if script.payload is not None:
+            add_seed_phases(script, repo_ref, bundle, opts)
+    messenger.ygit_info('Creating remote directory: "%s"' % repo_ref.repo_path)
+    if templated:
+        reply = await repository_templates.create(repo_ref, messenger, opts)
+    else:
+        reply = await run_remote_script_async(script, messenger, opts)
+    probe = reply.phase("probe")
+    if probe is not None and not probe.succeeded:
+        raise YonderGitError("Repository already exists.\n"
+            + "Please delete the repository before proceeding, or use another location.")
+    report_phase_stderr(reply, messenger, opts)
+    mkdir = reply.phase("mkdir")
+    if mkdir is not None and not mkdir.succeeded:
+        raise YonderGitError("Error creating directory.")
+    if init:
+        report_init(reply, repo_ref, messenger, opts)
+        if script.payload is not None:
+            report_seed(reply, messenger)
+        elif bundle is not None:
+            await seed_remote_async(repo_ref, bundle, messenger, opts)
+
+async def init_remote_async(repo_ref, messenger, opts, check=True, bundle=None):
+    """
+    Initialize a new remote repository, and, if a `SeedBundle` is given,
+    fill it from the bundle (over the same connection).
+    """
+    remote_state_cache.invalidate(repo_ref)
+    payload = None
+    if bundle is not None:
+        payload = bundle.path
+    script = RemoteScript(repo_ref, payload=payload)
+    if check:
+        messenger.ygit_info("Checking: %s" % messenger.compose_repo_ref(repo_ref))
+        add_check_phases(script, repo_ref)
+    add_init_phases(script, repo_ref, opts)
+    if bundle is not None:
+        add_seed_phases(script, repo_ref, bundle, opts)
+    reply = None
+    if repository_templates.enabled(repo_ref, messenger, opts):
+        reply = await repository_templates.init(repo_ref, messenger, opts)
+    seeded = reply is None and bundle is not None
+    if reply is None:
+        reply = await run_remote_script_async(script, messenger, opts)
+    if check:
+        report_check(reply, repo_ref, messenger)
+    report_phase_stderr(reply, messenger, opts)
+    report_init(reply, repo_ref, messenger, opts)
+    if seeded:
+        report_seed(reply, messenger)
+    elif bundle is not None:
+        await seed_remote_async(repo_ref, bundle, messenger, opts)
+
+async def add_remote_async(remote_name, repo_ref, messenger, opts):
+    """
+    Add a new remote repository to the local one.
+    """
+    messenger.ygit_info("Adding \"%s\": \"%s\"" % (remote_name, repo_ref.url))
+    await local_configs.get(opts.local_repo).add_remote(remote_name, repo_ref.url, opts.mirror, messenger)
+
+async def configure_branch_async(remote_name, messenger, opts, branch_name='master'):
+    """
+    Configure the local branch `branch_name` to track the branch of the same
+    name on the remote `remote_name`.
+    """
+    messenger.ygit_info('Configuring branch "%s" for remote "%s"' % (branch_name, remote_name))
+    settings = [
+        ("branch.%s.remote" % branch_name, remote_name),
+        ("branch.%s.merge" % branch_name, "refs/heads/%s" % branch_name),
+    ]
+    await local_configs.get(opts.local_repo).set_values(settings, messenger, owner=remote_name)
+
+async def track_seeded_branches_async(remote_name, bundle, messenger, opts):
+    """
+    Records the branches in `bundle`, with which the repository of the
+    remote `remote_name` was seeded, as the branches of the remote in the
+    local repository (as "git push" would have, without a round trip to
+    fetch them), unless it is a mirror, and configures the branch checked
+    out locally to track its counterpart on the remote.
+    """
+    if not opts.mirror and bundle.refs:
+        commands = ["update refs/remotes/%s/%s %s\n" % (remote_name, branch, sha) for sha, branch in bundle.branches()]
+        argv = ["git", "-C", opts.local_repo, "update-ref", "--stdin"]
+        async with local_config_lock():
+            retcode, out, err = await command_runner.run(argv,
+                    messenger=messenger,
+                    input="".join(commands),
+                    label="localhost",
+                    details=[command.strip() for command in commands])
+        if retcode:
+            messenger.error(err, newline=False)
+            raise YonderGitError('Error recording the branches of remote "%s".' % remote_name)
+    if bundle.head_branch is not None:
+        await configure_branch_async(remote_name, messenger, opts, branch_name=bundle.head_branch)
+
+def remote_exists(repo_ref, messenger, opts=None):
+    return run_sync(remote_exists_async(repo_ref, messenger, opts))
+
+def check_remote(repo_ref, messenger, opts):
+    return run_sync(check_remote_async(repo_ref, messenger, opts))
+
+def delete_remote(repo_ref, messenger, opts):
+    return run_sync(delete_remote_async(repo_ref, messenger, opts))
+
+def create_remote(repo_ref, messenger, opts, init=True):
+    return run_sync(create_remote_async(repo_ref, messenger, opts, init=init))
+
+def init_remote(repo_ref, messenger, opts, check=True):
+    return run_sync(init_remote_async(repo_ref, messenger, opts, check=check))
+
+def add_remote(remote_name, repo_ref, messenger, opts):
+    return run_sync(add_remote_async(remote_name, repo_ref, messenger, opts))
+
+def configure_branch(remote_name, messenger, opts, branch_name='master'):
+    return run_sync(configure_branch_async(remote_name, messenger, opts, branch_name=branch_name))
+
+def show_urls_help(stream=sys.stdout):
+#    stream.write("=====================\n")
+#    stream.write("Repository URL Syntax\n")
+#    stream.write("=====================\n")
+    for transport, urls in EXAMPLE_URLS.items():
+        stream.write('\n{0:->{1}}'.format("", len(transport)))
+        stream.write('\n{0}'.format(transport))
+        stream.write('\n{0:->{1}}\n'.format("", len(transport)))
+        for u in urls:
+            stream.write('# %s\n' % u)
+
+def show_commands_help(stream=sys.stdout, show_more_help=True):
+    stream.write("""\
+
+==============================================================================
+YonderGit Commands
+=========================+====================================================
+setup <NAME> <REPO-URL>  | create and initialize a new repository at
+                         | <REPO-URL>, and add it as a remote called '<NAME>';
+                         | equivalent to "--create <REPO-URL>" followed by
+                         | "--add <NAME> <REPO-URL>"
+-------------------------+----------------------------------------------------
+create <REPO-URL>        | create a new directory at <REPO-URL> and initialize
+                         | it as a new repository (including running
+                         | "server-update-info")
+-------------------------+----------------------------------------------------
+init <REPO-URL>          | initialize existing remote directory at <REPO-URL>
+                         | as a repository
+-------------------------+----------------------------------------------------
+add <NAME> <REPO-URL>    | add repository at <REPO-URL> as a remote named
+                         | '<NAME>'
+-------------------------+----------------------------------------------------
+check <REPO-URL> [...]   | check the existence of an accessible directory given
+                         | specified by <REPO-URL>; if several are given
+                         | (see also '--url-file'), they are checked
+                         | concurrently, and a line reporting the status and
+                         | round-trip latency of each is written (as JSON if
+                         | '--json' is given)
+-------------------------+----------------------------------------------------
+list <REPO-URL> [...]    | list the repositories found anywhere under the
+                         | directory specified by <REPO-URL> (e.g.,
+                         | "user@host:/srv/git"), in a single round trip,
+                         | with whether each is bare, its '--shared' setting
+                         | and when it was last modified (as JSON if
+                         | '--json' is given)
+-------------------------+----------------------------------------------------
+delete <REPO-URL> [...]  | recursively delete the directory specified by
+                         | <REPO-URL> and all subdirectories; if several are
+                         | given (see also '--url-file'), all are deleted
+                         | after a single confirmation (see '--yes'), with
+                         | one remote command per host; with '--quarantine',
+                         | repositories are instead moved into a trash
+                         | directory on their host (see '--trash-dir'), to
+                         | be removed later by 'purge' (or straight away,
+                         | in the background, with '--background-purge')
+-------------------------+----------------------------------------------------
+purge <REPO-URL> [...]   | remove the repositories quarantined by 'delete'
+                         | more than '--older-than' ago from the trash
+                         | directory on the host of each <REPO-URL> (only
+                         | the host is used: e.g., "user@host:" or
+                         | "file:///")
+-------------------------+----------------------------------------------------
+push-all [<NAME> ...]    | push to all the remotes of the local repository (or
+                         | to those named) concurrently, giving up on any
+                         | push taking longer than '--push-timeout', and
+                         | write a table of the outcome of each (as JSON if
+                         | '--json' is given)
+-------------------------+----------------------------------------------------
+batch <FILE>             | run the commands listed in the manifest <FILE>
+                         | ("-" for standard input) concurrently, one
+                         | "<COMMAND> [OPTIONS] <ARGS>" per line; supports
+                         | the 'setup', 'create', 'init', 'add' and 'check'
+                         | commands
+-------------------------+----------------------------------------------------
+serve                    | run in the foreground, carrying out the 'setup',
+                         | 'create', 'init', 'add' and 'check' commands
+                         | forwarded by 'ygit-client.py' through the socket
+                         | given by '--socket', over ssh connections that
+                         | are kept open between commands
+=========================+====================================================
+""")
+    if show_more_help:
+        stream.write("""\
+See 'ygit.py help options' for help on options, or 'ygit.py help urls' for
+help on REPO-URL syntax.
+""")
+
+############################################################################
+## Concurrency limits
+
+class HostLimiter(object):
+    """
+    Limits the number of operations in flight at the same time, to at most
+    `jobs` overall, and at most `jobs_per_host` against any single host. An
+    operation waits for a slot on its host before taking one of the overall
+    slots, so operations queued against a saturated host do not hold up
+    operations on other hosts.
+    """
+
+    def __init__(self, jobs=8, jobs_per_host=4):
+        self.jobs = max(1, jobs)
+        self.jobs_per_host = max(1, jobs_per_host)
+        self.slots = None
+        self.host_slots = {}
+
+    @contextlib.asynccontextmanager
+    async def slot(self, host_key):
+        """
+        Asynchronous context manager holding a slot for an operation on the
+        host identified by `host_key`.
+        """
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.jobs)
+        if host_key not in self.host_slots:
+            self.host_slots[host_key] = asyncio.Semaphore(self.jobs_per_host)
+        async with self.host_slots[host_key]:
+            async with self.slots:
+                yield
+
+############################################################################
+## Execution plans
+##
+## When a run carries out many operations, those on the same host do not
+## each run a remote script of their own: under an `ExecutionPlan`, the
+## scripts that the operations on a host submit are held until every
+## operation on the host has either submitted one or finished, and are then
+## compiled into a single script (a `ScriptBatch`) run by one remote shell,
+## so that the number of round trips grows with the number of hosts rather
+## than the number of repositories. The reply of each script is parsed back
+## out of that of the batch, and handed to its operation as soon as the
+## script has finished on the host.
+
+# the host (a `PlannedHost`) whose plan runs the scripts of the current task
+planned_host = contextvars.ContextVar("ygit_planned_host", default=None)
+
+class ScriptBatch(RemoteScript):
+    """
+    The scripts of several operations on the same host, run by a single
+    shell. Each script is a group of its own, whose phases run (and are
+    rolled back) exactly as they would have by themselves, whatever the
+    outcome of the other groups. `entries` is a list of (script, number of
+    phases to run, messenger, future) tuples, one for each group: the future
+    is given the `RemoteScriptReply` of its script.
+    """
+
+    def __init__(self, repo_ref, entries):
+        RemoteScript.__init__(self, repo_ref)
+        self.entries = entries
+
+    def details(self):
+        details = []
+        for script, num_phases, messenger, future in self.entries:
+            for name, command, rollback, read_only in script.phases[:num_phases]:
+                details.append("[%s] [%s] %s" % (script.repo_ref.url, name, command))
+        return details
+
+    def phases_to_run(self, messenger):
+        return sum(num_phases for script, num_phases, messenger, future in self.entries)
+
+    def timeout(self):
+        return None
+
+    def idle_timeout(self):
+        # each group reports its start and the end of each of its phases as
+        # they happen, so that a host that hangs is given up after as long
+        # as a single script would have been, however many scripts the
+        # batch has
+        return host_health.command_timeout
+
+    def compile(self, num_phases=None):
+        lines = self.preamble()
+        for idx, (script, script_phases, messenger, future) in enumerate(self.entries):
+            lines.append('echo "%s group %d"' % (self.marker, idx))
+            lines.append('echo "%s start"' % self.marker)
+            lines += script.phase_lines(script_phases)
+            lines.append('echo "%s group-end %d"' % (self.marker, idx))
+        lines.append('rm -rf "$ygit_t"')
+        return "\n".join(lines) + "\n"
+
+    def parse_reply(self, reply):
+        # the reply of each group is parsed as the group finishes
+        return []
+
+    def trace_phases(self, timed_lines, start):
+        pass
+
+    def finish_group(self, idx, timed_lines, start, reply=None):
+        """
+        Hands the reply of the group `idx`, given the lines of its output
+        (paired with the times at which they were received), to its
+        operation. If `reply` (that of the whole batch) is given, the group
+        did not finish, and its reply is that of the batch.
+        """
+        script, num_phases, messenger, future = self.entries[idx]
+        if future.done():
+            return
+        if timed_lines and tracer.enabled:
+            script.trace_phases(timed_lines, start)
+        phases = script.parse_reply("".join(line + "\n" for received, line in timed_lines))
+        if reply is not None:
+            future.set_result(RemoteScriptReply(phases=phases,
+                    returncode=reply.returncode or 1,
+                    stderr=reply.stderr,
+                    dry_run=reply.dry_run,
+                    # (the remote shell may yet get to the group, if it
+                    # is still running the batch)
+                    started=reply.started))
+            return
+        failed = [result for result in phases if not result.succeeded]
+        future.set_result(RemoteScriptReply(phases=phases,
+                returncode=1 if failed else 0,
+                dry_run=messenger.dry_run,
+                started=True))
+
+    async def run_groups(self, messenger):
+        """
+        Runs the batch, handing the reply of each group to its operation as
+        soon as it is received.
+        """
+        groups = {}
+        current = []
+        def on_line(line):
+            if line.startswith(self.marker + " group "):
+                current[:] = [int(line.split()[2])]
+                groups[current[0]] = (time.time(), [])
+            elif line.startswith(self.marker + " group-end "):
+                idx = int(line.split()[2])
+                start, timed_lines = groups.pop(idx)
+                self.finish_group(idx, timed_lines, start)
+                current[:] = []
+            elif current:
+                groups[current[0]][1].append((time.time(), line))
+        reply = await self.execute(messenger, on_line=on_line)
+        for idx in range(len(self.entries)):
+            start, timed_lines = groups.get(idx, (None, []))
+            self.finish_group(idx, timed_lines, start, reply=reply)
+
+class PlannedHost(object):
+    """
+    The operations of an `ExecutionPlan` on the host identified by `key`,
+    and the scripts they have submitted but that have not been run yet.
+    """
+
+    def __init__(self, plan, key):
+        self.plan = plan
+        self.key = key
+        self.participants = 0
+        self.pending = []
+        self.running = False
+        self.wakeup = None
+
+    def notify(self):
+        if self.wakeup is not None and not self.wakeup.done():
+            self.wakeup.set_result(None)
+
+    def join(self):
+        """
+        Registers an operation on the host, which may submit scripts until
+        it calls `leave`.
+        """
+        self.participants += 1
+
+    def leave(self):
+        self.participants -= 1
+        self.notify()
+
+    async def run(self, script, messenger):
+        """
+        Runs `script` along with the scripts of the other operations on the
+        host, returning its `RemoteScriptReply`. A script streaming a payload
+        (or running nothing on a dry run) is run by itself.
+        """
+        num_phases = script.phases_to_run(messenger)
+        if script.payload is not None or num_phases == 0:
+            # the operation does not hold up the batch meanwhile
+            self.participants -= 1
+            self.notify()
+            try:
+                async with self.plan.limiter.slot(self.key):
+                    return await script.execute(messenger)
+            finally:
+                self.participants += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((script, num_phases, messenger, future))
+        self.notify()
+        if not self.running:
+            self.running = True
+            asyncio.ensure_future(self.run_pending())
+        return await future
+
+    async def run_pending(self):
+        """
+        Runs the scripts submitted, in batches, each as soon as every
+        operation on the host has submitted its script or finished.
+        """
+        try:
+            await asyncio.sleep(0)
+            while self.pending:
+                while len(self.pending) < self.participants:
+                    self.wakeup = asyncio.get_running_loop().create_future()
+                    await self.wakeup
+                entries, self.pending = self.pending, []
+                try:
+                    async with self.plan.limiter.slot(self.key):
+                        if len(entries) == 1:
+                            script, num_phases, messenger, future = entries[0]
+                            future.set_result(await script.execute(messenger))
+                        else:
+                            tracer.lane("batch on %s" % host_label(entries[0][0].repo_ref))
+                            await ScriptBatch(entries[0][0].repo_ref, entries).run_groups(self.plan.messenger)
+                except Exception as e:
+                    for script, num_phases, messenger, future in entries:
+                        if not future.done():
+                            future.set_exception(e)
+        finally:
+            self.running = False
+
+class ExecutionPlan(object):
+    """
+    Runs the remote scripts of the operations of a run host by host (see
+    above), within the limits of `limiter` (which apply to the scripts run
+    on each host, rather than to the operations). The batches are shown
+    with the messages of `messenger`.
+    """
+
+    def __init__(self, messenger, limiter):
+        self.messenger = messenger
+        self.limiter = limiter
+        self.hosts = {}
+
+    def host(self, repo_ref):
+        """
+        Returns the `PlannedHost` of the host of `repo_ref`.
+        """
+        key = repo_ref.host_key()
+        if key not in self.hosts:
+            self.hosts[key] = PlannedHost(self, key)
+        return self.hosts[key]
+
+    @contextlib.contextmanager
+    def participating(self, repo_ref):
+        """
+        Context manager for the part of an operation on `repo_ref` that runs
+        remote scripts, which are run by the plan. Nothing in its body may
+        wait for other operations on the same host.
+        """
+        host = self.host(repo_ref)
+        host.join()
+        token = planned_host.set(host)
+        try:
+            yield
+        finally:
+            planned_host.reset(token)
+            host.leave()
+
+############################################################################
+## Operation graphs
+##
+## A command carried out on a repository (an `Operation`) is made up of
+## steps (connecting to the host, making the seed bundle, running the remote
+## script, adding the remote, ...), each of which declares the steps it
+## depends on. An `OperationGraph` runs each step as soon as those it
+## depends on have succeeded, so that steps that do not depend on each
+## other (e.g., connecting to the host and making the seed bundle) run at
+## the same time. A step that fails cancels the steps that depend on it,
+## and only those.
+
+class OperationStep(object):
+    """
+    A step of an `Operation`, carried out by the coroutine function `action`
+    once all the steps in `depends_on` have succeeded. `round_trips` is the
+    number of round trips to the remote host that the step is expected to
+    take. `journaled` is False for steps that leave nothing behind (e.g.,
+    connecting to the host), whose completion is not recorded in batch
+    journals. Once the step has been run (or not), `state` is "done",
+    "failed" (with the exception raised in `error`) or "cancelled" (if a
+    step that it depends on did not succeed). `skipped` is True if the step
+    was taken to be done without running it (see `OperationGraph.skip`).
+    """
+
+    def __init__(self, name, action, depends_on=(), round_trips=0, journaled=True):
+        self.name = name
+        self.action = action
+        self.depends_on = list(depends_on)
+        self.round_trips = round_trips
+        self.journaled = journaled
+        self.state = None
+        self.error = None
+        self.skipped = False
+
+    def describe(self):
+        text = self.name
+        if self.depends_on:
+            text += " (after %s)" % ", ".join(step.name for step in self.depends_on)
+        if self.skipped:
+            text += " [done before]"
+        return text
+
+def path_cost(path):
+    """
+    Returns the expected cost of running the steps in `path` one after the
+    other, compared as the number of round trips they take, and then the
+    number of steps.
+    """
+    return (sum(step.round_trips for step in path), len(path))
+
+class OperationGraph(object):
+    """
+    The steps (`OperationStep` objects) of an operation, each listed after
+    all those that it depends on.
+    """
+
+    def __init__(self, steps):
+        self.steps = list(steps)
+
+    def critical_path(self):
+        """
+        Returns the longest chain of steps that depend on each other (as a
+        list of steps, first to last), which bounds the time taken to run
+        the graph however many steps are run at the same time.
+        """
+        longest = {}
+        for step in self.steps:
+            before = max([longest[dep] for dep in step.depends_on] + [[]], key=path_cost)
+            if step.skipped:
+                longest[step] = before
+            else:
+                longest[step] = before + [step]
+        return max(list(longest.values()) + [[]], key=path_cost)
+
+    def skip(self, completed):
+        """
+        Marks the steps named in `completed` (the names of journaled steps
+        done by an earlier run) as done without running them, along with
+        each step that is not journaled and that only such steps depend on.
+        """
+        for step in self.steps:
+            if step.journaled and step.name in completed:
+                step.state = "done"
+                step.skipped = True
+        for step in reversed(self.steps):
+            if step.skipped or step.journaled:
+                continue
+            dependents = [other for other in self.steps if step in other.depends_on]
+            if dependents and all(other.skipped for other in dependents):
+                step.state = "done"
+                step.skipped = True
+
+    async def run(self, settled=None):
+        """
+        Runs the steps, each as soon as all those it depends on have
+        succeeded, and returns once all of them have been run or
+        cancelled. A step raising a `YonderGitError` fails, and any other
+        exception is propagated once all the steps are done. If `settled` is
+        given, it is called with each step once it is done, has failed, or
+        has been cancelled.
+        """
+        tasks = {}
+        async def run_step(step):
+            try:
+                if step.skipped:
+                    return
+                if step.depends_on:
+                    await asyncio.wait([tasks[dep] for dep in step.depends_on])
+                if any(dep.state != "done" for dep in step.depends_on):
+                    step.state = "cancelled"
+                    return
+                try:
+                    await step.action()
+                except YonderGitError as e:
+                    step.state = "failed"
+                    step.error = e
+                    return
+                except BaseException as e:
+                    step.state = "failed"
+                    step.error = e
+                    raise
+                step.state = "done"
+            finally:
+                if settled is not None:
+                    settled(step)
+        for step in self.steps:
+            tasks[step] = asyncio.ensure_future(run_step(step))
+        await asyncio.gather(*tasks.values())
+
+class Operation(object):
+    """
+    The command `command` ("setup", "create", "init", "add", "check" or
+    "delete") carried out on the repository at `repo_ref`, as an
+    `OperationGraph`. If `connections` is given, the connection to the host
+    is set up first (unless the command only changes the local
+    repository). If an `ExecutionPlan` is given, the remote scripts of the
+    command are run by the plan. If a `BatchJournal` is given, each
+    journaled step is recorded in it once done.
+    """
+
+    def __init__(self, command, remote_name, repo_ref, messenger, opts, connections=None, plan=None, journal=None):
+        self.command = command
+        self.remote_name = remote_name
+        self.repo_ref = repo_ref
+        self.messenger = messenger
+        self.opts = opts
+        self.connections = connections
+        self.plan = plan
+        self.journal = journal
+        self.key = BatchJournal.key(command, remote_name, repo_ref)
+        self.bundle = None
+        self.host = None
+        self.remote_step = None
+        self.add_step = None
+        self.graph = OperationGraph(self.plan_steps())
+
+    def describe(self):
+        parts = [self.command]
+        if self.remote_name is not None:
+            parts.append(self.remote_name)
+        parts.append(self.repo_ref.url)
+        return " ".join(parts)
+
+    def plan_steps(self):
+        """
+        Returns the steps of the operation, each after those it depends on.
+        """
+        steps = []
+        remote_deps = []
+        if self.command != 'add':
+            if self.connections is not None:
+                connect = OperationStep("connect", self.connect,
+                        round_trips=1 if self.repo_ref.protocol == 'ssh' else 0,
+                        journaled=False)
+                steps.append(connect)
+                remote_deps.append(connect)
+            if self.command in ['setup', 'create', 'init'] \
+                    and (self.opts.seed or (self.command == 'setup' and self.opts.push)):
+                # made before anything is created, so that no repository is
+                # created if it cannot be
+                bundle = OperationStep("bundle", self.make_bundle, journaled=False)
+                steps.append(bundle)
+                remote_deps.append(bundle)
+            if self.command == 'setup':
+                name = 'create'
+            else:
+                name = self.command
+            # (checking a repository leaves nothing behind, and is done
+            # again on resuming)
+            self.remote_step = OperationStep(name, self.run_remote, depends_on=remote_deps, round_trips=1,
+                                             journaled=self.command != 'check')
+            steps.append(self.remote_step)
+        if self.command in ['setup', 'add']:
+            # the remote is added once the repository has been created (for
+            # "setup"), and straight away for "add"
+            self.add_step = OperationStep("add", self.add_remote, depends_on=steps[-1:])
+            steps.append(self.add_step)
+            if self.command == 'setup' and self.opts.push:
+                # (the branches tracked are those of the bundle)
+                steps.append(OperationStep("track", self.track_branches, depends_on=[self.add_step, bundle]))
+        return steps
+
+    async def connect(self):
+        with tracer.span("connect", "operation", host=host_label(self.repo_ref)):
+            self.repo_ref = await connect_repo_ref_async(self.repo_ref, self.connections)
+
+    async def make_bundle(self):
+        self.bundle = await seed_bundles.bundle(self.messenger, self.opts)
+
+    async def run_remote(self):
+        if self.host is not None:
+            # (only for the task running this step)
+            planned_host.set(self.host)
+        if self.command == 'check':
+            await check_remote_async(repo_ref=self.repo_ref, messenger=self.messenger, opts=self.opts)
+        elif self.command == 'delete':
+            await delete_remote_async(repo_ref=self.repo_ref, messenger=self.messenger, opts=self.opts)
+        elif self.command in ['setup', 'create']:
+            await create_remote_async(repo_ref=self.repo_ref,
+                                      messenger=self.messenger,
+                                      opts=self.opts,
+                                      init=True,
+                                      bundle=self.bundle)
+        elif self.command == 'init':
+            await init_remote_async(repo_ref=self.repo_ref,
+                                    messenger=self.messenger,
+                                    opts=self.opts,
+                                    check=True,
+                                    bundle=self.bundle)
+
+    async def add_remote(self):
+        assert self.remote_name is not None
+        await add_remote_async(self.remote_name, self.repo_ref, self.messenger, self.opts)
+
+    async def track_branches(self):
+        await track_seeded_branches_async(self.remote_name, self.bundle, self.messenger, self.opts)
+
+    def settled(self, step):
+        if self.journal is not None and step.state == "done" and step.journaled and not step.skipped:
+            self.journal.record(self, step)
+        if step is self.remote_step and self.host is not None:
+            # no more scripts to run: the other operations on the host no
+            # longer wait for this one
+            self.host.leave()
+            self.host = None
+
+    async def run(self):
+        """
+        Runs the steps of the operation, raising the error of the first
+        step (in the order of the steps) that failed, if any.
+        """
+        tracer.lane("%s %s" % (self.command, self.repo_ref.url))
+        with tracer.span(self.command, "operation", url=self.repo_ref.url), contextlib.ExitStack() as reservations:
+            if self.command == 'check' and check_cached(self.repo_ref, self.messenger, self.opts):
+                return
+            if self.add_step is not None and not self.add_step.skipped:
+                # a remote that cannot be added is reported before anything
+                # is created (the name is held until it is added, so that no
+                # other operation of the run takes it meanwhile)
+                reservations.enter_context(local_configs.get(self.opts.local_repo).reserving_remote(self.remote_name))
+            if self.plan is not None and self.remote_step is not None and not self.remote_step.skipped:
+                self.host = self.plan.host(self.repo_ref)
+                self.host.join()
+            await self.graph.run(settled=self.settled)
+        for step in self.graph.steps:
+            if step.state == "failed":
+                raise step.error
+
+def show_operation_graphs(operations, messenger):
+    """
+    Writes the steps of each of `operations` (a list of (label, `Operation`)
+    pairs), with the steps that each depends on, followed by the critical
+    path of the one expected to take longest.
+    """
+    messenger.info("Planned steps:")
+    longest = None
+    for label, operation in operations:
+        messenger.info("  %s" % label)
+        for step in operation.graph.steps:
+            messenger.info("      %s" % step.describe())
+        path = operation.graph.critical_path()
+        if longest is None or path_cost(path) > path_cost(longest[1]):
+            longest = (label, path)
+    if longest is None:
+        return
+    label, path = longest
+    if len(operations) > 1:
+        prefix = "%s: " % label
+    else:
+        prefix = ""
+    messenger.info("Predicted critical path: %s%s (%d steps, %d round trips)" \
+        % (prefix, " -> ".join(step.name for step in path), len(path), path_cost(path)[0]))
+
+############################################################################
+## Checking many repositories
+
+def read_url_list(path):
+    """
+    Returns the list of repository URLs listed in the file at `path` ("-"
+    for standard input), one per line. Blank lines and anything following a
+    "#" are ignored.
+    """
+    if path == "-":
+        lines = sys.stdin.readlines()
+    else:
+        try:
+            with open(path, "r") as stream:
+                lines = stream.readlines()
+        except IOError as e:
+            raise YonderGitError("Cannot open URL list: %s" % e)
+    urls = []
+    for line in lines:
+        line = line.split("#", 1)[0].strip()
+        if line:
+            urls.append(line)
+    return urls
+
+async def check_remotes_async(urls, connections, messenger, opts):
+    """
+    Checks all the repositories at `urls` concurrently, subject to the
+    "--jobs" and "--jobs-per-host" limits, carrying on past any failures.
+    Unless "--no-plan" is given, the checks of the repositories on each host
+    are run as one script, under those limits. The status of each repository
+    is written as soon as it is known, either as a line of text or, with
+    "--json", as a JSON object on a line of its own. Without "--json", a
+    summary of latencies by host follows.
+    Repositories whose state is in the remote state cache are not checked
+    again. Returns True if all the repositories exist and are accessible
+    directories.
+    """
+    limiter = HostLimiter(jobs=opts.jobs, jobs_per_host=opts.jobs_per_host)
+    plan = None
+    if opts.plan:
+        plan = ExecutionPlan(messenger, limiter)
+    statuses = []
+    async def check(url):
+        tracer.lane("check %s" % url)
+        try:
+            repo_ref = parse_repo_url('check', url)
+        except YonderGitError as e:
+            status = RemoteStatus(url=url, error=str(e))
+        else:
+            state = remote_state_cache.get(repo_ref, opts)
+            if state is not None and (state.isdir is not None or not state.exists):
+                status = RemoteStatus.from_state(repo_ref, state)
+                status.url = url
+            else:
+                status = None
+        if status is None:
+            async with contextlib.AsyncExitStack() as stage:
+                if plan is None:
+                    await stage.enter_async_context(limiter.slot(repo_ref.host_key()))
+                else:
+                    stage.enter_context(plan.participating(repo_ref))
+                start = time.time()
+                with tracer.span("connect", "operation", host=host_label(repo_ref)):
+                    repo_ref = await connect_repo_ref_async(repo_ref, connections)
+                connect_time = time.time() - start
+                status = await probe_remote_async(repo_ref, messenger, opts)
+                status.connect_time = connect_time
+        statuses.append(status)
+        if opts.json:
+            messenger.info(json.dumps(status.as_dict(), sort_keys=True))
+        else:
+            if status.ok:
+                result = "OK"
+                detail = ""
+            else:
+                result = "FAILED"
+                detail = ": " + status.describe_problem()
+            if status.cached:
+                latency = "  cached"
+            elif status.latency is None:
+                latency = "       -"
+            else:
+                latency = "%7.3fs" % status.latency
+            messenger.info("%6s %s  %s%s" % (result, latency, url, detail))
+    await asyncio.gather(*[check(url) for url in urls])
+    if not opts.json:
+        report_host_latencies(statuses, messenger)
+    for status in statuses:
+        if not status.ok:
+            return False
+    return True
+
+def report_host_latencies(statuses, messenger):
+    """
+    Writes a summary, by host, of the latencies of `statuses`.
+    """
+    hosts = {}
+    for status in statuses:
+        if status.latency is not None:
+            hosts.setdefault(status.host, []).append(status)
+    if not hosts:
+        return
+    messenger.info("\n%-32s %6s %6s %9s %9s %9s" % ("Host", "Repos", "Failed", "Min", "Mean", "Max"))
+    for host in sorted(hosts):
+        latencies = [status.latency for status in hosts[host]]
+        failed = len([status for status in hosts[host] if not status.ok])
+        messenger.info("%-32s %6d %6d %8.3fs %8.3fs %8.3fs" \
+            % (host,
+               len(latencies),
+               failed,
+               min(latencies),
+               sum(latencies) / len(latencies),
+               max(latencies)))
+
+############################################################################
+## Deleting repositories
+
+# exit codes of the remote command deleting a repository if the repository
+# does not exist, and if it cannot be moved into the trash directory
+# without copying it
+DELETE_MISSING = 3
+DELETE_CROSS_DEVICE = 4
+
+# default location, on each host, of the directory into which repositories
+# are moved by "delete --quarantine"
+DEFAULT_TRASH_DIR = "~/.ygit-trash"
+
+# names of quarantined repositories start with the time of their deletion
+QUARANTINE_NAME_PATTERN = re.compile(r'^(\d+)\.[0-9a-f]+\.')
+
+def quarantine_name(repo_ref, now=None):
+    """
+    Returns the name under which the repository at `repo_ref` is kept in
+    the trash directory: the time of deletion (in seconds since the epoch),
+    a random tag and the name of the repository directory.
+    """
+    if now is None:
+        now = time.time()
+    return "%d.%s.%s" % (now, os.urandom(4).hex(), posixpath.basename(repo_ref.repo_path.rstrip("/")))
+
+def trash_dir_path(repo_ref, trash_dir):
+    """
+    Returns the path of the trash directory `trash_dir` on the host of
+    `repo_ref`; "~" is expanded here for local repositories, and by the
+    remote shell otherwise.
+    """
+    if repo_ref.protocol == 'file':
+        return os.path.expanduser(trash_dir)
+    return trash_dir
+
+class DeleteResult(object):
+    """
+    Outcome of the deletion of a single repository: `result` is one of
+    "deleted", "quarantined" (in which case `location` is where the
+    repository was moved to), "missing", "failed" or, on a dry run,
+    "skipped".
+    """
+
+    def __init__(self, repo_ref, result, error=None, location=None):
+        self.repo_ref = repo_ref
+        self.result = result
+        self.error = error
+        self.location = location
+
+    def as_dict(self):
+        return {
+            "url": self.repo_ref.url,
+            "host": host_label(self.repo_ref),
+            "result": self.result,
+            "error": self.error,
+            "location": self.location,
+        }
+
+async def confirm_async(messenger, opts, prompt="Continue (y/N)? "):
+    """
+    Asks the user to confirm an operation, returning True if they do (or if
+    "--yes" was given).
+    """
+    if getattr(opts, 'assume_yes', False):
+        return True
+    messenger.critical(prompt, newline=False)
+    messenger.stdout.flush()
+    answer = await asyncio.get_running_loop().run_in_executor(None, sys.stdin.readline)
+    return answer.lower().startswith("y")
+
+def remove_local_repository(path):
+    """
+    Removes the file or directory tree at `path`, as "rm -r" would. Returns
+    a `DeleteResult` result and error message.
+    """
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        return "missing", None
+    except OSError as e:
+        return "failed", str(e)
+    return "deleted", None
+
+def quarantine_local_repository(path, trash_dir, name):
+    """
+    Moves the local repository at `path` into `trash_dir` under `name`.
+    Returns a `DeleteResult` result and error message.
+    """
+    if not os.path.lexists(path):
+        return "missing", None
+    try:
+        os.makedirs(trash_dir, exist_ok=True)
+        os.rename(path, os.path.join(trash_dir, name))
+    except OSError as e:
+        if e.errno == errno.EXDEV:
+            return "failed", "not on the same filesystem as the trash directory, %s (see \"--trash-dir\")" % trash_dir
+        return "failed", str(e)
+    return "quarantined", None
+
+class DeletionPlan(object):
+    """
+    The repositories to be deleted, grouped by host. All the repositories on
+    a remote host are deleted by a single remote script (with each
+    repository deleted by a phase of its own, independently of the
+    others), while local repositories are removed in-process, in parallel.
+
+    If `trash_dir` is given, repositories are not removed but quarantined:
+    renamed into the trash directory on their host, which is instantaneous
+    whatever their size. A repository that is on a different filesystem
+    from the trash directory is not moved (as that would mean copying it),
+    and fails to be deleted instead. Quarantined repositories are removed
+    later by the "purge" command or, if `background_purge` is True, by a
+    process started in the background on their host straight away.
+    """
+
+    def __init__(self, groups, trash_dir=None, background_purge=False):
+        self.groups = groups
+        self.trash_dir = trash_dir
+        self.background_purge = background_purge
+        self.names = {}
+        self.scripts = {}
+        now = time.time()
+        for key, repo_refs in groups.items():
+            if trash_dir is not None:
+                for repo_ref in repo_refs:
+                    self.names[repo_ref] = quarantine_name(repo_ref, now)
+            if repo_refs[0].protocol != 'ssh':
+                continue
+            script = RemoteScript(repo_refs[0], keep_going=True)
+            for repo_ref in repo_refs:
+                script.add_phase(repo_ref.url, self.remote_command(repo_ref))
+            self.scripts[key] = script
+
+    def __len__(self):
+        return sum(len(repo_refs) for repo_refs in self.groups.values())
+
+    def location(self, repo_ref):
+        """
+        Returns the path that the repository at `repo_ref` is quarantined
+        at.
+        """
+        return posixpath.join(trash_dir_path(repo_ref, self.trash_dir), self.names[repo_ref])
+
+    def remote_command(self, repo_ref):
+        """
+        Returns the shell command deleting the remote repository `repo_ref`.
+        """
+        path = quote_remote_path(repo_ref.repo_path)
+        if self.trash_dir is None:
+            return "test -e %s || exit %d; rm -r %s" % (path, DELETE_MISSING, path)
+        trash_dir = quote_remote_path(self.trash_dir)
+        location = quote_remote_path(self.location(repo_ref))
+        command = "test -e %s || exit %d; mkdir -p %s || exit 1; " % (path, DELETE_MISSING, trash_dir) \
+            + "[ \"$(df -P %s | awk 'NR==2 {print $6}')\" = \"$(df -P %s | awk 'NR==2 {print $6}')\" ] " % (path, trash_dir) \
+            + "|| { echo 'not on the same filesystem as the trash directory, %s (see \"--trash-dir\")' >&2; exit %d; }; " \
+                % (self.trash_dir.replace("'", ""), DELETE_CROSS_DEVICE) \
+            + "mv %s %s" % (path, location)
+        if self.background_purge:
+            command += " && { rm -rf %s > /dev/null 2>&1 < /dev/null & }" % location
+        return command
+
+    def local_commands(self, repo_ref):
+        """
+        Returns the shell commands equivalent to the in-process deletion of
+        the local repository `repo_ref`, for display.
+        """
+        path = shell_quote(repo_ref.repo_path)
+        if self.trash_dir is None:
+            return ["rm -r %s" % path]
+        location = shell_quote(self.location(repo_ref))
+        commands = ["mv %s %s" % (path, location)]
+        if self.background_purge:
+            commands.append("rm -rf %s &" % location)
+        return commands
+
+    def show(self, messenger):
+        """
+        Writes out everything that is about to be executed.
+        """
+        if self.trash_dir is None:
+            action = "delete"
+        else:
+            action = "quarantine"
+        messenger.critical("About to %s %d repositor%s:" % (action, len(self), "y" if len(self) == 1 else "ies"))
+        for key, repo_refs in self.groups.items():
+            if key in self.scripts:
+                script = self.scripts[key]
+                messenger.critical("    %s" % format_argv(script.argv()))
+                for name, command, rollback, read_only in script.phases:
+                    messenger.critical("        %s" % command)
+            else:
+                messenger.critical("    (on localhost)")
+                for repo_ref in repo_refs:
+                    for command in self.local_commands(repo_ref):
+                        messenger.critical("        %s" % command)
+
+    async def delete_on_host(self, key, messenger):
+        """
+        Deletes the repositories on the remote host `key`, returning a list
+        of `DeleteResult` objects.
+        """
+        script = self.scripts[key]
+        reply = await script.run(messenger=messenger)
+        results = []
+        for repo_ref in self.groups[key]:
+            phase = reply.phase(repo_ref.url)
+            if phase is None and not reply.connected:
+                # (if the script was cut off, those it got to are reported)
+                error = "Error connnecting to: %s" % host_label(repo_ref)
+                if reply.stderr.strip():
+                    error += " (%s)" % reply.stderr.strip().splitlines()[-1]
+                results.append(DeleteResult(repo_ref, "failed", error))
+                continue
+            if phase is None:
+                results.append(DeleteResult(repo_ref, "skipped"))
+            elif phase.succeeded and self.trash_dir is not None:
+                results.append(DeleteResult(repo_ref, "quarantined", location=self.location(repo_ref)))
+            elif phase.succeeded:
+                results.append(DeleteResult(repo_ref, "deleted"))
+            elif phase.returncode == DELETE_MISSING:
+                results.append(DeleteResult(repo_ref, "missing"))
+            else:
+                results.append(DeleteResult(repo_ref, "failed", phase.stderr.strip() or None))
+        return results
+
+    async def delete_local(self, repo_ref, messenger, limiter):
+        """
+        Removes (or quarantines) the local repository `repo_ref` in a worker
+        thread, returning its `DeleteResult`.
+        """
+        if self.trash_dir is None:
+            async with limiter.slot(repo_ref.host_key()):
+                with command_runner.step("rm -r %s" % shell_quote(repo_ref.repo_path), messenger, label="localhost"):
+                    if messenger.dry_run:
+                        return DeleteResult(repo_ref, "skipped")
+                    result, error = await asyncio.get_running_loop().run_in_executor(None,
+                            remove_local_repository, repo_ref.repo_path)
+            return DeleteResult(repo_ref, result, error)
+        location = self.location(repo_ref)
+        with command_runner.step("mv %s %s" % (shell_quote(repo_ref.repo_path), shell_quote(location)), messenger, label="localhost"):
+            if messenger.dry_run:
+                return DeleteResult(repo_ref, "skipped")
+            result, error = quarantine_local_repository(repo_ref.repo_path,
+                    trash_dir_path(repo_ref, self.trash_dir),
+                    self.names[repo_ref])
+        if result != "quarantined":
+            return DeleteResult(repo_ref, result, error)
+        if self.background_purge:
+            command_runner.spawn(["rm", "-rf", location], messenger=messenger, label="localhost")
+        return DeleteResult(repo_ref, result, location=location)
+
+    async def run(self, messenger, limiter):
+        """
+        Deletes all the repositories of the plan, on all hosts at the same
+        time, returning a list of `DeleteResult` objects.
+        """
+        tasks = []
+        for key, repo_refs in self.groups.items():
+            if key in self.scripts:
+                async def delete_on_host(key=key):
+                    tracer.lane("delete on %s" % host_label(self.groups[key][0]))
+                    async with limiter.slot(key):
+                        return await self.delete_on_host(key, messenger)
+                tasks.append(delete_on_host())
+            else:
+                async def delete_local(repo_refs=repo_refs):
+                    tracer.lane("delete on localhost")
+                    return await asyncio.gather(*[self.delete_local(repo_ref, messenger, limiter) for repo_ref in repo_refs])
+                tasks.append(delete_local())
+        results = []
+        for host_results in await asyncio.gather(*tasks):
+            results.extend(host_results)
+        return results
+
+async def delete_remotes_async(repo_refs, messenger, opts, connections=None):
+    """
+    Deletes (or, with "--quarantine", quarantines) the repositories at
+    `repo_refs` after showing the plan and asking for a single
+    confirmation, reporting the outcome for each repository (as JSON with
+    "--json"). If `connections` is given, the connections to the hosts are
+    set up first. Returns True if no deletion failed (repositories that do
+    not exist are reported, but are not failures).
+    """
+    groups = group_by_host(repo_refs)
+    for repo_ref in repo_refs:
+        remote_state_cache.invalidate(repo_ref)
+    if connections is not None:
+        async def connect(key):
+            groups[key][0] = await connect_repo_ref_async(groups[key][0], connections)
+        await asyncio.gather(*[connect(key) for key in groups])
+    background_purge = getattr(opts, 'background_purge', False)
+    if getattr(opts, 'quarantine', False) or background_purge:
+        plan = DeletionPlan(groups,
+                trash_dir=getattr(opts, 'trash_dir', DEFAULT_TRASH_DIR),
+                background_purge=background_purge)
+        done = "quarantined"
+    else:
+        plan = DeletionPlan(groups)
+        done = "deleted"
+    plan.show(messenger)
+    if not await confirm_async(messenger, opts):
+        raise YonderGitError("Cancelling.")
+    limiter = HostLimiter(jobs=getattr(opts, 'jobs', 8), jobs_per_host=getattr(opts, 'jobs_per_host', 4))
+    results = await plan.run(messenger, limiter)
+    counts = {}
+    for result in results:
+        counts[result.result] = counts.get(result.result, 0) + 1
+        if getattr(opts, 'json', False):
+            messenger.info(json.dumps(result.as_dict(), sort_keys=True))
+        elif result.result == "failed":
+            messenger.error("%11s %s: %s" % ("FAILED", result.repo_ref.url, result.error or "error removing repository"))
+        elif result.result == "missing":
+            messenger.error("%11s %s: repository not found" % ("MISSING", result.repo_ref.url))
+        elif not opts.all_quiet and result.location is not None:
+            messenger.info("%11s %s -> %s" % (result.result.upper(), result.repo_ref.url, result.location))
+        elif not opts.all_quiet:
+            messenger.info("%11s %s" % (result.result.upper(), result.repo_ref.url))
+    if not getattr(opts, 'json', False):
+        messenger.ygit_info("%d %s, %d not found, %d failed%s." % (counts.get(done, 0),
+                done,
+                counts.get("missing", 0),
+                counts.get("failed", 0),
+                ", %d skipped (dry run)" % counts["skipped"] if "skipped" in counts else ""))
+        if counts.get(done):
+            messenger.info("Repositories %s, but may still be referenced in local." % done)
+            messenger.info('Use "git remote rm <name>" to remove references.')
+            if done == "quarantined" and not background_purge:
+                messenger.info('Use "ygit.py purge" to remove quarantined repositories for good.')
+    return not counts.get("failed")
+
+async def delete_urls_async(urls, connections, messenger, opts):
+    """
+    Deletes the repositories at `urls`. All the URLs are validated before
+    anything is deleted.
+    """
+    if opts.url_file == "-" and not opts.assume_yes:
+        raise YonderGitError('Reading URLs from standard input requires "--yes", as confirmation is read from there too')
+    repo_refs = parse_repo_urls('delete', urls)
+    return await delete_remotes_async(repo_refs, messenger, opts, connections=connections)
+
+def parse_repo_urls(command, urls):
+    """
+    Parses all of `urls` with `parse_repo_url`, raising a `YonderGitError`
+    listing every invalid URL if any are found.
+    """
+    repo_refs = []
+    errors = []
+    for url in urls:
+        try:
+            repo_refs.append(parse_repo_url(command, url))
+        except YonderGitError as e:
+            errors.append("%s: %s" % (url, e))
+    if errors:
+        raise YonderGitError("Invalid repository URL(s):\n    " + "\n    ".join(errors))
+    return repo_refs
+
+############################################################################
+## Purging quarantined repositories
+
+AGE_UNITS = {
+    's': 1,
+    'm': 60,
+    'h': 60 * 60,
+    'd': 24 * 60 * 60,
+    'w': 7 * 24 * 60 * 60,
+}
+
+def parse_age(text):
+    """
+    Parses an age such as "90s", "30m", "12h", "7d" or "2w" (a number
+    without a unit is in days) into a number of seconds.
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d*)?)\s*([smhdw]?)\s*$', text)
+    if match is None:
+        raise YonderGitError('Invalid age: "%s" (expecting, e.g., "12h" or "7d")' % text)
+    return float(match.group(1)) * AGE_UNITS[match.group(2) or 'd']
+
+class PurgeResult(object):
+    """
+    Outcome of purging the trash directory on a single host: `entries` are
+    the paths of the quarantined repositories that were (or, on a dry run,
+    would have been) removed.
+    """
+
+    def __init__(self, host, entries=None, error=None, dry_run=False):
+        self.host = host
+        self.entries = entries or []
+        self.error = error
+        self.dry_run = dry_run
+
+    def as_dict(self):
+        return {
+            "host": self.host,
+            "purged": self.entries,
+            "error": self.error,
+            "dry_run": self.dry_run,
+        }
+
+def trash_loop_command(trash_dir, cutoff, action):
+    """
+    Returns a shell command running `action` on each entry (in "$ygit_e")
+    of `trash_dir` quarantined before the time `cutoff`.
+    """
+    return 'for ygit_e in %s/[0-9]*.*; do ' % quote_remote_path(trash_dir.rstrip("/")) \
+        + '[ -e "$ygit_e" ] || continue; ' \
+        + 'ygit_n=${ygit_e##*/}; ygit_n=${ygit_n%%.*}; ' \
+        + 'case $ygit_n in *[!0-9]*) continue;; esac; ' \
+        + '[ "$ygit_n" -lt %d ] && %s; ' % (cutoff, action) \
+        + 'done; true'
+
+def expired_local_entries(trash_dir, cutoff):
+    """
+    Returns the paths of the entries of the local `trash_dir` quarantined
+    before the time `cutoff`.
+    """
+    entries = []
+    try:
+        names = os.listdir(trash_dir)
+    except FileNotFoundError:
+        return entries
+    for name in sorted(names):
+        match = QUARANTINE_NAME_PATTERN.match(name)
+        if match is not None and int(match.group(1)) < cutoff:
+            entries.append(os.path.join(trash_dir, name))
+    return entries
+
+async def purge_host_async(repo_ref, messenger, opts):
+    """
+    Removes the repositories quarantined longer than "--older-than" ago
+    from the trash directory on the host of `repo_ref`, in a single round
+    trip for a remote host. Returns a `PurgeResult`.
+    """
+    cutoff = int(time.time() - parse_age(opts.older_than))
+    trash_dir = trash_dir_path(repo_ref, opts.trash_dir)
+    result = PurgeResult(host_label(repo_ref), dry_run=messenger.dry_run)
+    if repo_ref.protocol == 'file':
+        result.entries = expired_local_entries(trash_dir, cutoff)
+        loop = asyncio.get_running_loop()
+        for entry in result.entries:
+            with command_runner.step("rm -rf %s" % shell_quote(entry), messenger, label="localhost"):
+                if not messenger.dry_run:
+                    outcome, error = await loop.run_in_executor(None, remove_local_repository, entry)
+                    if outcome == "failed":
+                        result.error = error
+        return result
+    script = RemoteScript(repo_ref)
+    script.add_phase("list", trash_loop_command(trash_dir, cutoff, 'echo "$ygit_e"'), read_only=True)
+    script.add_phase("purge", trash_loop_command(trash_dir, cutoff, '{ rm -rf "$ygit_e" && echo "$ygit_e"; }'))
+    reply = await script.run(messenger=messenger)
+    if not reply.connected:
+        result.error = "Error connnecting to: %s" % messenger.compose_repo_ref(repo_ref)
+        return result
+    phase = reply.phase("purge") or reply.phase("list")
+    result.entries = phase.stdout.splitlines()
+    if not phase.succeeded or phase.stderr:
+        result.error = phase.stderr.strip() or "error purging %s" % trash_dir
+    return result
+
+async def purge_urls_async(urls, connections, messenger, opts):
+    """
+    Purges the trash directories on the hosts of `urls` (only the host part
+    of each URL is used), all at the same time. Returns True if no purge
+    failed.
+    """
+    parse_age(opts.older_than)
+    groups = group_by_host(parse_repo_urls('purge', urls))
+    limiter = HostLimiter(jobs=opts.jobs, jobs_per_host=opts.jobs_per_host)
+    async def purge(repo_ref):
+        tracer.lane("purge on %s" % host_label(repo_ref))
+        async with limiter.slot(repo_ref.host_key()):
+            repo_ref = await connect_repo_ref_async(repo_ref, connections)
+            return await purge_host_async(repo_ref, messenger, opts)
+    results = await asyncio.gather(*[purge(repo_refs[0]) for repo_refs in groups.values()])
+    ok = True
+    for result in results:
+        if opts.json:
+            messenger.info(json.dumps(result.as_dict(), sort_keys=True))
+        else:
+            if result.dry_run:
+                verb = "would purge"
+            else:
+                verb = "purged"
+            messenger.ygit_info("%s: %s %d quarantined repositor%s" \
+                % (result.host, verb, len(result.entries), "y" if len(result.entries) == 1 else "ies"))
+            for entry in result.entries:
+                messenger.ygit_info("    %s" % entry)
+            if result.error:
+                messenger.error("%s: %s" % (result.host, result.error))
+        if result.error:
+            ok = False
+    return ok
+
+############################################################################
+## Listing repositories
+
+# exit code of the listing script if the directory to list does not exist
+LIST_MISSING = 3
+
+def listing_root(repo_ref):
+    """
+    Returns the path of the directory to list given by the URL of
+    `repo_ref`. As URLs are parsed as repository URLs, the ".git" extension
+    added to the last component of the path is removed again unless it was
+    given; an empty path is the home directory on a remote host, and the
+    current directory on this one.
+    """
+    path = repo_ref.repo_path
+    if not repo_ref.url.rstrip("/").endswith(".git"):
+        path = path[:-len(".git")]
+    if not path:
+        if repo_ref.url.endswith("/"):
+            path = "/"
+        elif repo_ref.protocol == 'ssh':
+            path = "~"
+        else:
+            path = "."
+    return path
+
+def list_script(root):
+    """
+    Returns the shell script listing the repositories under `root`. A single
+    "find" walks the tree, identifying repositories as directories with a
+    "HEAD" file and "objects" and "refs" subdirectories (i.e., bare
+    repositories, and the ".git" directories of non-bare ones) and not
+    descending into them. Each repository is reported on consecutive lines:
+    "R <path>", the modification times of the repository directory and of
+    the files updated when it is pushed to, and its "core.bare" and
+    "core.sharedRepository" settings, followed by a "." line.
+    """
+    path = quote_remote_path(root)
+    return "\n".join([
+        'if stat -c %Y / > /dev/null 2>&1; then ygit_stat="stat -c %Y"; else ygit_stat="stat -f %m"; fi',
+        'test -d %s || { echo "Directory not found" >&2; exit %d; }' % (path, LIST_MISSING),
+        'find %s -type d -exec test -f {}/HEAD \\; -exec test -d {}/objects \\; -exec test -d {}/refs \\; -prune -print |' % path,
+        'while IFS= read -r ygit_r; do',
+        '    echo "R $ygit_r"',
+        '    $ygit_stat "$ygit_r" "$ygit_r/refs/heads" "$ygit_r/packed-refs" "$ygit_r/objects/pack" "$ygit_r/info/refs" 2> /dev/null',
+        '    git config --file "$ygit_r/config" --get-regexp "^core\\.(bare|sharedrepository)$" 2> /dev/null',
+        '    echo "."',
+        'done',
+    ]) + "\n"
+
+def repository_url(repo_ref, path):
+    """
+    Returns the URL of the repository at `path` on the host of `repo_ref`,
+    in the form used by the URL of `repo_ref`.
+    """
+    if repo_ref.protocol == 'file':
+        if repo_ref.url.startswith("file://"):
+            return "file://" + path
+        return path
+    if repo_ref.url.startswith("ssh://"):
+        if not path.startswith("/"):
+            path = "/~/" + path
+        if repo_ref.port:
+            return "ssh://%s@%s:%s%s" % (repo_ref.user, repo_ref.host, repo_ref.port, path)
+        return "ssh://%s@%s%s" % (repo_ref.user, repo_ref.host, path)
+    return "%s@%s:%s" % (repo_ref.user, repo_ref.host, path)
+
+SHARED_SETTINGS = {
+    'false': 'umask',
+    '0': 'umask',
+    'umask': 'umask',
+    'true': 'group',
+    '1': 'group',
+    'group': 'group',
+    '2': 'all',
+    'all': 'all',
+    'world': 'all',
+    'everybody': 'all',
+}
+
+class ListedRepository(object):
+    """
+    A repository found by the "list" command: `bare` is True for a bare
+    repository, `shared` is its "core.sharedRepository" setting (as one of
+    the values accepted by "--shared") and `mtime` the time at which it was
+    last modified, as far as can be told from the repository directory and
+    the files and directories updated by a push ("refs/heads",
+    "packed-refs", "objects/pack" and "info/refs").
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.url = None
+        self.bare = None
+        self.shared = "umask"
+        self.mtime = None
+
+    def add_fact(self, line):
+        """
+        Records the fact reported by the listing script on `line`.
+        """
+        if line.isdigit():
+            self.mtime = max(self.mtime or 0, int(line))
+        elif line.startswith("core."):
+            parts = line.split(None, 1)
+            value = parts[1].strip().lower() if len(parts) > 1 else ""
+            if parts[0] == "core.bare":
+                self.bare = value == "true"
+            elif parts[0] == "core.sharedrepository":
+                self.shared = SHARED_SETTINGS.get(value, value)
+
+    def finish(self, repo_ref):
+        """
+        Resolves the location of the repository on the host of `repo_ref`:
+        a non-bare repository is at the working tree that contains its
+        ".git" directory.
+        """
+        if self.path.endswith("/.git"):
+            self.path = self.path[:-len("/.git")]
+            if self.bare is None:
+                self.bare = False
+        elif self.bare is None:
+            self.bare = True
+        if repo_ref.protocol == 'file':
+            self.path = os.path.abspath(self.path)
+        self.url = repository_url(repo_ref, self.path)
+
+    def as_dict(self):
+        return {
+            "url": self.url,
+            "path": self.path,
+            "bare": self.bare,
+            "shared": self.shared,
+            "mtime": self.mtime,
+        }
+
+    def describe(self):
+        if self.mtime is None:
+            mtime = "-"
+        else:
+            mtime = time.strftime("%Y-%m-%d %H:%M", time.localtime(self.mtime))
+        return "%-7s %-6s %16s  %s" % ("bare" if self.bare else "working", self.shared, mtime, self.url)
+
+async def list_repositories_async(repo_ref, messenger, opts):
+    """
+    Lists the repositories under the directory given by `repo_ref`, on its
+    host, in a single round trip. Each repository is written (as a line of
+    text, or a JSON object with "--json") as soon as it is found. Returns
+    the number of repositories found. The walk is subject to the timeouts
+    and retries of remote scripts (see `HostHealth`), although it is not
+    itself one, as its output is passed on as it comes.
+    """
+    root = listing_root(repo_ref)
+    found = []
+    current = []
+    def on_line(line):
+        if line.startswith("R "):
+            current[:] = [ListedRepository(line[2:])]
+        elif line == "." and current:
+            listed = current.pop()
+            listed.finish(repo_ref)
+            found.append(listed)
+            if opts.json:
+                messenger.info(json.dumps(listed.as_dict(), sort_keys=True))
+            else:
+                messenger.info(listed.describe())
+            messenger.stdout.flush()
+        elif current:
+            current[0].add_fact(line)
+    remote = repo_ref.protocol == 'ssh'
+    attempt = 0
+    while True:
+        if remote and host_health.is_down(repo_ref):
+            reply = host_health.down_reply(repo_ref, messenger)
+            returncode, stderr = reply.returncode, reply.stderr
+            break
+        returncode, stdout, stderr = await command_runner.run(remote_argv(repo_ref, ["sh", "-s"]),
+                messenger=messenger,
+                input=list_script(root),
+                read_only=True,
+                label=host_label(repo_ref),
+                details=["[list] %s" % root],
+                on_line=on_line,
+                timeout=host_health.command_timeout,
+                interactive=remote)
+        # (only if nothing has been listed yet, so that nothing is listed
+        # twice)
+        failed = remote and not found and returncode in (255, TIMED_OUT)
+        if remote:
+            host_health.record(repo_ref, failed)
+        if not failed or attempt >= host_health.retries or host_health.is_down(repo_ref):
+            break
+        delay = host_health.retry_delay_for(attempt)
+        messenger.ygit_info("Could not reach %s: trying again in %.1fs" % (host_label(repo_ref), delay))
+        await asyncio.sleep(delay)
+        attempt += 1
+    if returncode == LIST_MISSING:
+        raise YonderGitError("Directory not found: %s" % repository_url(repo_ref, root))
+    if not found and returncode:
+        if stderr:
+            messenger.error(stderr, newline=False)
+        raise YonderGitError("Error connnecting to: %s" % messenger.compose_repo_ref(repo_ref))
+    if stderr and not opts.all_quiet:
+        # e.g., directories that could not be read
+        messenger.error(stderr, newline=False)
+    return len(found)
+
+async def list_urls_async(urls, connections, messenger, opts):
+    """
+    Lists the repositories under each of `urls`, all at the same time.
+    Returns True if all could be listed.
+    """
+    repo_refs = parse_repo_urls('list', urls)
+    limiter = HostLimiter(jobs=opts.jobs, jobs_per_host=opts.jobs_per_host)
+    async def list_url(repo_ref):
+        tracer.lane("list %s" % repo_ref.url)
+        async with limiter.slot(repo_ref.host_key()):
+            repo_ref = await connect_repo_ref_async(repo_ref, connections)
+            try:
+                count = await list_repositories_async(repo_ref, messenger, opts)
+            except YonderGitError as e:
+                messenger.error(str(e))
+                return False
+            if not opts.json:
+                messenger.ygit_info("%d repositor%s found under: %s" \
+                    % (count, "y" if count == 1 else "ies", repo_ref.url or listing_root(repo_ref)))
+            return True
+    results = await asyncio.gather(*[list_url(repo_ref) for repo_ref in repo_refs])
+    return all(results)
+
+############################################################################
+## Pushing to all remotes
+
+# default limit, in seconds, on the time taken by the push to each remote
+DEFAULT_PUSH_TIMEOUT = 600
+
+class PushResult(object):
+    """
+    Outcome of pushing to a single remote of the local repository. `refs`
+    counts the refs reported by "git push --porcelain" for each status: of
+    "updated", "rejected" and "up to date".
+    """
+
+    def __init__(self, name, url):
+        self.name = name
+        self.url = url
+        self.returncode = None
+        self.duration = None
+        self.refs = {}
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    @property
+    def status(self):
+        if self.returncode == TIMED_OUT:
+            return "TIMEOUT"
+        if self.ok:
+            return "OK"
+        return "FAILED"
+
+    def describe(self):
+        parts = ["%d %s" % (self.refs[status], status)
+                for status in ("updated", "rejected", "up to date") if self.refs.get(status)]
+        if self.error:
+            parts.append(self.error)
+        return ", ".join(parts)
+
+    def as_dict(self):
+        return {
+            "remote": self.name,
+            "url": self.url,
+            "status": self.status,
+            "exit": self.returncode,
+            "duration": self.duration,
+            "refs": self.refs,
+            "error": self.error,
+        }
+
+def count_pushed_refs(output):
+    """
+    Returns the number of refs of each status (see `PushResult`) reported in
+    the output of "git push --porcelain".
+    """
+    refs = {}
+    for line in output.splitlines():
+        fields = line.split("\t")
+        if len(fields) < 3 or len(fields[0]) != 1:
+            continue
+        if fields[0] == "!":
+            status = "rejected"
+        elif fields[0] == "=":
+            status = "up to date"
+        else:
+            status = "updated"
+        refs[status] = refs.get(status, 0) + 1
+    return refs
+
+async def local_remotes_async(messenger, opts):
+    """
+    Returns a list of (name, URL) tuples of the remotes of the local
+    repository, in the order in which they are configured.
+    """
+    argv = ["git", "-C", opts.local_repo, "config", "--get-regexp", r"^remote\..*\.url$"]
+    retcode, out, err = await command_runner.run(argv, messenger=messenger, read_only=True, label="localhost")
+    if retcode == 1 and not err:
+        # no remotes
+        return []
+    if retcode:
+        messenger.error(err, newline=False)
+        raise YonderGitError("Cannot read the remotes of the local repository.")
+    remotes = []
+    names = set()
+    for line in out.splitlines():
+        key, url = line.split(" ", 1)
+        name = key[len("remote."):-len(".url")]
+        # of a remote with several URLs, git pushes to all of them
+        if name not in names:
+            names.add(name)
+            remotes.append((name, url))
+    return remotes
+
+def push_host_key(url):
+    """
+    Returns the key of the host of `url` by which the pushes to it are
+    limited by "--jobs-per-host".
+    """
+    try:
+        return parse_repo_url('push', url).host_key()
+    except (YonderGitError, ValueError, AttributeError):
+        return (url,)
+
+async def push_remote_async(result, messenger, opts):
+    """
+    Pushes to the remote of `result`, and fills `result` in. Pushes are run
+    without a terminal, in a session of their own, so that neither git nor
+    ssh waits on a prompt that would never be answered; on a dry run, they
+    are run with "--dry-run".
+    """
+    argv = ["git", "-C", opts.local_repo, "push", "--porcelain"]
+    if messenger.dry_run:
+        argv.append("--dry-run")
+    argv.append(result.name)
+    timeout = opts.push_timeout or None
+    start = time.time()
+    with tracer.span("push", "operation", remote=result.name, url=result.url):
+        result.returncode, out, err = await command_runner.run(argv,
+                messenger=messenger,
+                read_only=True,
+                label=result.name,
+                timeout=timeout,
+                env={"GIT_TERMINAL_PROMPT": "0"})
+    result.duration = time.time() - start
+    result.refs = count_pushed_refs(out)
+    if not result.ok:
+        lines = [line.strip() for line in err.splitlines() if line.strip()]
+        errors = [line for line in lines if line.lower().startswith(("error", "fatal"))]
+        if errors:
+            result.error = errors[0]
+        elif lines:
+            result.error = lines[-1]
+        else:
+            result.error = "exit %d" % result.returncode
+    return result
+
+async def push_all_async(names, messenger, opts):
+    """
+    Pushes to all the remotes of the local repository (or to those named in
+    `names`, if any) concurrently, subject to the "--jobs" and
+    "--jobs-per-host" limits. A line reporting progress is written as each
+    push finishes (or, with "--json", a JSON object), and a table of the
+    outcomes follows. Returns True if all pushes succeeded.
+    """
+    remotes = await local_remotes_async(messenger, opts)
+    if names:
+        configured = dict(remotes)
+        unknown = [name for name in names if name not in configured]
+        if unknown:
+            raise YonderGitError("No such remote: %s" % ", ".join(unknown))
+        remotes = [(name, configured[name]) for name in names]
+    if not remotes:
+        raise YonderGitError("The local repository has no remotes to push to.")
+    limiter = HostLimiter(jobs=opts.jobs, jobs_per_host=opts.jobs_per_host)
+    results = [PushResult(name, url) for name, url in remotes]
+    finished = []
+    if not opts.json:
+        messenger.ygit_info("Pushing to %d remote(s)" % len(results))
+    async def push(result):
+        tracer.lane("push %s" % result.name)
+        async with limiter.slot(push_host_key(result.url)):
+            await push_remote_async(result, messenger, opts)
+        finished.append(result)
+        if opts.json:
+            messenger.info(json.dumps(result.as_dict(), sort_keys=True))
+        else:
+            messenger.info("[%d/%d, %d failed] %-7s %s (%.2fs)" \
+                % (len(finished), len(results),
+                   len([done for done in finished if not done.ok]),
+                   result.status, result.name, result.duration))
+    start = time.time()
+    await asyncio.gather(*[push(result) for result in results])
+    if not opts.json:
+        report_pushes(results, time.time() - start, messenger)
+    for result in results:
+        if not result.ok:
+            return False
+    return True
+
+def report_pushes(results, elapsed, messenger):
+    """
+    Writes a table of the outcomes of `results`.
+    """
+    width = max([len("Remote")] + [len(result.name) for result in results])
+    messenger.info("\n%-*s %-7s %9s  %s" % (width, "Remote", "Result", "Time", "Details"))
+    for result in results:
+        messenger.info("%-*s %-7s %8.2fs  %s" \
+            % (width, result.name, result.status, result.duration, result.describe()))
+    failed = len([result for result in results if not result.ok])
+    messenger.info("%d pushed, %d failed (%.2fs)" % (len(results) - failed, failed, elapsed))
+
+############################################################################
+## Batch processing
+
+class BatchItem(object):
+    """
+    A single command read from a batch manifest, with the outcome of running
+    it.
+    """
+
+    def __init__(self, lineno, command, remote_name, repo_ref, opts):
+        self.lineno = lineno
+        self.command = command
+        self.remote_name = remote_name
+        self.repo_ref = repo_ref
+        self.opts = opts
+        self.succeeded = None
+        self.error = None
+        self.stream = None
+        self.output = ""
+        self.duration = None
+        self.done_before = False
+
+    def describe(self):
+        parts = [self.command]
+        if self.remote_name is not None:
+            parts.append(self.remote_name)
+        parts.append(self.repo_ref.url)
+        return " ".join(parts)
+
+class ManifestOptionParser(OptionParser):
+    """
+    Option parser for the options given on the lines of a batch manifest:
+    reports errors by raising a `YonderGitError` instead of exiting.
+    """
+
+    def error(self, msg):
+        raise YonderGitError(msg)
+
+def read_manifest(stream, opts, journal=None):
+    """
+    Reads a batch manifest from `stream` and returns a list of `BatchItem`
+    objects. Each non-blank line of the manifest gives a command as it would
+    be given on the command line (i.e., "COMMAND [OPTIONS] ARGS"), e.g.:
+
+        setup origin user@host.xz:/srv/git/project.git --shared=group
+
+    Anything following a "#" is ignored. Options given on a line override
+    those given on the command line for that line only. All lines are
+    validated before any are run (including the names of the remotes that
+    they add, unless `journal`, the `BatchJournal` of the run resumed,
+    records them as added): a `YonderGitError` listing every invalid line is
+    raised if any are found.
+    """
+    parser = create_option_parser(option_parser_class=ManifestOptionParser)
+    items = []
+    errors = []
+    for lineno, line in enumerate(stream):
+        lineno += 1
+        try:
+            tokens = shlex.split(line, comments=True)
+            if not tokens:
+                continue
+            item_opts, args = parser.parse_args(tokens, values=copy.copy(opts))
+            if not args:
+                raise YonderGitError("no command given")
+            command = args[0].lower()
+            if command not in BATCH_COMMANDS:
+                raise YonderGitError("'%s' is not a valid batch command (expecting one of: %s)" \
+                    % (command, ", ".join(BATCH_COMMANDS)))
+            remote_name, remote_url = parse_command_args(command, args[1:])
+            repo_ref = parse_repo_url(command, remote_url)
+            items.append(BatchItem(lineno=lineno,
+                                   command=command,
+                                   remote_name=remote_name,
+                                   repo_ref=repo_ref,
+                                   opts=item_opts))
+        except (ValueError, YonderGitError) as e:
+            errors.append("line %d: %s" % (lineno, e))
+    errors.extend(check_remote_names(items, journal))
+    if errors:
+        raise YonderGitError("Invalid batch manifest:\n    " + "\n    ".join(errors))
+    return items
+
+def check_remote_names(items, journal=None):
+    """
+    Returns a list of errors for the lines of a batch manifest (given as
+    `BatchItem` objects) that add remotes that cannot be added: those with
+    invalid names, or names already defined in the local repository or
+    added by an earlier line. Remotes that `journal` records as added are
+    not checked.
+    """
+    errors = []
+    added = {}
+    for item in items:
+        if item.command not in ['setup', 'add']:
+            continue
+        if journal is not None \
+                and "add" in journal.completed_steps(BatchJournal.key(item.command, item.remote_name, item.repo_ref)):
+            continue
+        try:
+            config = local_configs.get(item.opts.local_repo)
+            key = (config.git_dir, item.remote_name)
+            if key in added:
+                raise YonderGitError('a remote called "%s" is also added by line %d' % (item.remote_name, added[key]))
+            added[key] = item.lineno
+            config.check_remote_name(item.remote_name)
+        except YonderGitError as e:
+            errors.append("line %d: %s" % (item.lineno, e))
+    return errors
+
+def default_journal_path(manifest_path):
+    """
+    Returns the path of a new journal for a run of the batch manifest at
+    `manifest_path` ("-" for standard input), unless given by "--journal":
+    named after the manifest and the time the run started, so that each run
+    leaves the journals of earlier runs (which may yet be resumed) as they
+    are.
+    """
+    if manifest_path == "-":
+        name = "stdin"
+    else:
+        manifest_path = os.path.abspath(manifest_path)
+        name = "%s-%s" % (os.path.basename(manifest_path),
+                hashlib.sha1(manifest_path.encode("utf-8")).hexdigest()[:12])
+    name += "-%s-%d" % (time.strftime("%Y%m%d-%H%M%S"), os.getpid())
+    return os.path.join(default_journal_dir(), name + ".jsonl")
+
+def default_journal_dir():
+    """
+    Returns the directory of the journals not given by "--journal".
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "ygit", "journals")
+
+class BatchJournal(object):
+    """
+    The record of the steps of the operations of a batch that have been
+    done, in the file at `path`: one JSON object per line, appended (and
+    flushed) as soon as each step is done, so that the journal of a run
+    that is interrupted still records everything the run did, e.g.:
+
+        {"operation": ["setup", "origin", KEY], "step": "create", "time": T}
+
+    where KEY is the canonical key of the repository (see
+    `RepositoryReference.canonical_key`). Given to "--resume", the journal
+    of an earlier run is read first, and the steps it records are not run
+    again. Unless resuming, a new journal is started: an existing journal
+    that records steps is never started afresh.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = {}
+        self.stream = None
+
+    @staticmethod
+    def key(command, remote_name, repo_ref):
+        return json.dumps([command, remote_name, list(repo_ref.canonical_key())])
+
+    def read(self):
+        """
+        Reads the steps recorded in the journal. A line that cannot be
+        parsed (e.g., the last one, if the run writing it was killed) is
+        ignored.
+        """
+        try:
+            stream = open(self.path, "r")
+        except IOError as e:
+            raise YonderGitError("Cannot open journal: %s" % e)
+        with stream:
+            for line in stream:
+                try:
+                    record = json.loads(line)
+                    key = json.dumps(record["operation"])
+                    step = record["step"]
+                except (ValueError, KeyError, TypeError):
+                    continue
+                self.completed.setdefault(key, set()).add(step)
+
+    def completed_steps(self, key):
+        """
+        Returns the names of the steps recorded for the operation `key`.
+        """
+        return self.completed.get(key, set())
+
+    def open(self, resume):
+        """
+        Opens the journal for recording, appending to it if `resume` is
+        True, and starting it otherwise. Raises a `YonderGitError` if it is
+        to be started but already records steps of an earlier run.
+        """
+        if not resume and os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            raise YonderGitError('The journal "%s" records the steps of an earlier run: carry on with it ' \
+                'with "--resume %s", or remove it first.' % (self.path, shell_quote(self.path)))
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self.stream = open(self.path, "a" if resume else "w")
+        except (IOError, OSError) as e:
+            raise YonderGitError("Cannot write journal: %s" % e)
+
+    def record(self, operation, step):
+        """
+        Records that `step` of `operation` has been done.
+        """
+        if self.stream is None:
+            return
+        self.stream.write(json.dumps({"operation": json.loads(operation.key),
+                                      "step": step.name,
+                                      "time": time.time()}) + "\n")
+        self.stream.flush()
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+class BatchRunner(object):
+    """
+    Runs a list of `BatchItem` objects concurrently on the event loop,
+    subject to the limits of a `HostLimiter`, recording the steps done in
+    a `BatchJournal` (if given), and skipping those it already records.
+    """
+
+    def __init__(self, items, connections, messenger, limiter, plan=None, journal=None):
+        self.items = items
+        self.connections = connections
+        self.messenger = messenger
+        self.limiter = limiter
+        self.plan = plan
+        self.journal = journal
+
+    def operation(self, item):
+        """
+        Returns the `Operation` carrying out `item`, whose messages are
+        collected (in `item.output`, once it has run) so that the messages
+        of concurrently-running items are not interleaved.
+        """
+        item.stream = StringIO()
+        operation = Operation(command=item.command,
+                              remote_name=item.remote_name,
+                              repo_ref=item.repo_ref,
+                              messenger=create_messenger(item.opts, stdout=item.stream, stderr=item.stream),
+                              opts=item.opts,
+                              connections=self.connections,
+                              plan=self.plan,
+                              journal=self.journal)
+        if self.journal is not None:
+            operation.graph.skip(self.journal.completed_steps(operation.key))
+            item.done_before = all(step.skipped for step in operation.graph.steps)
+        return operation
+
+    async def run_item(self, item, operation):
+        """
+        Runs a single item, as `operation`.
+        """
+        start = time.time()
+        try:
+            await operation.run()
+            item.succeeded = True
+        except YonderGitError as e:
+            item.error = str(e)
+            operation.messenger.error(item.error)
+            item.succeeded = False
+        item.duration = time.time() - start
+        item.output = item.stream.getvalue()
+        self.messenger.ygit_info("[%d] %s" % (item.lineno, item.describe()))
+        if item.output:
+            self.messenger.info(item.output, newline=False)
+
+    async def run(self):
+        """
+        Runs all items, returning when all have completed. On a dry run,
+        the steps of all the items are shown first.
+        """
+        operations = [(item, self.operation(item)) for item in self.items]
+        if self.messenger.dry_run:
+            show_operation_graphs([("[%d] %s" % (item.lineno, item.describe()), operation)
+                for item, operation in operations], self.messenger)
+        # items done by the run resumed are not reported as they run
+        operations = [(item, operation) for item, operation in operations if not item.done_before]
+        async def run_item(item, operation):
+            if self.plan is not None:
+                # the limits apply to the scripts run by the plan instead
+                await self.run_item(item, operation)
+                return
+            async with self.limiter.slot(item.repo_ref.host_key()):
+                await self.run_item(item, operation)
+        await asyncio.gather(*[run_item(item, operation) for item, operation in operations])
+
+    def report(self, elapsed):
+        """
+        Writes a summary of the outcome of each item.
+        """
+        failed = [item for item in self.items if not item.succeeded and not item.done_before]
+        done_before = [item for item in self.items if item.done_before]
+        self.messenger.info("\nBatch summary: %d items, %d succeeded, %d failed%s (%.2fs)" \
+            % (len(self.items), len(self.items) - len(failed) - len(done_before), len(failed),
+               ", %d done before" % len(done_before) if done_before else "", elapsed))
+        for item in self.items:
+            if item.done_before:
+                self.messenger.info("  %6s  [%d] %s (done before)" % ("OK", item.lineno, item.describe()))
+                continue
+            if item.succeeded:
+                status = "OK"
+                detail = ""
+            else:
+                status = "FAILED"
+                detail = ": " + item.error.splitlines()[0]
+            self.messenger.info("  %6s  [%d] %s (%.2fs)%s" \
+                % (status, item.lineno, item.describe(), item.duration, detail))
+
+async def run_batch_async(manifest_path, journal_path, connections, messenger, opts):
+    """
+    Runs all the commands in the batch manifest at `manifest_path` ("-" for
+    standard input), recording the steps done in the journal at
+    `journal_path` (see `BatchJournal`), and, with "--resume", skipping
+    those it already records. Returns True if all succeeded, in which case
+    the journal is removed, unless given by "--journal" (there is nothing
+    left in it to resume).
+    """
+    journal = BatchJournal(journal_path)
+    if opts.resume:
+        journal.read()
+    if manifest_path == "-":
+        items = read_manifest(sys.stdin, opts, journal)
+    else:
+        try:
+            stream = open(manifest_path, "r")
+        except IOError as e:
+            raise YonderGitError("Cannot open batch manifest: %s" % e)
+        try:
+            items = read_manifest(stream, opts, journal)
+        finally:
+            stream.close()
+    limiter = HostLimiter(jobs=opts.jobs, jobs_per_host=opts.jobs_per_host)
+    plan = None
+    if opts.plan:
+        plan = ExecutionPlan(messenger, limiter)
+    runner = BatchRunner(items=items,
+                         connections=connections,
+                         messenger=messenger,
+                         limiter=limiter,
+                         plan=plan,
+                         journal=journal)
+    if not messenger.dry_run:
+        journal.open(resume=bool(opts.resume))
+    start = time.time()
+    try:
+        await runner.run()
+    finally:
+        journal.close()
+    runner.report(time.time() - start)
+    if any(not item.succeeded and not item.done_before for item in items):
+        messenger.info('To carry on with what did not succeed: ygit.py batch %s --resume %s' \
+            % (shell_quote(manifest_path), shell_quote(journal.path)))
+        return False
+    if not messenger.dry_run and not opts.journal \
+            and os.path.dirname(os.path.abspath(journal.path)) == os.path.abspath(default_journal_dir()):
+        try:
+            os.remove(journal.path)
+        except OSError:
+            pass
+    return True
+
+def batch_journal_path(manifest_path, opts):
+    """
+    Returns the path of the journal of the run of the batch manifest at
+    `manifest_path`: that resumed, if any, that given by "--journal", or a
+    new one.
+    """
+    return opts.resume or opts.journal or default_journal_path(manifest_path)
+
+############################################################################
+## Serving requests
+##
+## "ygit.py serve" listens on a Unix domain socket for commands forwarded by
+## "ygit-client.py", and carries them out on its event loop, so that the
+## ssh connections to each host (and the states of remote repositories) are
+## kept from one command to the next. Each request is a single line of JSON
+## giving the arguments of the command and the working directory of the
+## client:
+##
+##      {"argv": ["setup", "origin", "host:/srv/git/x.git"], "cwd": "/src/x"}
+##
+## and each line of the reply is a JSON object giving either output
+## ({"out": TEXT} or {"err": TEXT}) or, last, the exit code of the command
+## ({"exit": CODE}). Commands that are not served are answered with
+## {"fallback": true}, upon which the client runs them itself.
+
+def default_socket_path():
+    """
+    Returns the path of the socket on which "serve" listens (and to which
+    the client connects) by default: "ygit.sock" in $XDG_RUNTIME_DIR, or in
+    a directory of the user's own under the temporary directory.
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "ygit.sock")
+    return os.path.join(temp_socket_dir(), "ygit.sock")
+
+def temp_socket_dir():
+    """
+    Returns the directory of the user's own under the temporary directory
+    in which the default socket is, if $XDG_RUNTIME_DIR is not set.
+    """
+    return os.path.join(tempfile.gettempdir(), "ygit-%d" % os.getuid())
+
+def check_private_dir(directory):
+    """
+    Raises a `YonderGitError` unless `directory` is a directory (and not a
+    symbolic link) owned by the user, that other users cannot access.
+    """
+    try:
+        st = os.lstat(directory)
+    except OSError as e:
+        raise YonderGitError("Cannot use the directory of the socket: %s" % e)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) & 0o077:
+        raise YonderGitError('Not using "%s" for the socket: it is not a directory of your own, ' \
+            'accessible by you only (it may have been made by another user, to stand in for ' \
+            'the server). Remove it, or give another "--socket".' % directory)
+
+class ReplyStream(object):
+    """
+    File-like object sending whatever is written to it to a client, as
+    lines of the reply tagged with `key` ("out" or "err").
+    """
+
+    def __init__(self, writer, key):
+        self.writer = writer
+        self.key = key
+
+    def write(self, text):
+        if text and not self.writer.is_closing():
+            self.writer.write(json.dumps({self.key: text}).encode("utf-8") + b"\n")
+
+    def flush(self):
+        pass
+
+class RequestServer(object):
+    """
+    Carries out the commands forwarded by clients, concurrently, subject to
+    the limits of a `HostLimiter`, over the connections of `connections`.
+    Each command is carried out with the options given by its client, as it
+    would have been by "ygit.py" in the working directory of the client;
+    the options given to "serve" itself apply to the server as a whole
+    (e.g., "--ssh", "--jobs").
+    """
+
+    # the options applied to the server as a whole: commands given any of
+    # these, set otherwise than for the server, are not served
+    server_options = ['trace_file', 'profile', 'multiplex', 'ssh_program', 'agent',
+                      'connect_timeout', 'command_timeout', 'retries', 'retry_delay', 'host_failures']
+
+    def __init__(self, connections, messenger, opts):
+        self.connections = connections
+        self.messenger = messenger
+        self.opts = opts
+        self.limiter = HostLimiter(jobs=opts.jobs, jobs_per_host=opts.jobs_per_host)
+        self.parser = create_option_parser(option_parser_class=ManifestOptionParser)
+        self.in_flight = 0
+
+    def parse_request(self, argv, cwd):
+        """
+        Returns the command, its remote name, the `RepositoryReference` of
+        the repository and the options for the command in `argv`, given in
+        `cwd`, or None if it is not one that is served (including if it is
+        given one of the `server_options` that the server would ignore).
+        """
+        if "-h" in argv or "--help" in argv:
+            return None
+        values = self.parser.get_default_values()
+        values.local_repo = cwd
+        opts, args = self.parser.parse_args(list(argv), values=values)
+        if not args or args[0].lower() not in BATCH_COMMANDS \
+                or opts.commands or opts.urls or opts.url_file or opts.json:
+            return None
+        command = args[0].lower()
+        if command == 'check' and len(args) != 2:
+            return None
+        for dest in self.server_options:
+            value = getattr(opts, dest)
+            if value != self.parser.defaults.get(dest) and value != getattr(self.opts, dest):
+                return None
+        opts.local_repo = os.path.join(cwd, os.path.expanduser(opts.local_repo))
+        remote_name, remote_url = parse_command_args(command, args[1:])
+        repo_ref = parse_repo_url(command, remote_url)
+        if repo_ref.protocol == 'file' and not os.path.isabs(repo_ref.repo_path):
+            repo_ref = repo_ref.replace(repo_path=os.path.join(cwd, repo_ref.repo_path))
+        return command, remote_name, repo_ref, opts
+
+    async def serve_request(self, request, writer):
+        """
+        Carries out `request`, sending its output to `writer`. Returns the
+        exit code of the command, or None if it is not served.
+        """
+        stdout = ReplyStream(writer, "out")
+        stderr = ReplyStream(writer, "err")
+        try:
+            parsed = self.parse_request(request["argv"], request["cwd"])
+        except YonderGitError as e:
+            stderr.write("%s\n" % e)
+            return 1
+        if parsed is None:
+            return None
+        command, remote_name, repo_ref, opts = parsed
+        messenger = create_messenger(opts, stdout=stdout, stderr=stderr)
+        self.messenger.debug("Serving: %s" % format_argv(request["argv"]))
+        try:
+            async with self.limiter.slot(repo_ref.host_key()):
+                await run_command_async(command=command,
+                                        remote_name=remote_name,
+                                        repo_ref=repo_ref,
+                                        messenger=messenger,
+                                        opts=opts,
+                                        connections=self.connections)
+        except YonderGitError as e:
+            messenger.error(str(e))
+            return 1
+        return 0
 
-            # ignore directory creation errors,
-            # but report error if directory does not exist
-            # after all is said anddone mimics (sorta) "mkdir -p"
+    async def handle(self, reader, writer):
+        """
+        Handles a single client connection.
+        """
+        self.in_flight += 1
+        try:
             try:
-                os.makedirs(repo_ref.repo_path)
-            except:
-                pass
-            if not os.path.exists(repo_ref.repo_path):
-                retcode = 1
+                request = json.loads((await reader.readline()).decode("utf-8"))
+                if not isinstance(request.get("argv"), list) or not isinstance(request.get("cwd"), str):
+                    raise ValueError("expecting \"argv\" and \"cwd\"")
+            except (ValueError, AttributeError) as e:
+                ReplyStream(writer, "err").write("Invalid request: %s\n" % e)
+                reply = {"exit": 1}
             else:
-                retcode = 0
-#             if not opts.dry_run:
-#                 try:
-#                     os.makedirs(repo_ref.repo_path)
-#                     retcode = False
-#                 except:
-#                     retcode = True
-#             else:
-#                  retcode = False
-    if retcode:
-        messenger.error("Error creating directory.")
-        sys.exit(1)
-    if init:
-        init_remote(repo_ref=repo_ref,
-                    messenger=messenger,
-                    opts=opts,
-                    check=False)
+                retcode = await self.serve_request(request, writer)
+                if retcode is None:
+                    reply = {"fallback": True}
+                else:
+                    reply = {"exit": retcode}
+            writer.write(json.dumps(reply).encode("utf-8") + b"\n")
+            await writer.drain()
+        except (ConnectionError, OSError):
+            # the client went away
+            pass
+        finally:
+            writer.close()
+            self.in_flight -= 1
+            if not self.in_flight:
+                # between requests, forget the commands run and remove
+                # the seed bundles made (so that a long-running server does
+                # not accumulate them), and write out the states found
+                command_runner.clear()
+                seed_bundles.remove_all()
+                remote_state_cache.save()
 
-def init_remote(repo_ref, messenger, opts, check=True):
+def listen_path(path):
     """
-    Initialize a new remote repository
+    Prepares `path` for a new socket: creates its directory (accessible by
+    the user only), and removes any socket left behind by a server that is
+    no longer running. Raises a `YonderGitError` if a server is already
+    listening there, or if the directory is that of the default socket
+    under the temporary directory (which another user could have made
+    first) and is not private to the user.
     """
-    if check:
-        check_remote(repo_ref=repo_ref, messenger=messenger, opts=opts)
-    if opts.bare:
-        bare = "--bare"
-    else:
-        bare = ""
-    if opts.shared:
-        shared = "--shared=" + opts.shared
-    else:
-        shared = ""
-    init_command = "cd %s; git init %s %s; git update-server-info" % (repo_ref.repo_path, bare, shared)
-    if repo_ref.protocol == 'ssh':
-        command = repo_ref.ssh_command + ' "' + init_command + '"'
-        host = str(repo_ref.host)
-    elif repo_ref.protocol == 'file':
-        command = init_command
-        host = "localhost"
-    messenger.ygit_command(command)
-    if not opts.dry_run:
-        init = subprocess.Popen([command], shell=True, stdout=subprocess.PIPE)
-        stdout = init.communicate()[0]
-        if opts.all_quiet:
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory, mode=0o700)
+        except FileExistsError:
             pass
+    if directory and os.path.abspath(directory) == os.path.abspath(temp_socket_dir()):
+        check_private_dir(directory)
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.remove(path)
         else:
-            messenger.info("[%s] %s" % (host, stdout), newline=False)
-        if init.returncode:
-            messenger.error("Error initializing repository.")
-            sys.exit(1)
+            raise YonderGitError("A server is already listening on: %s" % path)
+        finally:
+            probe.close()
 
-def add_remote(remote_name, repo_ref, messenger, opts):
+async def serve_async(connections, messenger, opts):
     """
-    Add a new remote repository to the local one.
+    Serves requests on the socket given by "--socket" until interrupted.
     """
-    if opts.all_quiet:
-        git_stdout = subprocess.PIPE
-    else:
-        git_stdout = None
-    if opts.mirror:
-        mirror = "--mirror"
-    else:
-        mirror = ""
-    messenger.ygit_info("Adding \"%s\": \"%s\"" % (remote_name, repo_ref.url))
-    command = "cd \"%s\"; git remote add %s %s '%s' " % (opts.local_repo, mirror, remote_name, repo_ref.url)
-    messenger.ygit_command(command)
-    if not opts.dry_run:
-        proc = subprocess.Popen([command], shell=True, stdout=git_stdout, stderr=subprocess.PIPE)
-        retcode = proc.wait()
-        if retcode:
-            err = proc.stderr.read()
-            messenger.error(err, newline=False)
-            if err.lower().count("not a git repository"):
-                hint = ' (have you run "git init" locally?)'
-            elif err.lower().count("already exists"):
-                hint = ' (maybe a remote called "%s" is already defined?)' % remote_name
-            messenger.error('Error adding remote%s.' % hint)
-            sys.exit(1)
-
-def configure_branch(remote_name, messenger, opts, branch_name='master'):
-    messenger.ygit_info('Configuring branch "branch_name" for remote "%s"' % (branch_name, remote_name))
-    command = "git config branch.%s.remote '%s'" % (branch_name, remote_name)
-    messenger.ygit_command(command)
-    if not opts.dry_run:
-        proc = subprocess.Popen([command], shell=True, stdout=git_stdout)
-        proc.wait()
-    command = "git config branch.%s.merge 'refs/heads/%s'" % (branch_name, branch_name)
-    messenger.ygit_command(command)
-    if not opts.dry_run:
-        proc = subprocess.Popen([command], shell=True, stdout=git_stdout)
-        proc.wait()
-
-def show_urls_help(stream=sys.stdout):
-#    stream.write("=====================\n")
-#    stream.write("Repository URL Syntax\n")
-#    stream.write("=====================\n")
-    for transport, urls in EXAMPLE_URLS.items():
-        stream.write('\n{0:->{1}}'.format("", len(transport)))
-        stream.write('\n{0}'.format(transport))
-        stream.write('\n{0:->{1}}\n'.format("", len(transport)))
-        for u in urls:
-            stream.write('# %s\n' % u)
-
-def show_commands_help(stream=sys.stdout, show_more_help=True):
-    stream.write("""\
-
-==============================================================================
-YonderGit Commands
-=========================+====================================================
-setup <NAME> <REPO-URL>  | create and initialize a new repository at
-                         | <REPO-URL>, and add it as a remote called '<NAME>';
-                         | equivalent to "--create <REPO-URL>" followed by
-                         | "--add <NAME> <REPO-URL>"
--------------------------+----------------------------------------------------
-create <REPO-URL>        | create a new directory at <REPO-URL> and initialize
-                         | it as a new repository (including running
-                         | "server-update-info")
--------------------------+----------------------------------------------------
-init <REPO-URL>          | initialize existing remote directory at <REPO-URL>
-                         | as a repository
--------------------------+----------------------------------------------------
-add <NAME> <REPO-URL>    | add repository at <REPO-URL> as a remote named
-                         | '<NAME>'
--------------------------+----------------------------------------------------
-check <REPO-URL>         | check the existence of an accessible directory given
-                         | specified by <REPO-URL>
--------------------------+----------------------------------------------------
-delete <REPO-URL>        | recursively delete the directory specified by
-                         | <REPO-URL> and all subdirectories.
-=========================+====================================================
-""")
-    if show_more_help:
-        stream.write("""\
-See 'ygit.py help options' for help on options, or 'ygit.py help urls' for
-help on REPO-URL syntax.
-""")
+    path = opts.socket_path or default_socket_path()
+    listen_path(path)
+    server = RequestServer(connections, messenger, opts)
+    old_umask = os.umask(0o077)
+    try:
+        listener = await asyncio.start_unix_server(server.handle, path=path)
+    finally:
+        os.umask(old_umask)
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopped.set)
+    messenger.ygit_info("Serving on: %s" % path)
+    try:
+        await stopped.wait()
+    finally:
+        listener.close()
+        await listener.wait_closed()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    messenger.ygit_info("Stopped serving.")
 
 ############################################################################
 ## Main CLI
 
-def main():
+VALID_COMMANDS = ['setup', 'create', 'init', 'add', 'check', 'list', 'delete', 'purge', 'push-all', 'batch', 'serve']
+BATCH_COMMANDS = ['setup', 'create', 'init', 'add', 'check']
+
+def create_option_parser(option_parser_class=OptionParser):
     """
-    Main CLI handler.
+    Returns the parser for the command-line options.
     """
-    usage = '%prog [options] <setup|create|init|add|delete|help> <ARGS>'
-    parser = OptionParser(usage=usage,
+    usage = '%prog [options] <setup|create|init|add|check|list|delete|purge|push-all|batch|serve|help> <ARGS>'
+    parser = option_parser_class(usage=usage,
                           add_help_option=True,
                           version=_prog_version,
                           description=_prog_description)
@@ -564,11 +5603,111 @@ def main():
         default=False,
         help='show debugging messages (assumes "--show")')
 
+    parser.add_option('--trace',
+        action='store',
+        dest='trace_file',
+        default=None,
+        metavar="<FILE>",
+        help='write the timing of every operation, command and remote phase ' \
+           + 'to FILE in the Chrome trace event format (for viewing in, ' \
+           + 'e.g., "chrome://tracing" or Perfetto)')
+
+    parser.add_option('--profile',
+        action='store_true',
+        dest='profile',
+        default=False,
+        help='profile ygit itself, writing the statistics of the functions ' \
+           + 'taking the most time to standard error at the end of the run')
+
     parser.add_option('--dry-run',
         action='store_true',
         dest='dry_run',
         default=False,
-        help='do not actually do anything')
+        help='do not actually do anything (but show the steps that would be taken)')
+
+    parser.add_option('-y', '--yes',
+        action='store_true',
+        dest='assume_yes',
+        default=False,
+        help='do not ask for confirmation before deleting repositories')
+
+    parser.add_option('--no-multiplex',
+        action='store_false',
+        dest='multiplex',
+        default=True,
+        help='open a separate ssh connection for each remote command instead ' \
+            + 'of sharing a single (ControlMaster) connection to each host')
+
+    parser.add_option('--no-plan',
+        action='store_false',
+        dest='plan',
+        default=True,
+        help='in "batch" and "check" of several repositories, run the ' \
+            + 'commands of each repository by themselves, instead of those ' \
+            + 'of all the repositories on each host together')
+
+    parser.add_option('--agent',
+        action='store_true',
+        dest='agent',
+        default=False,
+        help='start a single shell (an agent) on each remote host, over one ' \
+            + 'ssh session, and send it the commands of all the operations on ' \
+            + 'the host, instead of starting a new remote shell for each')
+
+    parser.add_option('--ssh',
+        action='store',
+        dest='ssh_program',
+        default=os.environ.get("YGIT_SSH", "ssh"),
+        metavar="<PROGRAM>",
+        help='program to run instead of "ssh" to reach remote hosts, which ' \
+            + 'must accept the same arguments (default: the value of the ' \
+            + 'YGIT_SSH environment variable, or "ssh")')
+
+    parser.add_option('--connect-timeout',
+        action='store',
+        type='float',
+        dest='connect_timeout',
+        default=30,
+        metavar="<SECONDS>",
+        help='give up connecting to a remote host after SECONDS (0 for no ' \
+            + 'limit; default: %default)')
+
+    parser.add_option('--command-timeout',
+        action='store',
+        type='float',
+        dest='command_timeout',
+        default=600,
+        metavar="<SECONDS>",
+        help='give up the remote commands of an operation after SECONDS (0 ' \
+            + 'for no limit; default: %default)')
+
+    parser.add_option('--retries',
+        action='store',
+        type='int',
+        dest='retries',
+        default=2,
+        metavar="<N>",
+        help='try the remote commands of an operation up to N more times if ' \
+            + 'the host cannot be reached (default: %default)')
+
+    parser.add_option('--retry-delay',
+        action='store',
+        type='float',
+        dest='retry_delay',
+        default=1.0,
+        metavar="<SECONDS>",
+        help='wait about SECONDS before the first retry, and twice as long ' \
+            + 'before each further one (default: %default)')
+
+    parser.add_option('--host-failures',
+        action='store',
+        type='int',
+        dest='host_failures',
+        default=3,
+        metavar="<N>",
+        help='once a host could not be reached N times in a row, fail the ' \
+            + 'remaining operations on it without trying to reach it (0 to ' \
+            + 'always try; default: %default)')
 
     init_opts = OptionGroup(parser, 'Initialization Options')
     parser.add_option_group(init_opts)
@@ -598,6 +5737,23 @@ def main():
             + 'When not specified, git will use permissions reported by ' \
             + 'umask(2). For more information, see "git help init".')
 
+    init_opts.add_option('--no-templates',
+        action='store_false',
+        dest='use_templates',
+        default=True,
+        help='always run "git init" to initialize local ("file://") ' \
+            + 'repositories, instead of copying them from a repository ' \
+            + 'initialized once per combination of options')
+
+    init_opts.add_option('--seed',
+        action='store_true',
+        dest='seed',
+        default=False,
+        help='after creating or initializing a repository, fill it with the ' \
+            + 'branches and tags of the local repository (see "--local-repo"), ' \
+            + 'from a bundle made once per run however many repositories ' \
+            + 'are seeded')
+
     add_opts = OptionGroup(parser, 'Adding Options')
     parser.add_option_group(add_opts)
 
@@ -618,6 +5774,15 @@ def main():
             + ' only makes sense in bare repositories. If a remote uses ' \
             + 'mirror mode, furthermore, git push will always behave as if ' \
             + '--mirror was passed.')
+    add_opts.add_option('--push',
+        action='store_true',
+        dest='push',
+        default=False,
+        help='with "setup", fill the new repository with the branches and ' \
+            + 'tags of the local repository as it is created, over the same ' \
+            + 'connection (see "--seed"), and then set up the branch checked ' \
+            + 'out locally to track the new remote, as "git push -u" would')
+
     add_opts.add_option('-l', '--local-repo',
         action='store',
         dest='local_repo',
@@ -628,14 +5793,267 @@ def main():
            + 'if this is not an initialized Git repository then ' \
            + 'the "add" operation will fail.')
 
-    (opts, args) = parser.parse_args()
+    parser.add_option('--socket',
+        action='store',
+        dest='socket_path',
+        default=os.environ.get("YGIT_SOCKET"),
+        metavar="<PATH>",
+        help='socket on which "serve" listens, and to which ' \
+           + '"ygit-client.py" connects (default: the value of the ' \
+           + 'YGIT_SOCKET environment variable, or "ygit.sock" in ' \
+           + '$XDG_RUNTIME_DIR)')
+
+    parser.add_option('--no-cache',
+        action='store_false',
+        dest='use_cache',
+        default=True,
+        help='neither use nor record the state of repositories in the remote ' \
+           + 'state cache (%s)' % default_cache_path().replace("%", "%%"))
+
+    parser.add_option('--cache-ttl',
+        action='store',
+        type='float',
+        dest='cache_ttl',
+        default=DEFAULT_CACHE_TTL,
+        metavar="<SECONDS>",
+        help='use the cached state of a repository for up to SECONDS after ' \
+           + 'it was found (default: %default)')
 
-    messenger = Messenger(ygit_quiet=opts.ygit_quiet,
-                          git_verbose=opts.git_verbose,
-                          all_quiet=opts.all_quiet,
-                          show_commands=opts.show_commands,
-                          show_debug=opts.show_debug,
-                          dry_run=opts.dry_run)
+    delete_opts = OptionGroup(parser, 'Deletion Options')
+    parser.add_option_group(delete_opts)
+
+    delete_opts.add_option('--quarantine',
+        action='store_true',
+        dest='quarantine',
+        default=False,
+        help='instead of removing repositories, "delete" moves them into the ' \
+           + 'trash directory on their host, which takes no time whatever ' \
+           + 'their size; quarantined repositories are removed by "purge"')
+
+    delete_opts.add_option('--background-purge',
+        action='store_true',
+        dest='background_purge',
+        default=False,
+        help='quarantine repositories (see "--quarantine"), and start ' \
+           + 'removing them in the background straight away')
+
+    delete_opts.add_option('--trash-dir',
+        action='store',
+        dest='trash_dir',
+        default=DEFAULT_TRASH_DIR,
+        metavar="<DIR>",
+        help='trash directory on each host, which must be on the same ' \
+           + 'filesystem as the repositories quarantined in it ' \
+           + '(default: %default)')
+
+    delete_opts.add_option('--older-than',
+        action='store',
+        dest='older_than',
+        default="7d",
+        metavar="<AGE>",
+        help='"purge" removes the repositories quarantined more than AGE ' \
+           + '(e.g., "12h", "7d" or "0") ago (default: %default)')
+
+    push_opts = OptionGroup(parser, 'Push Options')
+    parser.add_option_group(push_opts)
+
+    push_opts.add_option('--push-timeout',
+        action='store',
+        type='float',
+        dest='push_timeout',
+        default=DEFAULT_PUSH_TIMEOUT,
+        metavar="<SECONDS>",
+        help='"push-all" gives up on the push to any remote that is not ' \
+           + 'done after this many seconds ("0" for no limit; default: ' \
+           + '%default)')
+
+    multi_opts = OptionGroup(parser, 'Multiple Repository Options')
+    parser.add_option_group(multi_opts)
+
+    multi_opts.add_option('--url-file',
+        action='store',
+        dest='url_file',
+        default=None,
+        metavar="<FILE>",
+        help='read additional repository URLs from FILE ("-" for standard ' \
+           + 'input), one per line, for commands that accept several')
+
+    multi_opts.add_option('--json',
+        action='store_true',
+        dest='json',
+        default=False,
+        help='report the result for each repository as a JSON object on a ' \
+           + 'line of its own')
+
+    multi_opts.add_option('--journal',
+        action='store',
+        dest='journal',
+        default=None,
+        metavar="<FILE>",
+        help='record each step done by "batch" in FILE, which must not ' \
+           + 'already record steps (default: a new file named after the ' \
+           + 'manifest and the time, under "~/.cache/ygit/journals", ' \
+           + 'removed if all the steps succeed)')
+
+    multi_opts.add_option('--resume',
+        action='store',
+        dest='resume',
+        default=None,
+        metavar="<JOURNAL>",
+        help='in "batch", skip the steps recorded as done in JOURNAL (the ' \
+           + 'journal of an earlier run of the same manifest), and carry on ' \
+           + 'recording in it')
+
+    multi_opts.add_option('-j', '--jobs',
+        action='store',
+        type='int',
+        dest='jobs',
+        default=8,
+        metavar="<N>",
+        help='run at most N operations at the same time (default: %default)')
+
+    multi_opts.add_option('--jobs-per-host',
+        action='store',
+        type='int',
+        dest='jobs_per_host',
+        default=4,
+        metavar="<N>",
+        help='run at most N operations at the same time against any single ' \
+           + 'host (default: %default)')
+
+    return parser
+
+
+def create_messenger(opts, stdout=None, stderr=None):
+    """
+    Returns a `Messenger` configured by the command-line options.
+    """
+    return Messenger(ygit_quiet=opts.ygit_quiet,
+                     git_verbose=opts.git_verbose,
+                     all_quiet=opts.all_quiet,
+                     show_commands=opts.show_commands,
+                     show_debug=opts.show_debug,
+                     dry_run=opts.dry_run,
+                     stdout=stdout,
+                     stderr=stderr)
+
+def parse_command_args(command, args):
+    """
+    Validates the arguments given to `command`, returning a tuple of the
+    remote name (or None, if the command does not take one) and the
+    repository URL.
+    """
+    if command in ['setup', 'add']:
+        if len(args) < 2:
+            raise YonderGitError("'%s' requires specification of remote name and repository URL" % command)
+        elif len(args) > 2:
+            raise YonderGitError("'%s' takes a maximum of two arguments: remote name and repository URL" % command)
+        return args[0], args[1]
+    else:
+        if len(args) < 1:
+            raise YonderGitError("'%s' requires specification of repository URL" % command)
+        elif len(args) > 1:
+            raise YonderGitError("'%s' takes a maximum of one argument: the repository URL" % command)
+        return None, args[0]
+
+PROTOCOL_OPERATIONS = {
+    'check': 'repository checking',
+    'delete': 'repository removal',
+    'setup': 'repository creation',
+    'create': 'repository creation',
+    'init': 'repository initialization',
+    'list': 'repository listing',
+    'purge': 'purging quarantined repositories',
+}
+
+def parse_repo_url(command, remote_url):
+    """
+    Parses `remote_url` into a `RepositoryReference`, filling in the
+    defaults needed to operate on it, and validating that `command` supports
+    its protocol.
+    """
+    if remote_url.count(' ') or remote_url.count('\t'):
+        raise YonderGitError("Whitespace detected in URL path: refusing to continue with this insanity.")
+    repo_ref = RepositoryReference(remote_url)
+    if repo_ref.protocol == 'ssh':
+        if repo_ref.user is None:
+            repo_ref = repo_ref.replace(user=getpass.getuser())
+    elif repo_ref.protocol == 'file':
+        repo_ref = repo_ref.replace(repo_path=os.path.expanduser(os.path.expandvars(repo_ref.repo_path)))
+    if command in PROTOCOL_OPERATIONS \
+            and repo_ref.protocol != 'ssh' and repo_ref.protocol != 'file':
+        raise YonderGitError('Currently only supporting "ssh" or "file" protocol for %s.' \
+            % PROTOCOL_OPERATIONS[command])
+    return repo_ref
+
+async def connect_repo_ref_async(repo_ref, connections):
+    """
+    Returns a copy of `repo_ref` with the command used to reach its host
+    (the `ssh_command` argument list) set up.
+    """
+    if repo_ref.protocol == 'ssh':
+        return repo_ref.replace(ssh_command=await connections.ssh_command(repo_ref))
+    return repo_ref
+
+def debug_repo_ref(remote_name, repo_ref, messenger):
+    messenger.debug('\n---')
+    if remote_name:
+        messenger.debug("    Remote: '%s'" % remote_name)
+    if repo_ref.protocol:
+        messenger.debug("  Protocol: %s" % repo_ref.protocol)
+    if repo_ref.user:
+        messenger.debug("      User: %s" % repo_ref.user)
+    if repo_ref.host:
+        messenger.debug("      Host: %s" % repo_ref.host)
+    if repo_ref.port:
+        messenger.debug("      Port: %s" % repo_ref.port)
+    if repo_ref.dir_name:
+        messenger.debug(" Directory: %s" % repo_ref.dir_name)
+    if repo_ref.repo_name:
+        messenger.debug("Repository: %s" % repo_ref.repo_name)
+    messenger.debug('---\n')
+
+async def run_command_async(command, remote_name, repo_ref, messenger, opts, connections=None, plan=None):
+    """
+    Carries out `command` on the repository at `repo_ref` (see `Operation`),
+    first showing its steps on a dry run.
+    """
+    operation = Operation(command=command,
+                          remote_name=remote_name,
+                          repo_ref=repo_ref,
+                          messenger=messenger,
+                          opts=opts,
+                          connections=connections,
+                          plan=plan)
+    if messenger.dry_run:
+        show_operation_graphs([(operation.describe(), operation)], messenger)
+    await operation.run()
+
+def write_trace(path, messenger):
+    """
+    Writes the spans traced during the run to `path`.
+    """
+    try:
+        tracer.write(path)
+    except IOError as e:
+        messenger.error("Cannot write trace: %s" % e)
+
+def report_profile(profiler, messenger, limit=30):
+    """
+    Writes the profiling statistics collected by `profiler` to standard
+    error.
+    """
+    profiler.disable()
+    stats = pstats.Stats(profiler, stream=messenger.stderr)
+    stats.sort_stats("cumulative").print_stats(limit)
+
+def main():
+    """
+    Main CLI handler.
+    """
+    parser = create_option_parser()
+    (opts, args) = parser.parse_args()
+    messenger = create_messenger(opts)
 
     if opts.commands:
         show_commands_help()
@@ -672,119 +6090,103 @@ def main():
             parser.print_help()
             sys.exit(0)
 
-    command_command = args[0].lower()
+    command = args[0].lower()
     args = args[1:]
-    valid_commands = ['setup', 'create', 'init', 'add', 'check', 'delete']
-    if command_command not in valid_commands:
-        messenger.error("'%s' is not a valid command" % command_command)
+    if command not in VALID_COMMANDS:
+        messenger.error("'%s' is not a valid command" % command)
         sys.exit(1)
-    if command_command in ['setup', 'add']:
-        if len(args) < 2:
-            messenger.error("'%s' requires specification of remote name and repository URL" % command_command)
-            sys.exit(1)
-        elif len(args) > 2:
-            messenger.error("'%s' takes a maximum of two arguments: remote name and repository URL" % command_command)
-            sys.exit(1)
-        remote_name = args[0]
-        remote_url = args[1]
-    else:
-        if len(args) < 1:
-            messenger.error("'%s' requires specification of repository URL" % command_command)
-            sys.exit(1)
-        elif len(args) > 1:
-            messenger.error("'%s' takes a maximum of one argument: the repository URL" % command_command)
-            sys.exit(1)
-        remote_name = None
-        remote_url = args[0]
-
-    command_check = False
-    command_delete = False
-    command_create = False
-    command_init = False
-    command_add = False
-    if command_command == 'check':
-       command_check = True
-    if command_command == 'delete':
-       command_delete = True
-    if command_command == 'setup':
-       command_create = True
-       command_add = True
-    if command_command == 'create':
-       command_create = True
-    if command_command == 'init':
-       command_init = True
-    if command_command == 'add':
-       command_add = True
 
-    if remote_url.count(' ') or remote_url.count('\t'):
-        messenger.error("Whitespace detected in URL path: refusing to continue with this insanity.")
+    if opts.trace_file:
+        tracer.enable()
+        # registered before the connection manager, so that the trace is
+        # written after the connections are closed
+        atexit.register(write_trace, opts.trace_file, messenger)
+    if opts.profile:
+        profiler = cProfile.Profile()
+        atexit.register(report_profile, profiler, messenger)
+        profiler.enable()
+    connections = SshConnectionManager(messenger=messenger,
+            multiplex=opts.multiplex,
+            ssh_program=opts.ssh_program,
+            connect_timeout=opts.connect_timeout)
+    host_health.configure(opts)
+    if opts.agent:
+        remote_agents.enable(messenger)
+        # registered after the connection manager, so that the agents are
+        # stopped before the connections they use are closed
+        atexit.register(remote_agents.close_all)
+    try:
+        if command == 'batch':
+            if len(args) != 1:
+                raise YonderGitError("'batch' requires specification of a single manifest file")
+            journal_path = batch_journal_path(args[0], opts)
+            try:
+                if not run_sync(run_batch_async(args[0], journal_path, connections, messenger, opts)):
+                    sys.exit(1)
+            except KeyboardInterrupt:
+                messenger.error('Interrupted: to carry on, run "ygit.py batch %s --resume %s".' \
+                    % (shell_quote(args[0]), shell_quote(journal_path)))
+                sys.exit(130)
+            return
+        if command == 'serve':
+            if args:
+                raise YonderGitError("'serve' does not take any arguments")
+            run_sync(serve_async(connections, messenger, opts))
+            return
+        if command == 'push-all':
+            if not run_sync(push_all_async(args, messenger, opts)):
+                sys.exit(1)
+            return
+        if command == 'delete':
+            urls = list(args)
+            if opts.url_file:
+                urls.extend(read_url_list(opts.url_file))
+            if not urls:
+                raise YonderGitError("'delete' requires specification of repository URL")
+            if not run_sync(delete_urls_async(urls, connections, messenger, opts)):
+                sys.exit(1)
+            return
+        if command == 'list':
+            urls = list(args)
+            if opts.url_file:
+                urls.extend(read_url_list(opts.url_file))
+            if not urls:
+                raise YonderGitError("'list' requires specification of the directory to list (e.g., \"user@host:/srv/git\")")
+            if not run_sync(list_urls_async(urls, connections, messenger, opts)):
+                sys.exit(1)
+            return
+        if command == 'purge':
+            urls = list(args)
+            if opts.url_file:
+                urls.extend(read_url_list(opts.url_file))
+            if not urls:
+                raise YonderGitError("'purge' requires specification of at least one host (e.g., \"user@host:\" or \"file:///\")")
+            if not run_sync(purge_urls_async(urls, connections, messenger, opts)):
+                sys.exit(1)
+            return
+        if command == 'check' and (len(args) != 1 or opts.url_file or opts.json):
+            urls = list(args)
+            if opts.url_file:
+                urls.extend(read_url_list(opts.url_file))
+            if not urls:
+                raise YonderGitError("'check' requires specification of repository URL")
+            if not run_sync(check_remotes_async(urls, connections, messenger, opts)):
+                sys.exit(1)
+            return
+        remote_name, remote_url = parse_command_args(command, args)
+        repo_ref = parse_repo_url(command, remote_url)
+        debug_repo_ref(remote_name, repo_ref, messenger)
+        run_sync(run_command_async(command=command,
+                                   remote_name=remote_name,
+                                   repo_ref=repo_ref,
+                                   messenger=messenger,
+                                   opts=opts,
+                                   connections=connections))
+    except YonderGitError as e:
+        messenger.error(str(e))
         sys.exit(1)
-
-    repo_ref = RepositoryReference(remote_url)
-
-    messenger.debug('\n---')
-    if remote_name:
-        messenger.debug("    Remote: '%s'" % remote_name)
-    if repo_ref.protocol:
-        messenger.debug("  Protocol: %s" % repo_ref.protocol)
-    if repo_ref.user:
-        messenger.debug("      User: %s" % repo_ref.user)
-    if repo_ref.host:
-        messenger.debug("      Host: %s" % repo_ref.host)
-    if repo_ref.port:
-        messenger.debug("      Port: %s" % repo_ref.port)
-    if repo_ref.dir_name:
-        messenger.debug(" Directory: %s" % repo_ref.dir_name)
-    if repo_ref.repo_name:
-        messenger.debug("Repository: %s" % repo_ref.repo_name)
-    messenger.debug('---\n')
-
-    # setup support for commands
-    if repo_ref.protocol == 'ssh':
-        if repo_ref.user is None:
-            repo_ref.user = getpass.getuser()
-        repo_ref.ssh_command = "ssh " + repo_ref.user + "@" + repo_ref.host
-    elif repo_ref.protocol == 'file':
-        repo_ref.repo_path = os.path.expanduser(os.path.expandvars(repo_ref.repo_path))
-
-    # check #
-    if command_check:
-        if repo_ref.protocol != 'ssh' and repo_ref.protocol != 'file':
-            messenger.error('Currently only supporting "ssh" or "file" protocol for repository checking.')
-            sys.exit(1)
-        check_remote(repo_ref=repo_ref, messenger=messenger, opts=opts)
-
-    # delete #
-    if command_delete:
-        if repo_ref.protocol != 'ssh' and repo_ref.protocol != 'file':
-            messenger.error('Currently only supporting "ssh" or "file" protocol for repository removal.')
-            sys.exit(1)
-        delete_remote(repo_ref=repo_ref, messenger=messenger, opts=opts)
-
-    # create and/or init #
-    if command_create:
-        if repo_ref.protocol != 'ssh' and repo_ref.protocol != 'file':
-            messenger.error('Currently only supporting "ssh" or "file" protocol for repository creation.')
-            sys.exit(1)
-        create_remote(repo_ref=repo_ref, messenger=messenger, opts=opts, init=True)
-    elif command_init:
-        if repo_ref.protocol != 'ssh' and repo_ref.protocol != 'file':
-            messenger.error('Currently only supporting "ssh" or "file" protocol for repository initialization.')
-            sys.exit(1)
-        init_remote(repo_ref=repo_ref,
-                    messenger=messenger,
-                    opts=opts,
-                    check=True)
-
-    # add #
-    if command_add:
-        assert remote_name is not None
-        add_remote(remote_name, repo_ref, messenger, opts)
+    finally:
+        command_runner.report(messenger)
 
 if __name__ == '__main__':
     main()
-
-
-
-
-
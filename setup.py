@@ -44,9 +44,10 @@ Remote Git repository management utilities.""",
       packages=[],
       package_dir={},
       package_data={},
-      scripts=['scripts/ygit.py'],
+      scripts=['scripts/ygit.py', 'scripts/ygit-client.py'],
       include_package_data=True,
       zip_safe=True,
+      python_requires='>=3.7',
       install_requires=[
           # -*- Extra requirements: -*-
       ],
@@ -63,6 +64,7 @@ filesystem and repository maintenance operations.""",
             "Natural Language :: English",
             "Operating System :: OS Independent",
             "Programming Language :: Python",
+            "Programming Language :: Python :: 3",
             ],
       keywords='Git version control',
       )